@@ -57,7 +57,8 @@ parser.add_argument("-m","--molecule_size", \
                     default = 45000, \
                     type = int)
 parser.add_argument("-n","--n_proc", \
-                    help="Number of processes to run during scaffolding. [1]", \
+                    help="Number of processes to run during barcode collection \
+                    and scaffolding. [1]", \
                     default = 1, \
                     type = int)
 parser.add_argument("-r","--barcode_fraction", \
@@ -93,6 +94,64 @@ parser.add_argument("-b","--bc_quantity", \
                     help="Minimum number of reads per barcode. [3]", \
                     default = 3, \
                     type = int)
+parser.add_argument("-w","--overlap_window", \
+                    help="Only search this many bases at each contig end for \
+                    overlaps during merging. Should be larger than the longest \
+                    expected overlap, e.g. --molecule_size. 0 searches the \
+                    whole contigs. [0]", \
+                    default = 0, \
+                    type = int)
+parser.add_argument("--max_traversal", \
+                    help="Maximum number of path extensions when searching \
+                    for the best path through the overlaps of a junction. \
+                    [100000]", \
+                    default = 100000, \
+                    type = int)
+parser.add_argument("--single_pass", \
+                    help="Collect barcodes for the linkgraph and for short \
+                    contigs in a single sequential pass over the bam file, \
+                    instead of fetching every window separately. With \
+                    --n_proc > 1 the contigs are split into shards, and \
+                    every shard is read sequentially once.", \
+                    action="store_true")
+parser.add_argument("--top_k", \
+                    help="Only keep the fractions of shared barcodes of the k \
+                    windows that share the most barcodes with each window, \
+                    to bound the memory of the linkgraph construction. \
+                    Outliers beyond the k largest are lost. 0 keeps all \
+                    fractions. [0]", \
+                    default = 0, \
+                    type = int)
+parser.add_argument("--minhash_size", \
+                    help="Number of MinHash values to sketch the barcodes of \
+                    each window with. If > 0, only windows whose sketches \
+                    agree in at least one of --lsh_bands bands are compared, \
+                    instead of all pairs of windows. Approximate, for highly \
+                    fragmented assemblies: links between windows that LSH \
+                    does not pair are missed, and the outlier bounds of \
+                    windows sharing barcodes with many others are estimated \
+                    from a sample of them. Overrides --top_k. [0]", \
+                    default = 0, \
+                    type = int)
+parser.add_argument("--lsh_bands", \
+                    help="Number of bands to split the MinHash sketches into. \
+                    More bands, i.e. fewer values per band, find windows \
+                    sharing fewer barcodes but compare more pairs. [64]", \
+                    default = 64, \
+                    type = int)
+parser.add_argument("--memory_budget", \
+                    help="Compare the windows for the linkgraph in tiles that \
+                    are spilled to disk, using about this many GB of memory \
+                    in addition to the collected barcodes. Tiles are \
+                    compared in --n_proc processes. Ignored with --top_k or \
+                    --minhash_size. 0 compares all windows in memory. [0]", \
+                    default = 0, \
+                    type = float)
+parser.add_argument("--dump_fractions", \
+                    help="Write the fractions of shared barcodes between all \
+                    windows to <prefix>.fractions.npz, for inspection with \
+                    graph_building.loadFractions.", \
+                    action="store_true")
 parser.add_argument("-o","--output", \
                     help="Prefix for output files.", \
                     type = str)
@@ -118,14 +177,6 @@ def writeGfa(outfilename, input_contig_lengths, graph):
             gfa.write("S\t{0}\t*\tLN:i:{1}\n".format(k,str(v)))
         gfa.write(formatting_tools.formatGFA(graph))
 
-def writeFasta(outfilename, linked_scaffolds):
-    '''Writes fasta output.
-    '''
-    with open(outfilename+".fasta","w",encoding = "utf-8") as fastaout:
-        for k,v in linked_scaffolds.items():
-            fastaout.write(">"+k+"\n")
-            fastaout.write(v+"\n")
-
 def writePaths(outfilename, scaffolds):
     '''
     Writes the usable paths from the graph
@@ -134,14 +185,6 @@ def writePaths(outfilename, scaffolds):
         for k,v in scaffolds.items():
             pathsout.write("{}\t{}\n".format(k,v))
 
-def writeBed(outfilename, bed_dict):
-    ''' Write a bed file from dict.
-    '''
-    with open(outfilename+".bed", "w") as out:
-        for k,v in bed_dict.items():
-            for feature in v:
-                out.write(k+"\t"+"\t".join(feature)+"\n")
-
 def main():
     misc.printstatus("Starting ARBitR.")
 
@@ -157,8 +200,17 @@ def main():
     barcode_fraction = args.barcode_fraction
     mincov = args.coverage
     bc_quantity = args.bc_quantity
+    overlap_window = args.overlap_window
+    max_traversal = args.max_traversal
+    minhash_size = args.minhash_size
+    lsh_bands = args.lsh_bands
     gapsize = 100
 
+    if minhash_size > 0 and not 0 < lsh_bands <= minhash_size:
+        misc.printstatus("--lsh_bands must be between 1 and --minhash_size. \
+                            Using {} bands instead.".format(minhash_size))
+        lsh_bands = minhash_size
+
     if region_size > molecule_size:
         misc.printstatus(   "Larger --region_size than --molecule_size detected. \
                             Using default values instead.")
@@ -179,19 +231,45 @@ def main():
                                 - backbone_contig_lengths.keys()}
 
     # First step is to collect the barcodes for the backbone graph
-    misc.printstatus("Collecting barcodes for linkgraph.")
-    GEMlist = barcode_collection.main(  args.input_bam, \
-                                        backbone_contig_lengths, \
-                                        region_size, \
-                                        mapq, \
-                                        bc_quantity)
+    if args.single_pass:
+        misc.printstatus("Collecting barcodes for linkgraph and short contigs.")
+        GEMlist, small_GEMlist = barcode_collection.collectAll( args.input_bam, \
+                                                                backbone_contig_lengths, \
+                                                                small_contig_lengths, \
+                                                                region_size, \
+                                                                molecule_size, \
+                                                                mapq, \
+                                                                bc_quantity, \
+                                                                short_mapq, \
+                                                                short_bc_quant, \
+                                                                n_proc)
+    else:
+        misc.printstatus("Collecting barcodes for linkgraph.")
+        GEMlist = barcode_collection.main(  args.input_bam, \
+                                            backbone_contig_lengths, \
+                                            region_size, \
+                                            mapq, \
+                                            bc_quantity, \
+                                            n_proc)
+
+    sketches = None
+    if minhash_size > 0:
+        misc.printstatus("Sketching barcodes for linkgraph.")
+        sketches = GEMlist.minhash(minhash_size)
 
     # Second step is to build the link graph based on the barcodes
     misc.printstatus("Creating link graph.")
     backbone_graph = graph_building.main(backbone_contig_lengths, \
                                         GEMlist, \
                                         barcode_factor, \
-                                        barcode_fraction)
+                                        barcode_fraction, \
+                                        outfilename+".fractions.npz" if args.dump_fractions else None, \
+                                        args.top_k, \
+                                        sketches, \
+                                        lsh_bands, \
+                                        args.memory_budget * 1e9, \
+                                        n_proc, \
+                                        os.path.dirname(os.path.abspath(outfilename)))
 
     misc.printstatus("Writing link graph to {}.backbone.gfa.".format(outfilename))
     writeGfa(outfilename+".backbone", backbone_contig_lengths, backbone_graph)
@@ -205,12 +283,16 @@ def main():
 
     # Fourth step is to collect the barcodes from the input bam file,
     # this time for the small contigs
-    misc.printstatus("Collecting barcodes from short contigs.")
-    GEMlist = barcode_collection.main(  args.input_bam, \
-                                        small_contig_lengths, \
-                                        molecule_size, \
-                                        short_mapq, \
-                                        short_bc_quant)
+    if args.single_pass:
+        GEMlist = small_GEMlist
+    else:
+        misc.printstatus("Collecting barcodes from short contigs.")
+        GEMlist = barcode_collection.main(  args.input_bam, \
+                                            small_contig_lengths, \
+                                            molecule_size, \
+                                            short_mapq, \
+                                            short_bc_quant, \
+                                            n_proc)
 
     # Fifth step is to pull in the short contigs into the linkgraph junctions,
     # if they have
@@ -223,27 +305,19 @@ def main():
     if os.path.isfile(args.input_fasta):
         # If user gave an assembly fasta file, use this for merging
         misc.printstatus("Found fasta file for merging: {}".format(args.input_fasta))
-        new_scaffolds, \
-        scaffold_correspondence, \
-        bed = merge_fasta.main( args.input_fasta, \
-                                args.input_bam, \
-                                paths, \
-                                mincov, \
-                                gapsize, \
-                                n_proc)
-        misc.printstatus("Writing merged fasta to {0}.fasta".format(outfilename))
-        writeFasta(outfilename,new_scaffolds)
-        writePaths(outfilename+".correspondence", scaffold_correspondence)
-        writeBed(outfilename, bed)
+        merge_fasta.main(   args.input_fasta, \
+                            args.input_bam, \
+                            paths, \
+                            mincov, \
+                            gapsize, \
+                            n_proc, \
+                            outfilename, \
+                            overlap_window, \
+                            max_traversal)
 
     else:
         misc.printstatus("No fasta file found for merging. Pipeline finished.")
 
-    # Cleanup temp files
-    tmp_files = [file for file in os.listdir() if file.endswith(".tmp.fasta")]
-    for tmp in tmp_files:
-        os.remove(tmp)
-
     misc.printstatus("ARBitR successfully completed!\n")
 
 if __name__ == "__main__":
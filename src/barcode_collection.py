@@ -14,9 +14,137 @@ import numpy as np
 import pysam
 from scipy.stats import t
 from collections import defaultdict
+import heapq
+import itertools
+import multiprocessing
 
 import misc
 
+# Barcodes are interned as integer IDs, shared by all GEMlists of a run so
+# that windows collected in separate calls can be compared
+barcode_ids = {} # {barcode: ID}
+
+class GEMlist:
+    '''Barcodes collected from a set of windows.
+
+    Every barcode is stored as its integer ID in barcode_ids. The windows are
+    kept in a compressed sparse row layout: the barcodes of the window at
+    position idx are the sorted uint32 array indices[indptr[idx]:indptr[idx+1]].
+    GEMlist can be used like a dict of windows (keys) and barcode arrays
+    (values).
+    '''
+    def __init__(self, windows = [], barcode_arrays = []):
+        self.windows = list(windows) # [region1, region2, ...]
+        self.index = {region:idx for idx, region in enumerate(self.windows)}
+        self.indptr = np.zeros(len(self.windows)+1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum([len(arr) for arr in barcode_arrays])
+        if len(barcode_arrays) > 0:
+            self.indices = np.concatenate(barcode_arrays).astype(np.uint32, copy=False)
+        else:
+            self.indices = np.zeros(0, dtype=np.uint32)
+
+    def __str__(self):
+        return "GEMlist([windows: {0},barcodes: {1}])".format(len(self.windows), len(self.indices))
+
+    def __eq__(self, other):
+        return isinstance(other, GEMlist) \
+                and self.windows == other.windows \
+                and np.array_equal(self.indptr, other.indptr) \
+                and np.array_equal(self.indices, other.indices)
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __iter__(self):
+        return iter(self.windows)
+
+    def __contains__(self, region):
+        return region in self.index
+
+    def __getitem__(self, region):
+        '''Returns the sorted barcode IDs of the given window.
+        '''
+        idx = self.index[region]
+        return self.indices[self.indptr[idx]:self.indptr[idx+1]]
+
+    def keys(self):
+        '''Returns all windows.
+        '''
+        return self.windows
+
+    def items(self):
+        '''Iterates over windows and their barcode arrays.
+        '''
+        for idx, region in enumerate(self.windows):
+            yield region, self.indices[self.indptr[idx]:self.indptr[idx+1]]
+
+    def sizes(self):
+        '''Returns the number of barcodes in every window.
+        '''
+        return np.diff(self.indptr)
+
+    def rows(self):
+        '''Returns the window position of every entry in indices.
+        '''
+        return np.repeat(np.arange(len(self.windows)), self.sizes())
+
+    def minhash(self, n_hashes, seed = 0):
+        '''Returns the MinHash sketch of the barcodes of every window.
+
+        Description:
+            Every hash function is a multiply-shift hash of the barcode IDs,
+            and the sketch of a window holds the minimum of each hash over
+            its barcodes. The fraction of hashes where the sketches of two
+            windows agree estimates the fraction of shared barcodes, as in
+            graph_building.pairwise_comparisons and
+            fill_junctions.sharedCandidates. Barcode IDs are shared by all
+            GEMlists of a run, so sketches with the same seed are comparable.
+
+        Returns:
+            np.array: n_windows x n_hashes, uint32. Windows without barcodes
+                get the maximum value.
+        '''
+        rng = np.random.default_rng(seed)
+        multipliers = rng.integers(1, 2**63, size=n_hashes, dtype=np.uint64) | np.uint64(1)
+        increments = rng.integers(0, 2**63, size=n_hashes, dtype=np.uint64)
+        sketches = np.full((len(self.windows), n_hashes), np.iinfo(np.uint32).max, dtype=np.uint32)
+        nonempty = self.sizes() > 0
+        starts = self.indptr[:-1][nonempty]
+        if len(starts) == 0:
+            return sketches
+        IDs = self.indices.astype(np.uint64)
+        for idx in range(n_hashes):
+            # Multiplication wraps around at 2**64, the high bits are the hash
+            hashes = ((IDs * multipliers[idx] + increments[idx]) >> np.uint64(32)).astype(np.uint32)
+            sketches[nonempty, idx] = np.minimum.reduceat(hashes, starts)
+        return sketches
+
+def internBarcodes(BC_set):
+    '''Returns the barcodes in BC_set as a sorted array of integer IDs.
+    Barcodes that have not been seen before are added to barcode_ids.
+    '''
+    IDs = np.fromiter( (barcode_ids.setdefault(BC, len(barcode_ids)) for BC in sorted(BC_set)), \
+                        dtype=np.uint32, count=len(BC_set))
+    IDs.sort()
+    return IDs
+
+def makeGEMlist(windows, BC_sets):
+    '''Builds a GEMlist from collected barcode sets.
+    Args:
+        windows (list): Windows in the order to keep them, as tuples where
+            the first element is the region name.
+        BC_sets (dict): region (keys) and set of barcodes (values).
+    Returns:
+        GEMlist: windows with at least 100 barcodes.
+    '''
+    regions, barcode_arrays = [], []
+    for window in windows:
+        # If at least 100 barcodes in list, use it
+        if len(BC_sets[window[0]]) > 100:
+            regions.append(window[0])
+            barcode_arrays.append(internBarcodes(BC_sets[window[0]]))
+    return GEMlist(regions, barcode_arrays)
+
 def collectGEMs(window, mapq, quant):
     """Collect the barcodes from the given window, if they fulfill some criteria.
     Args:
@@ -66,19 +194,249 @@ def getWindows(region_size, contig_dict):
             yield (contig+"s", 0, region_size)
             yield (contig+"e", length - region_size, length)
 
-def main(input_bam, contig_dict, region_size=20000, mapq=60, bc_quant = 2):
+def streamGEMs(windows, contigs = None):
+    """Collect the barcodes from all given windows in a single pass over samfile.
+    Description:
+        Instead of fetching every window separately, the coordinate sorted
+        bam file is read once from front to back and every read is assigned
+        to all windows it overlaps. Each window carries its own mapping
+        quality and barcode quantity cutoffs, so backbone and short contig
+        windows can be collected together. If contigs are given, only those
+        contigs are read, each with a single fetch of the whole contig.
+    Args:
+        windows (list): Windows as tuples of (region, contig, start, end,
+            mapq, quant).
+        contigs (list): Contigs to read. Defaults to the whole bam file.
+    Returns:
+        dict: region (keys) and the set of barcodes collected from it (values).
+    """
+    # Windows are looked up by reference id to avoid name lookups per read
+    tid_windows = [[] for _ in samfile.references]
+    for window in windows:
+        tid_windows[samfile.get_tid(window[1])].append(window)
+
+    BC_sets = {window[0]:set() for window in windows}
+    occurrences = {window[0]:defaultdict(int) for window in windows}
+    current_tid = -1
+
+    if contigs is None:
+        reads = samfile.fetch(until_eof=True)
+    else:
+        # Read the contigs in the order they are stored in
+        reads = itertools.chain.from_iterable( samfile.fetch(contig) for contig \
+                                                in sorted(contigs, key=samfile.get_tid) )
+
+    for read in reads:
+        tid = read.reference_id
+        if tid < 0:
+            # Unmapped reads are placed last in a sorted bam file
+            break
+
+        if tid != current_tid:
+            current_tid = tid
+            if contigs is None and tid in range(0,100000000,20):
+                misc.printstatusFlush("[ BARCODE COLLECTION ]\t" + \
+                misc.reportProgress(tid, len(tid_windows)))
+
+        if not tid_windows[tid] \
+        or not read.has_tag('BX') \
+        or not read.is_proper_pair \
+        or read.is_qcfail:
+            continue
+
+        # Same overlap definition as samfile.fetch(tig, start, stop)
+        read_start = read.reference_start
+        read_end = read.reference_end if read.reference_end else read_start + 1
+        BC = None
+        for region, contig, start, end, mapq, quant in tid_windows[tid]:
+            if read_start < end and read_end > start \
+            and read.mapping_quality >= mapq:
+                if BC is None:
+                    BC = read.get_tag("BX")
+                occurrences[region][BC] += 1
+
+                if occurrences[region][BC] >= quant:
+                    BC_sets[region].add(BC)
+
+    if contigs is None:
+        misc.printstatus("[ BARCODE COLLECTION ]\t" + \
+        misc.reportProgress(len(tid_windows), len(tid_windows)))
+
+    return BC_sets
+
+def initWorker(input_bam):
+    '''Opens a separate handle to the bam file in each worker process.
+    '''
     global samfile
     samfile = pysam.AlignmentFile(input_bam, "rb")
-    GEMlist = {} # Inappropriately named "list"
+
+def collectShard(shard):
+    '''Collect the barcodes from every window in a shard.
+    Args:
+        shard (list): Windows as tuples of (region, contig, start, end,
+            mapq, quant).
+    Returns:
+        dict: region (keys) and the set of barcodes collected from it (values).
+    '''
+    return { region:collectGEMs((contig, start, end), mapq, quant) \
+            for region, contig, start, end, mapq, quant in shard }
+
+def streamShard(shard):
+    '''Collect the barcodes from every window in a shard, reading each
+    contig of the shard once from start to end.
+    Args:
+        shard (list): Windows as tuples of (region, contig, start, end,
+            mapq, quant).
+    Returns:
+        dict: region (keys) and the set of barcodes collected from it (values).
+    '''
+    return streamGEMs(shard, set(window[1] for window in shard))
+
+def makeShards(windows, n_shards, contig_weights, whole_contigs = False):
+    '''Split windows into shards of contigs with balanced amounts of reads.
+
+    Description:
+        All windows of a contig are put in the same shard. The cost of a
+        contig is estimated from the number of mapped reads in the bam index,
+        scaled by the fraction of the contig that is covered by its windows,
+        unless whole contigs are read. Contigs are then assigned greedily, heaviest first, to the shard
+        with the lowest total cost.
+
+    Args:
+        windows (list): Windows as tuples of (region, contig, start, end,
+            mapq, quant).
+        n_shards (int): Number of shards to create.
+        contig_weights (dict): Contig names (keys) and number of mapped reads
+            (values).
+        whole_contigs (bool): If the whole contigs are read, not only their
+            windows.
+    Returns:
+        list: shards, lists of windows.
+    '''
+    contig_windows = defaultdict(list)
+    for window in windows:
+        contig_windows[window[1]].append(window)
+
+    def cost(contig):
+        if whole_contigs:
+            return contig_weights.get(contig, 0)
+        window_length = sum([window[3] - window[2] for window in contig_windows[contig]])
+        contig_length = max([window[3] for window in contig_windows[contig]])
+        return contig_weights.get(contig, 0) * window_length / max(contig_length, 1)
+
+    # Sort by decreasing cost, ties by contig name to stay deterministic
+    contigs = sorted(contig_windows.keys(), key = lambda contig: (-cost(contig), contig))
+    shards = [[] for _ in range(n_shards)]
+    loads = [(0, idx) for idx in range(n_shards)]
+    for contig in contigs:
+        load, idx = heapq.heappop(loads)
+        shards[idx].extend(contig_windows[contig])
+        heapq.heappush(loads, (load + cost(contig), idx))
+
+    return [shard for shard in shards if shard]
+
+def parallelGEMs(input_bam, windows, n_proc, stream = False):
+    '''Collect the barcodes from all given windows using a pool of processes.
+    Args:
+        input_bam (str): Path to coordinate sorted and indexed bam file.
+        windows (list): Windows as tuples of (region, contig, start, end,
+            mapq, quant).
+        n_proc (int): Number of processes.
+        stream (bool): Read every contig of a shard once from start to end,
+            as in streamGEMs, instead of fetching every window.
+    Returns:
+        dict: region (keys) and the set of barcodes collected from it (values).
+    '''
+    samfile = pysam.AlignmentFile(input_bam, "rb")
+    contig_weights = {stat.contig:stat.mapped for stat in samfile.get_index_statistics()}
+    samfile.close()
+
+    shards = makeShards(windows, n_proc, contig_weights, whole_contigs=stream)
+    misc.printstatus("[ BARCODE COLLECTION ]\tCollecting from {0} shards in {1} processes.".format( \
+                    len(shards), n_proc))
+
+    BC_sets = {}
+    with multiprocessing.Pool(n_proc, initializer=initWorker, initargs=(input_bam,)) as pool:
+        for idx, shard_sets in enumerate(pool.imap_unordered(streamShard if stream else collectShard, \
+                                                            shards)):
+            misc.printstatusFlush("[ BARCODE COLLECTION ]\t" + \
+            misc.reportProgress(idx+1, len(shards)))
+            BC_sets.update(shard_sets)
+    misc.printstatus("[ BARCODE COLLECTION ]\t" + \
+    misc.reportProgress(len(shards), len(shards)))
+
+    return BC_sets
+
+def collectAll(input_bam, backbone_contig_dict, small_contig_dict, \
+                region_size=20000, molecule_size=45000, mapq=60, bc_quant=3, \
+                short_mapq=20, short_bc_quant=2, n_proc=1):
+    '''Collect the barcodes of backbone and short contigs in one pass.
+
+    Description:
+        Produces the same GEMlists as running main once for the backbone
+        contig ends and once for the short contigs, but reads the bam file
+        sequentially a single time instead of seeking to every window. With
+        more than one process, the contigs are split into shards and every
+        process reads the contigs of its shards sequentially, once each.
+
+    Args:
+        input_bam (str): Path to coordinate sorted and indexed bam file.
+        backbone_contig_dict (dict): Backbone contigs and their lengths.
+        small_contig_dict (dict): Short contigs and their lengths.
+        region_size (int): Window size at the backbone contig ends.
+        molecule_size (int): Window size for short contigs.
+        mapq (int): Mapping quality cutoff for backbone windows.
+        bc_quant (int): Cutoff for number of reads per barcode in backbone
+            windows.
+        short_mapq (int): Mapping quality cutoff for short contig windows.
+        short_bc_quant (int): Cutoff for number of reads per barcode in short
+            contig windows.
+        n_proc (int): Number of processes.
+    Returns:
+        GEMlist: barcodes of the backbone contig windows.
+        GEMlist: barcodes of the short contig windows.
+    '''
+    global samfile
+
+    misc.printstatus("Starting barcode collection of backbone and short contigs. Found {0} contigs.".format( \
+                    len(backbone_contig_dict.keys()) + len(small_contig_dict.keys())))
+
+    backbone_windows = [ (window[0], window[0][:-1], window[1], window[2], mapq, bc_quant) \
+                        for window in getWindows(region_size, backbone_contig_dict) ]
+    small_windows = [ (window[0], window[0][:-1], window[1], window[2], short_mapq, short_bc_quant) \
+                    for window in getWindows(molecule_size, small_contig_dict) ]
+
+    if n_proc > 1:
+        BC_sets = parallelGEMs(input_bam, backbone_windows + small_windows, n_proc, stream=True)
+    else:
+        samfile = pysam.AlignmentFile(input_bam, "rb")
+        BC_sets = streamGEMs(backbone_windows + small_windows)
+        samfile.close()
+
+    # Keep the window order of main
+    return makeGEMlist(backbone_windows, BC_sets), makeGEMlist(small_windows, BC_sets)
+
+def main(input_bam, contig_dict, region_size=20000, mapq=60, bc_quant = 2, n_proc = 1):
+    global samfile
 
     # First step is to collect all barcodes (passing -q cutoff) that are aligned
     # to each contigs first and last regions (-l)
     misc.printstatus("Starting barcode collection. Found {0} contigs.".format(len(contig_dict.keys())))
 
+    if n_proc > 1:
+        # Shard the windows by contig over a pool of processes, then merge
+        # the results in window order
+        windows = [ (window[0], window[0][:-1], window[1], window[2], mapq, bc_quant) \
+                    for window in getWindows(region_size, contig_dict) ]
+        return makeGEMlist(windows, parallelGEMs(input_bam, windows, n_proc))
+
+    samfile = pysam.AlignmentFile(input_bam, "rb")
+
     # Generate windows
     windows = getWindows(region_size, contig_dict)
 
     # Iterate over windows to collect barcodes sets
+    regions, barcode_arrays = [], []
     for idx, window in enumerate(windows):
         # Unpack variables, for readability
         region, contig, start, end = window[0], window[0][:-1], window[1], window[2]
@@ -98,7 +456,8 @@ def main(input_bam, contig_dict, region_size=20000, mapq=60, bc_quant = 2):
 
         # If at least 100 barcodes in list, use it
         if len(GEMs) > 100:
-            GEMlist[region] = GEMs
+            regions.append(region)
+            barcode_arrays.append(internBarcodes(GEMs))
 
     if region[-1] == "a":
         misc.printstatus("[ BARCODE COLLECTION ]\t" + \
@@ -108,4 +467,4 @@ def main(input_bam, contig_dict, region_size=20000, mapq=60, bc_quant = 2):
         misc.reportProgress(len(contig_dict.keys())*2, len(contig_dict.keys())*2))
     samfile.close()
 
-    return GEMlist
+    return GEMlist(regions, barcode_arrays)
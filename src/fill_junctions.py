@@ -12,11 +12,39 @@ Licensed under the GPL3 license. See LICENSE file.
 """
 
 import numpy as np
-import pandas as pd
 
 import graph_building
 import misc
 
+def invertedIndex(GEMlist):
+    '''Create an inverted index from barcode IDs to the windows of GEMlist.
+
+    Returns:
+        scipy.sparse.csr_matrix: barcode x window incidence matrix. The windows
+            containing barcode ID b are indices[indptr[b]:indptr[b+1]].
+    '''
+    return graph_building.incidenceMatrix(GEMlist).T.tocsr()
+
+def sharedCandidates(barcodes, inverted_index):
+    '''Find the windows sharing at least one barcode with barcodes.
+
+    Args:
+        barcodes (np.array): Sorted barcode IDs.
+        inverted_index (scipy.sparse.csr_matrix): from invertedIndex.
+    Returns:
+        np.array: candidates, positions of the windows in window order.
+        np.array: shared, number of shared barcodes with each candidate.
+    '''
+    # Barcodes that were never seen in the windows cannot be shared
+    barcodes = barcodes[barcodes < inverted_index.shape[0]].astype(np.int64)
+    starts = inverted_index.indptr[barcodes]
+    lengths = inverted_index.indptr[barcodes+1] - starts
+
+    # Positions in inverted_index.indices of the windows of every barcode
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    candidates, shared = np.unique(inverted_index.indices[offsets], return_counts=True)
+    return candidates, shared
+
 def fillJunctions(backbone_graph, GEMlist, barcode_factor):
     '''Fill the Linkgraph junctions with short contigs.
 
@@ -26,7 +54,7 @@ def fillJunctions(backbone_graph, GEMlist, barcode_factor):
 
     Args:
         backbone_graph (Linkgraph)
-        GEMlist (dict)
+        GEMlist (barcode_collection.GEMlist)
         barcode_factor (int)
 
     Returns:
@@ -35,6 +63,11 @@ def fillJunctions(backbone_graph, GEMlist, barcode_factor):
 
     filled_junction_paths = []
 
+    # Only short contigs that share barcodes with a junction are compared to it
+    inverted_index = invertedIndex(GEMlist)
+    windows = GEMlist.keys()
+    sizes = GEMlist.sizes()
+
     # Iterate over paths and every junction in the path
     # Create a barcode comparison of the junction and all small contigs
     for idx, path in enumerate(backbone_graph.paths):
@@ -48,13 +81,11 @@ def fillJunctions(backbone_graph, GEMlist, barcode_factor):
         # Check outgoing edges from both start and target in full_graph.
         # If they are connected to both sides, add them to junction.
         for junction in path:
-            tigs, fractions = zip(*[(k, graph_building.compareGEMlibs(junction.barcodes, v)) \
-                                    for k,v in GEMlist.items()])
-            fracs = pd.Series(fractions, index = tigs)
-            fracs = fracs[fracs > 0]
+            candidates, shared = sharedCandidates(junction.barcodes, inverted_index)
 
-            if len(fracs > 0):
-                outliers = graph_building.calcOutliers(fracs, barcode_factor)
+            if len(candidates) > 0:
+                fractions = shared / (len(junction.barcodes) + sizes[candidates] - shared)
+                outliers = candidates[fractions > graph_building.outlierBound(fractions, barcode_factor)]
 
                 # Old outlier method:
                 #outliers = esd.getOutliers_QC(np.array(fractions),tigs,10)
@@ -63,7 +94,7 @@ def fillJunctions(backbone_graph, GEMlist, barcode_factor):
                 filled_path.append( graph_building.Junction(junction.start, \
                                                             junction.target, \
                                                             junction.connections + \
-                                                            [ o[:-1] for o in list(outliers.index)] ))
+                                                            [ windows[o][:-1] for o in outliers] ))
 
         filled_junction_paths.append(filled_path)
 
@@ -69,6 +69,45 @@ def formatGFA(linkgraph):
 
     return "".join(gfalist)
 
+class ScaffoldWriter:
+    '''Writes scaffolds to the fasta, correspondence and bed outputs as soon
+    as they are created, so that the whole assembly is never kept in memory.
+
+    Outputs:
+        <outfilename>.fasta: one line per scaffold sequence.
+        <outfilename>.correspondence.paths.txt: contigs in each scaffold.
+        <outfilename>.bed: merged features of each scaffold.
+    '''
+    def __init__(self, outfilename):
+        self.fasta = open(outfilename+".fasta", "w", encoding = "utf-8")
+        self.paths = open(outfilename+".correspondence.paths.txt", "w")
+        self.bed = open(outfilename+".bed", "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, name, sequence, included, bed_coords = []):
+        '''Write one scaffold to all outputs.
+
+        Args:
+            name (str): Scaffold name.
+            sequence (str): Scaffold sequence.
+            included (list): Names of the contigs in the scaffold.
+            bed_coords (list): Tuples of bed fields, excluding the name.
+        '''
+        self.fasta.write(">"+name+"\n")
+        self.fasta.write(sequence+"\n")
+        self.paths.write("{}\t{}\n".format(name, included))
+        for feature in bed_coords:
+            self.bed.write(name+"\t"+"\t".join(feature)+"\n")
+
+    def close(self):
+        self.fasta.close()
+        self.paths.close()
+        self.bed.close()
 
 # Deprecated
 def formatGFA_from_dict(dict1):
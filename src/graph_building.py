@@ -10,13 +10,27 @@ Copyright (c) 2020, Markus Hiltunen
 Licensed under the GPL3 license. See LICENSE file.
 """
 
+import contextlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+
 import mappy as mp
 import numpy as np
-import pandas as pd
+from scipy import sparse
 
 import nuclseqTools as nt
 import misc
 
+bytes_per_pair = 64 # Peak memory per compared window pair in tiledEdges
+min_block_size = 100 # Fewest windows per block in tiledEdges
+# Barcode occurrences in other windows to sample per window for the outlier
+# bounds in pairwise_lsh_comparisons. Windows with fewer than twice as many
+# get exact bounds.
+lsh_bound_samples = 500
+tile_pair_dtype = np.dtype([("row", np.int32), ("column", np.int32), ("shared", np.int32)])
+
 class Junction:
     '''This class describes an ARBitR "junction". This is a part of a Linkgraph path
     where there is a known start and target node and their orientations are known.
@@ -26,7 +40,7 @@ class Junction:
         self.start = start_node # Name of starting contig
         self.target = target_node # Name of target contig
         self.connections = connected # List of names of connected contigs
-        self.barcodes = barcodes # Set of barcodes
+        self.barcodes = barcodes # Sorted array of barcode IDs
 
     def __repr__(self):
         return "start: {0}, target: {1}, connections: {2}".format(self.start, self.target, self.connections)
@@ -75,15 +89,21 @@ class Linkgraph:
         self.edges = list(set(edges + [(a[1], a[0], a[2]) for a in edges]))
         self.paths = [] # Paths as lists of junctions
 
+        # Outgoing edges of every node, in the order of self.edges
+        # {node1: [(node2, weight), ...], ...}
+        self.adjacency = {}
+        for e in self.edges:
+            self.adjacency.setdefault(e[0], []).append((e[1], e[2]))
+
     def __str__(self):
         return "Linkgraph([nodes: {0},edges: {1}])".format(len(self.nodes), len(self.edges))
 
-    def addNode(node):
+    def addNode(self, node):
         '''Adds node to graph
         '''
         self.nodes.append(node)
 
-    def addEdge(edge):
+    def addEdge(self, edge):
         '''Adds edge to graph. Edges have the format (node1, node2, weight),
         where nodes are directed, i.e. node1 is contig1s and node2 contig2s.
         This means that (node1, node2, weight) is the same as (node2, node1, weight).
@@ -91,6 +111,8 @@ class Linkgraph:
         reverse_edge = (edge[1], edge[0], edge[2])
         self.edges.append(edge)
         self.edges.append(reverse_edge)
+        self.adjacency.setdefault(edge[0], []).append((edge[1], edge[2]))
+        self.adjacency.setdefault(edge[1], []).append((edge[0], edge[2]))
 
     def nodes():
         '''Returns all nodes in graph
@@ -118,21 +140,13 @@ class Linkgraph:
     def getEdges(self,node):
         '''Returns all outgoing edges from the given node.
         '''
-        outgoing_edges = []
-        for e in self.edges:
-            if e[0] == node:
-                outgoing_edges.append(e)
-        return outgoing_edges
+        return [(node, connected, weight) for connected, weight in self.adjacency.get(node, [])]
 
     def getNodes(self,node):
         '''Returns:
             List: connected_nodes, all connected nodes to the given node.
         '''
-        connected_nodes = []
-        for e in self.edges:
-            if e[0] == node:
-                connected_nodes.append(e[1])
-        return connected_nodes
+        return [connected for connected, weight in self.adjacency.get(node, [])]
 
     def extend(self,node):
         '''Returns a connected node to the given node, if there is
@@ -158,7 +172,7 @@ class Linkgraph:
             connected_node = connections[0]
             # Check the connected node for a single edge back to the original node
             if len(self.getNodes(connected_node)) == 1:
-                return Junction(node, connected_node, [], GEMs[node]|GEMs[connected_node])
+                return Junction(node, connected_node, [], np.union1d(GEMs[node], GEMs[connected_node]))
             # If the connected node has more than one outgoing edge
             elif len(self.getNodes(connected_node)) == 2:
                 # We can get a junction in two cases from here:
@@ -168,9 +182,9 @@ class Linkgraph:
                     # Here we need also check if there is any other node involved.
                     # If not, we cannot confidently orient node.
                     if self.getNodes(self.opposite(node)) == 1:
-                        return Junction(node, None, [connected_node[:-1]], GEMs[node]|GEMs[connected_node])
+                        return Junction(node, None, [connected_node[:-1]], np.union1d(GEMs[node], GEMs[connected_node]))
                     else:
-                        return Junction(node, connected_node, [], GEMs[node]|GEMs[connected_node])
+                        return Junction(node, connected_node, [], np.union1d(GEMs[node], GEMs[connected_node]))
                 # 2. one new connection leads elsewhere (third_node). Opposite end of connected_node
                 # also leads here, and has only one outgoing edge.
                 third_node = self.getNodes(connected_node)
@@ -180,7 +194,7 @@ class Linkgraph:
                 opp_outg = self.getNodes(self.opposite(connected_node))
                 # Test for 2.
                 if len(opp_outg) == 1 and opp_outg[0] == third_node:
-                    return Junction(node, connected_node, [], GEMs[node]|GEMs[connected_node])
+                    return Junction(node, connected_node, [], np.union1d(GEMs[node], GEMs[connected_node]))
 
         # Check alternatives with two outgoing edges
         elif len(connections) == 2:
@@ -206,17 +220,17 @@ class Linkgraph:
                         conn1_nodes.remove(node)
                         third_node_connections = self.getNodes(conn1_nodes[0])
                         if len(third_node_connections) == 2:
-                            return Junction(node, conn1_nodes[0], [middle_ctg], GEMs[node]|GEMs[conn1_nodes[0]])
+                            return Junction(node, conn1_nodes[0], [middle_ctg], np.union1d(GEMs[node], GEMs[conn1_nodes[0]]))
 
                 # Connections are uneven, but a path may still be found
                 elif len(self.getNodes(connections[0])) == 1 \
                 and (len(self.getNodes(connections[1])) > 1 \
                 and node in set(self.getNodes(connections[1]))):
-                    return Junction(node, connections[0], [], GEMs[node]|GEMs[connections[0]])
+                    return Junction(node, connections[0], [], np.union1d(GEMs[node], GEMs[connections[0]]))
                 elif len(self.getNodes(connections[1])) == 1 \
                 and (len(self.getNodes(connections[0])) > 1 \
                 and node in self.getNodes(connections[0])):
-                    return Junction(node, connections[1], [], GEMs[node]|GEMs[connections[1]])
+                    return Junction(node, connections[1], [], np.union1d(GEMs[node], GEMs[connections[1]]))
 
             # One connection may be back to a formerly connected node in the path
             elif len(self.getNodes(self.opposite(node))) == 1 and \
@@ -224,7 +238,7 @@ class Linkgraph:
                 # Remove this node from the connections
                 connections.remove(self.getNodes(self.opposite(node))[0])
                 if len(self.getNodes(connections[0])) == 1:
-                    return Junction(node, connections[0], [], GEMs[node]|GEMs[connections[0]])
+                    return Junction(node, connections[0], [], np.union1d(GEMs[node], GEMs[connections[0]]))
 
         # A third possibility exists: there are 3
         # connections, out of which two are to the same contig (middle).
@@ -265,7 +279,7 @@ class Linkgraph:
                 and node in target_node_conn \
                 and middle_ctg_node1 in target_node_conn \
                 and middle_ctg_node2 in target_node_conn:
-                    return Junction(node, target_node, [middle_ctg], GEMs[node]|GEMs[target_node])
+                    return Junction(node, target_node, [middle_ctg], np.union1d(GEMs[node], GEMs[target_node]))
 
         return None
 
@@ -311,7 +325,7 @@ class Linkgraph:
         ext = self.extend(node) # Look for a possible extension
         while ext != None and ext.target and ext.target[:-1] not in visited:
             visited.add(node[:-1])
-            path.insert(0, Junction(ext.target,ext.start,ext.connections, GEMs[ext.target]|GEMs[ext.start]))
+            path.insert(0, Junction(ext.target,ext.start,ext.connections, np.union1d(GEMs[ext.target], GEMs[ext.start])))
             node = self.opposite(ext.target)
             ext = self.extend(node)
 
@@ -324,175 +338,700 @@ class Linkgraph:
         '''
         Append all unambiguous paths in the graph.
         '''
-        visited_nodes = []
+        visited_nodes = set()
         for n in self.nodes:
             if n not in visited_nodes:
                 path = self.findPath(n)
                 if path != []:
                     self.paths.append(path)
-                    # Append visisted nodes
+                    # Add visisted nodes
                     for junc in path:
-                        visited_nodes.append(junc.start)
-                        visited_nodes.append(junc.target)
+                        visited_nodes.add(junc.start)
+                        visited_nodes.add(junc.target)
                         for conn in junc.connections:
-                            visited_nodes.append(conn+"s")
-                            visited_nodes.append(conn+"e")
+                            visited_nodes.add(conn+"s")
+                            visited_nodes.add(conn+"e")
 
-                    # Also append starting and ending points
+                    # Also add starting and ending points
                     if path[0].start != None:
-                        visited_nodes.append(self.opposite(path[0].start))
+                        visited_nodes.add(self.opposite(path[0].start))
                     if path[-1].target != None:
-                        visited_nodes.append(self.opposite(path[-1].target))
+                        visited_nodes.add(self.opposite(path[-1].target))
 
 def makeNodes(contig_list):
     return [a+"s" for a in contig_list] + [a+"e" for a in contig_list]
 
-def compareGEMlibs(lib1,lib2):
+def windowContigs(windows):
+    '''Returns an integer ID of the contig of every window, for comparing
+    the contigs of windows in arrays.
     '''
-    Compares two sets of barcodes, collects all shared ones and
-    counts them. Returns fraction of shared barcodes.
+    _, contigs = np.unique([region[:-1] for region in windows], return_inverse=True)
+    return contigs.reshape(-1)
+
+def incidenceMatrix(GEMlist):
     '''
-    # Find shared ones. Numpy arrays were tried here - way slower
-    shared = lib1.intersection(lib2)
-    totallength = len(lib1|lib2) # Total number of barcodes
+    Returns the window x barcode incidence matrix of GEMlist, built directly
+    from its compressed sparse row layout.
 
-    # Find the fraction of shared barcodes, avoid division by 0
-    return len(shared) / totallength if totallength != 0 else 0
+    Returns:
+        scipy.sparse.csr_matrix
+    '''
+    n_barcodes = int(GEMlist.indices.max()) + 1 if len(GEMlist.indices) > 0 else 0
+    data = np.ones(len(GEMlist.indices), dtype=np.int32)
+    return sparse.csr_matrix(   (data, GEMlist.indices, GEMlist.indptr), \
+                                shape=(len(GEMlist), n_barcodes))
 
 def pairwise_comparisons(GEMlist):
     '''
     Performs all pairwise comparisons between windows in GEMlist.
 
+    Description:
+        The numbers of shared barcodes between all windows are found with a
+        single sparse product of the incidence matrix with its transpose.
+        The fractions of shared barcodes then follow from the window sizes.
+        Only pairs of windows that share barcodes are stored.
+
     Returns:
-        GEMcomparison (pd.DataFrame)
+        GEMcomparison (scipy.sparse.csr_matrix): fractions of shared barcodes,
+            rows and columns in the window order of GEMlist.
     '''
-    # Compare the barcodes in every region to all other regions
-    GEMcomparison = pd.DataFrame(np.zeros(( len(GEMlist), len(GEMlist) )), \
-                                index=GEMlist.keys())
-    GEMcomparison.columns = GEMcomparison.index
+    misc.printstatus("[ BARCODE COMPARISON ]\tComparing {} windows.".format(len(GEMlist)))
+    incidence = incidenceMatrix(GEMlist)
+    shared = (incidence @ incidence.T).tocsr()
+    shared.sort_indices()
+
+    # Fraction of shared barcodes, i.e. shared / (size1 + size2 - shared)
+    sizes = GEMlist.sizes()
+    rows = np.repeat(np.arange(shared.shape[0]), np.diff(shared.indptr))
+    totallength = sizes[rows] + sizes[shared.indices] - shared.data
+    fractions = shared.data / totallength
+
+    GEMcomparison = sparse.csr_matrix(  (fractions, shared.indices, shared.indptr), \
+                                        shape=shared.shape)
+    misc.printstatus("[ BARCODE COMPARISON ]\tFound {} window pairs with shared barcodes.".format( \
+                    GEMcomparison.nnz))
 
-    # Iterate over rows in GEMcomparison
-    # Index to keep track of position so we can skip calculating some fractions
-    # twice
-    idx = 0
-    for idx, region1 in enumerate(GEMcomparison.index):
-        lib1 = GEMlist[region1]
-
-        # Report progress every 20 windows
-        if idx in range(0,100000000,20):
-            misc.printstatusFlush("[ BARCODE COMPARISON ]\t" + misc.reportProgress(idx+1, len(GEMlist)))
+    return GEMcomparison
 
-        fractions = [ compareGEMlibs(lib1,GEMlist[col]) for col in GEMcomparison.columns[idx:] ]
+def lshCandidates(sketches, n_bands):
+    '''
+    Finds pairs of windows that are likely to share many barcodes, by
+    locality-sensitive hashing of their MinHash sketches.
 
-        GEMcomparison.loc[region1][idx:] = fractions # Update row values from idx
-        GEMcomparison[region1][idx:] = fractions # Also update column values from idx
+    Description:
+        The sketches are split into n_bands bands of consecutive hashes,
+        and windows whose sketches are identical in at least one band
+        become candidate pairs. With r hashes per band, a pair sharing the
+        fraction J of their barcodes is found with probability
+        1 - (1 - J^r)^n_bands. Hashes left over after the last full band are
+        not used.
 
-    misc.printstatus("[ BARCODE COMPARISON ]\t" + misc.reportProgress(idx+1, len(GEMlist)))
+    Args:
+        sketches (np.array): n_windows x n_hashes MinHash sketches, from
+            barcode_collection.GEMlist.minhash.
+        n_bands (int): Number of bands.
+    Returns:
+        np.array: first window of every candidate pair.
+        np.array: second window of every candidate pair, larger than the first.
+    '''
+    n_windows, n_hashes = sketches.shape
+    band_size = n_hashes // n_bands
+    rng = np.random.default_rng(0)
+    multipliers = rng.integers(1, 2**63, size=band_size, dtype=np.uint64) | np.uint64(1)
+
+    firsts, seconds = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for band in range(n_bands):
+        # One key per window and band, wrapping around at 2**64
+        band_hashes = sketches[:, band * band_size:(band + 1) * band_size].astype(np.uint64)
+        keys = (band_hashes * multipliers).sum(axis=1, dtype=np.uint64)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+
+        # Pair every window with the following windows in the same bucket
+        offset = 1
+        while offset < n_windows:
+            same = sorted_keys[offset:] == sorted_keys[:-offset]
+            if not same.any():
+                break
+            firsts.append(order[:-offset][same])
+            seconds.append(order[offset:][same])
+            offset += 1
+
+    firsts, seconds = np.concatenate(firsts), np.concatenate(seconds)
+    return uniquePairs(np.minimum(firsts, seconds), np.maximum(firsts, seconds), n_windows)
+
+def uniquePairs(firsts, seconds, n_windows):
+    '''Returns the unique pairs of windows in firsts and seconds, in
+    order of the first and then the second window.
+    '''
+    pairs = np.unique(firsts.astype(np.int64) * n_windows + seconds)
+    return pairs // n_windows, pairs % n_windows
+
+def sharedBarcodes(incidence, firsts, seconds, block_size = 1000):
+    '''Returns the number of barcodes shared by the windows of every pair,
+    from the window x barcode incidence matrix.
+
+    Description:
+        The pairs are compared in blocks of block_size first windows, with
+        one sparse product of the block against the second windows of its
+        pairs. This costs at most the comparison of the block against all
+        windows, however many pairs the block has.
+    '''
+    shared = np.zeros(len(firsts), dtype=np.int64)
+    order = np.argsort(firsts, kind="stable")
+    sorted_firsts = firsts[order]
+    for block_start in range(0, incidence.shape[0], block_size):
+        pair_start, pair_end = np.searchsorted(sorted_firsts, [block_start, block_start + block_size])
+        if pair_start == pair_end:
+            continue
+        pairs = order[pair_start:pair_end]
+        columns, pair_columns = np.unique(seconds[pairs], return_inverse=True)
+        block = (incidence[block_start:block_start + block_size] @ incidence[columns].T).tocsr()
+        block.sort_indices()
+
+        # Look up the pairs in the block by row and column
+        keys = np.repeat(np.arange(block.shape[0], dtype=np.int64), np.diff(block.indptr)) \
+                * len(columns) + block.indices
+        pair_keys = (firsts[pairs] - block_start) * len(columns) + pair_columns.reshape(-1)
+        found = np.minimum(np.searchsorted(keys, pair_keys), len(keys) - 1)
+        if len(keys) > 0:
+            shared[pairs] = np.where(keys[found] == pair_keys, block.data[found], 0)
+    return shared
+
+def pairwise_lsh_comparisons(GEMlist, sketches, n_bands, barcode_factor, block_size = 1000):
+    '''
+    Compares the windows in GEMlist that are likely to share barcodes,
+    instead of keeping the fractions of all pairs of windows.
+
+    Description:
+        Candidate pairs are found by lshCandidates, and only their fractions
+        of shared barcodes are kept. The outlier bound of every window is
+        taken from a sample of all the windows it shares barcodes with, by
+        sampledOutlierBounds, so it does not depend on which pairs LSH
+        finds. Edges between windows that LSH does not pair are missed, and
+        windows with estimated bounds may gain or lose edges near the bound.
+        Memory is O(candidates) for the result and O(block_size *
+        lsh_bound_samples) for the sample being compared.
 
-    return GEMcomparison
+    Args:
+        GEMlist (barcode_collection.GEMlist): Windows to compare.
+        sketches (np.array): MinHash sketches of the windows in GEMlist.
+        n_bands (int): Number of LSH bands.
+        barcode_factor (int): Factor for calculating outliers.
+        block_size (int): Number of windows to compare at a time for the
+            outlier bounds.
+    Returns:
+        GEMcomparison (scipy.sparse.csr_matrix): fractions of shared barcodes
+            of the candidate pairs, rows and columns in the window order of
+            GEMlist.
+        np.array: outlier bound of every window, nan if it shares no
+            barcodes with other contigs.
+    '''
+    n_windows = len(GEMlist)
+    misc.printstatus("[ BARCODE COMPARISON ]\tComparing {} windows by MinHash.".format(n_windows))
+    firsts, seconds = lshCandidates(sketches, n_bands)
+    different = firsts != seconds
+    firsts, seconds = firsts[different], seconds[different]
+    misc.printstatus("[ BARCODE COMPARISON ]\tFound {} candidate pairs.".format(len(firsts)))
+
+    # Fraction of shared barcodes, i.e. shared / (size1 + size2 - shared)
+    incidence = incidenceMatrix(GEMlist)
+    shared = sharedBarcodes(incidence, firsts, seconds)
+    sizes = GEMlist.sizes()
+    has_shared = shared > 0
+    firsts, seconds, shared = firsts[has_shared], seconds[has_shared], shared[has_shared]
+    fractions = shared / (sizes[firsts] + sizes[seconds] - shared)
+
+    # Both directions of every pair, as in the all-against-all comparison
+    GEMcomparison = sparse.csr_matrix(  (np.concatenate([fractions, fractions]), \
+                                        (np.concatenate([firsts, seconds]), np.concatenate([seconds, firsts]))), \
+                                        shape=(n_windows, n_windows))
+    GEMcomparison.sort_indices()
+    misc.printstatus("[ BARCODE COMPARISON ]\tFound {} window pairs with shared barcodes.".format( \
+                    GEMcomparison.nnz))
+
+    misc.printstatus("[ BARCODE COMPARISON ]\tEstimating outlier bounds of {} windows.".format(n_windows))
+    bounds = sampledOutlierBounds(  incidence, sizes, windowContigs(GEMlist.keys()), barcode_factor, \
+                                    lsh_bound_samples, block_size)
+
+    return GEMcomparison, bounds
+
+def sampledOutlierBounds(incidence, sizes, contigs, barcode_factor, n_samples, block_size = 1000, seed = 0):
+    '''Estimates the outlier bound of every window from a sample of the
+    windows it shares barcodes with.
+
+    Description:
+        Every window gets a random level, and the windows of level k or
+        higher are a random fraction 2^-k of all windows. A window whose
+        barcodes occur p times in other windows, or in all other windows
+        if fewer, is compared only with the windows of level k or higher,
+        for the largest k with p / 2^k of at least n_samples. Its bound is
+        the outlier bound of the fractions to windows of other contigs in
+        that sample. Windows with p below 2 * n_samples are compared with
+        all windows, so their bounds are exact. Comparing costs
+        O(n * n_samples), instead of O(n * p) for the exact bounds.
 
-def calcOutliers(frac_series, factor = 3):
-    '''Calculate the outliers of fracs. Default: major outlier.
-    Factors > 10 usually give the best results.
+    Args:
+        incidence (scipy.sparse.csr_matrix): window x barcode incidence matrix.
+        sizes (np.array): Number of barcodes in every window.
+        contigs (np.array): Contig of every window, from windowContigs.
+        barcode_factor (int): Factor for calculating outliers.
+        n_samples (int): Least expected number of sampled barcode
+            occurrences per window.
+        block_size (int): Number of windows to compare at a time.
+        seed (int): Seed of the window levels.
+    Returns:
+        np.array: outlier bound of every window, nan if no sampled window
+            of another contig shares barcodes with it.
+    '''
+    n_windows = incidence.shape[0]
+    bounds = np.full(n_windows, np.nan)
+    if n_windows == 0:
+        return bounds
+
+    # Occurrences of the barcodes of every window in other windows
+    occurrences = np.bincount(incidence.indices, minlength=incidence.shape[1])
+    partners = np.minimum(incidence @ (occurrences - 1), n_windows - 1)
+    levels = np.random.default_rng(seed).geometric(0.5, size=n_windows) - 1
+    row_levels = np.floor(np.log2(np.maximum(partners, 1) / n_samples))
+    row_levels = np.maximum(row_levels, 0).astype(np.int64)
+
+    n_done = 0
+    for level in np.unique(row_levels):
+        windows = np.flatnonzero(row_levels == level)
+        sampled = np.flatnonzero(levels >= level)
+        sampled_T = incidence[sampled].T.tocsr()
+        for block_start in range(0, len(windows), block_size):
+            misc.printstatusFlush("[ BARCODE COMPARISON ]\t" + misc.reportProgress(n_done, n_windows))
+            block = windows[block_start:block_start + block_size]
+            shared = (incidence[block] @ sampled_T).tocsr()
+            rows = np.repeat(np.arange(len(block)), np.diff(shared.indptr))
+            columns = sampled[shared.indices]
+
+            # Fractions to windows of other contigs, as in makeEdges
+            keep = contigs[block[rows]] != contigs[columns]
+            rows, columns, shared_counts = rows[keep], columns[keep], shared.data[keep]
+            fractions = shared_counts / (sizes[block[rows]] + sizes[columns] - shared_counts)
+            bounds[block] = rowOutlierBounds(rows, fractions, len(block), barcode_factor)
+            n_done += len(block)
+    misc.printstatus("[ BARCODE COMPARISON ]\t" + misc.reportProgress(n_windows, n_windows))
+
+    return bounds
+
+def outlierBound(fractions, factor = 3):
+    '''Calculate the upper bound for outliers of fractions. Default: major outlier.
     '''
     # Calculate quartiles and interquartile range
-    quartiles = np.quantile(frac_series, [0.25,0.75])
+    quartiles = np.quantile(fractions, [0.25,0.75])
     IQR = quartiles[1] - quartiles[0]
-    upper_bound = quartiles[1] + (factor * IQR)
-    return frac_series[frac_series > upper_bound]
+    return quartiles[1] + (factor * IQR)
+
+def rowOrder(rows, values):
+    '''Returns the order that sorts values by row, and within each row by
+    value.
+    '''
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Offsetting the values by their row keeps the rows apart in a single
+    # sort, which is much faster than lexsort. Rounding of the offset values
+    # can only swap nearly equal values within a row, in which case lexsort
+    # is used instead.
+    span = values.max() - values.min() + 1
+    order = np.argsort(rows * span + (values - values.min()))
+    sorted_values, sorted_rows = values[order], rows[order]
+    if np.any( (sorted_values[1:] < sorted_values[:-1]) \
+                & (sorted_rows[1:] == sorted_rows[:-1]) ):
+        order = np.lexsort((values, rows))
+    return order
+
+def rowQuantiles(rows, values, n_rows, quantiles):
+    '''Quantiles of the values of every row, by linear interpolation as
+    in np.quantile.
+
+    Args:
+        rows (np.array): Row of each value.
+        values (np.array): Values to calculate the quantiles of.
+        n_rows (int): Number of rows.
+        quantiles (list): Quantiles to calculate, between 0 and 1.
+    Returns:
+        np.array: n_rows x len(quantiles), nan for rows without values.
+    '''
+    sorted_values = values[rowOrder(rows, values)]
+    counts = np.bincount(rows, minlength=n_rows)
+    row_starts = np.cumsum(counts) - counts
+    has_values = counts > 0
+
+    result = np.full((n_rows, len(quantiles)), np.nan)
+    for qidx, q in enumerate(quantiles):
+        # Same interpolation between the closest ranks as np.quantile
+        virtual_index = (counts[has_values] - 1) * q
+        previous = np.floor(virtual_index).astype(np.int64)
+        following = np.minimum(previous + 1, counts[has_values] - 1)
+        gamma = virtual_index - previous
+        a = sorted_values[row_starts[has_values] + previous]
+        b = sorted_values[row_starts[has_values] + following]
+        diff_b_a = b - a
+        result[has_values, qidx] = np.where(gamma >= 0.5, \
+                                            b - diff_b_a * (1 - gamma), \
+                                            a + diff_b_a * gamma)
+    return result
+
+def rowOutlierBounds(rows, values, n_rows, factor = 3):
+    '''Upper bound for outliers of the values of every row, as
+    outlierBound. Rows without values get nan.
+    '''
+    quartiles = rowQuantiles(rows, values, n_rows, [0.25,0.75])
+    IQR = quartiles[:,1] - quartiles[:,0]
+    return quartiles[:,1] + (factor * IQR)
+
+def rowTopK(rows, values, n_rows, k):
+    '''Returns a mask of the k largest values of every row.
+    '''
+    order = rowOrder(rows, values)
+    row_ends = np.cumsum(np.bincount(rows, minlength=n_rows))
+    # Rank of every sorted value from the end of its row, the largest is 1
+    from_end = row_ends[rows[order]] - np.arange(len(order))
+    keep = np.zeros(len(values), dtype=bool)
+    keep[order[from_end <= k]] = True
+    return keep
+
+def blockFractions(incidence, sizes, contigs, block_size = 1000):
+    '''Compares blocks of block_size windows against all windows.
+
+    Args:
+        incidence (scipy.sparse.csr_matrix): window x barcode incidence matrix.
+        sizes (np.array): Number of barcodes in every window.
+        contigs (np.array): Contig of every window, from windowContigs.
+        block_size (int): Number of windows to compare at a time.
+    Yields:
+        int: first window of the block.
+        int: end of the block, exclusive.
+        int: number of window pairs of the block with shared barcodes.
+        np.array: first window of every pair with windows of other contigs.
+        np.array: second window of every pair.
+        np.array: fraction of shared barcodes of every pair.
+    '''
+    n_windows = incidence.shape[0]
+    incidence_T = incidence.T.tocsr()
+    for block_start in range(0, n_windows, block_size):
+        block_end = min(block_start + block_size, n_windows)
+        shared = (incidence[block_start:block_end] @ incidence_T).tocsr()
+        rows = np.repeat(np.arange(block_start, block_end), np.diff(shared.indptr))
+        columns = shared.indices
+
+        # Fractions to windows of other contigs, as in makeEdges
+        keep = contigs[rows] != contigs[columns]
+        rows, columns, shared_counts = rows[keep], columns[keep], shared.data[keep]
+        fractions = shared_counts / (sizes[rows] + sizes[columns] - shared_counts)
+        yield block_start, block_end, shared.nnz, rows, columns, fractions
+
+def pairwise_top_comparisons(GEMlist, k, barcode_factor, block_size = 1000):
+    '''
+    Compares all windows in GEMlist, but only keeps the k windows of other
+    contigs that every window shares the largest fractions of barcodes with.
+
+    Description:
+        The windows are compared in blocks of block_size rows against all
+        windows, as in pairwise_comparisons. Each block holds complete rows,
+        so the outlier bound of every row is calculated exactly from all
+        its fractions before the block is reduced to the top k fractions
+        of every row. Memory is O(n * k) for the result and
+        O(block_size * n) for the block being compared.
+
+    Args:
+        GEMlist (barcode_collection.GEMlist): Windows to compare.
+        k (int): Number of fractions to keep per window.
+        barcode_factor (int): Factor for calculating outliers.
+        block_size (int): Number of windows to compare at a time.
+    Returns:
+        GEMcomparison (scipy.sparse.csr_matrix): the kept fractions of
+            shared barcodes, rows and columns in the window order of GEMlist.
+        np.array: outlier bound of every window, nan if it shares no
+            barcodes with other contigs.
+    '''
+    misc.printstatus("[ BARCODE COMPARISON ]\tComparing {0} windows, keeping {1} per window.".format( \
+                    len(GEMlist), k))
+    n_windows = len(GEMlist)
+    bounds = np.full(n_windows, np.nan)
+    kept_rows, kept_columns = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int32)]
+    kept_fractions = [np.zeros(0)]
+    n_pairs, n_truncated = 0, 0
+    for block_start, block_end, n_shared, rows, columns, fractions \
+        in blockFractions(incidenceMatrix(GEMlist), GEMlist.sizes(), windowContigs(GEMlist.keys()), \
+                            block_size):
+        misc.printstatusFlush("[ BARCODE COMPARISON ]\t" + misc.reportProgress(block_start, n_windows))
+        n_pairs += n_shared
+        bounds[block_start:block_end] = rowOutlierBounds(   rows - block_start, fractions, \
+                                                            block_end - block_start, barcode_factor)
+        outliers = np.bincount(rows[fractions > bounds[rows]] - block_start, \
+                                minlength=block_end - block_start)
+        n_truncated += np.count_nonzero(outliers > k)
+
+        top = rowTopK(rows - block_start, fractions, block_end - block_start, k)
+        kept_rows.append(rows[top])
+        kept_columns.append(columns[top])
+        kept_fractions.append(fractions[top])
+
+    if n_windows > 0:
+        misc.printstatus("[ BARCODE COMPARISON ]\t" + misc.reportProgress(n_windows, n_windows))
+    misc.printstatus("[ BARCODE COMPARISON ]\tFound {} window pairs with shared barcodes.".format(n_pairs))
+    if n_truncated > 0:
+        misc.printstatus("[ BARCODE COMPARISON ]\t{0} windows have more than {1} outliers, ".format( \
+                        n_truncated, k) + "only the {} largest are kept.".format(k))
+
+    GEMcomparison = sparse.csr_matrix(  (np.concatenate(kept_fractions), \
+                                        (np.concatenate(kept_rows), np.concatenate(kept_columns))), \
+                                        shape=(n_windows, n_windows))
+    GEMcomparison.sort_indices()
+    return GEMcomparison, bounds
+
+def tileBlockSize(n_windows, memory_budget, n_proc):
+    '''Returns the number of windows per block that keeps the tiled
+    comparison within memory_budget bytes.
+
+    Description:
+        The edges of a block are called from up to block_size * n_windows
+        pairs, and each of the n_proc processes compares tiles of up to
+        block_size * block_size pairs. Both are sized to the budget at
+        bytes_per_pair per pair, i.e. as if all windows shared barcodes.
+        Blocks have at least min_block_size windows, since the number of
+        tiles grows with the square of the number of blocks.
+    '''
+    pairs = memory_budget / bytes_per_pair
+    block_size = min(pairs / max(n_windows, 1), (pairs / n_proc) ** 0.5)
+    return max(1, min(n_windows, max(min_block_size, int(block_size))))
+
+def initTileWorker(incidence, block_size, directory):
+    '''Sets the incidence matrix, block size and spill directory in each
+    tile comparison process.
+    '''
+    global tile_incidence
+    global tile_block_size
+    global tile_directory
+    tile_incidence = incidence
+    tile_block_size = block_size
+    tile_directory = directory
+
+def compareTile(tile):
+    '''Counts the barcodes shared by the windows of two blocks, and spills
+    the pairs that share barcodes to a file.
+
+    Args:
+        tile (tuple): Indexes of the two blocks.
+    Returns:
+        tuple: the tile.
+        str: path of the .npy file with the window pairs and their numbers
+            of shared barcodes, in tile_pair_dtype.
+    '''
+    first, second = [ slice(block * tile_block_size, (block + 1) * tile_block_size) \
+                        for block in tile]
+    shared = (tile_incidence[first] @ tile_incidence[second].T).tocoo()
+    pairs = np.empty(shared.nnz, dtype=tile_pair_dtype)
+    pairs["row"] = shared.row + first.start
+    pairs["column"] = shared.col + second.start
+    pairs["shared"] = shared.data
+
+    path = os.path.join(tile_directory, "tile.{0}.{1}.npy".format(*tile))
+    np.save(path, pairs)
+    return tile, path
+
+def tiledEdges(GEMlist, barcode_factor, min_barcode_fraction, memory_budget, n_proc = 1, \
+                directory = None):
+    '''
+    Create edges from all pairwise comparisons of windows in GEMlist,
+    without keeping all comparisons in memory.
+
+    Description:
+        The windows are split into blocks, sized by tileBlockSize. The
+        numbers of barcodes shared by the windows of every pair of blocks,
+        a tile, are computed in a pool of processes and spilled to files.
+        Only tiles on or above the diagonal are computed, the others are
+        their transposes. The edges of each block are then called from its
+        tiles, read back as memory maps. The edges are the same, and in the
+        same order, as from makeEdges on the full comparison.
+
+    Args:
+        GEMlist (barcode_collection.GEMlist): Windows to compare.
+        barcode_factor (int): Factor for calculating outliers.
+        min_barcode_fraction (float): Minimum fraction of shared barcodes to create
+            an edge in the linkgraph.
+        memory_budget (float): Approximate memory to use, in bytes.
+        n_proc (int): Number of processes to compare tiles with.
+        directory (str): Where to create the directory for the tile files.
+            Defaults to the system temporary directory.
+    Returns:
+        list: Edges inferred from the fractions of shared barcodes.
+    '''
+    windows = list(GEMlist.keys())
+    n_windows = len(windows)
+    block_size = tileBlockSize(n_windows, memory_budget, n_proc)
+    n_blocks = (n_windows + block_size - 1) // block_size
+    tiles = [(first, second) for first in range(n_blocks) for second in range(first, n_blocks)]
+    misc.printstatus("[ BARCODE COMPARISON ]\tComparing {0} windows in {1} tiles of {2} windows.".format( \
+                    n_windows, len(tiles), block_size))
+
+    incidence = incidenceMatrix(GEMlist)
+    sizes = GEMlist.sizes()
+    contigs = windowContigs(windows)
+    tile_directory = tempfile.mkdtemp(prefix="tiles.", dir=directory)
+    try:
+        tile_paths = {}
+        if n_proc == 1:
+            initTileWorker(incidence, block_size, tile_directory)
+        with multiprocessing.Pool(n_proc, initializer=initTileWorker, \
+                                initargs=(incidence, block_size, tile_directory)) \
+                if n_proc > 1 else contextlib.nullcontext() as pool:
+            results = pool.imap_unordered(compareTile, tiles) if n_proc > 1 else map(compareTile, tiles)
+            for idx, (tile, path) in enumerate(results):
+                misc.printstatusFlush("[ BARCODE COMPARISON ]\t" + misc.reportProgress(idx+1, len(tiles)))
+                tile_paths[tile] = path
+        if tiles:
+            misc.printstatus("[ BARCODE COMPARISON ]\t" + misc.reportProgress(len(tiles), len(tiles)))
+
+        misc.printstatus("Number of windows: "+str(n_windows))
+        edges = []
+        for block in range(n_blocks):
+            misc.printstatusFlush("[ BARCODE LINKING ]\t" + misc.reportProgress(block, n_blocks))
+            rows, columns, shared = [], [], []
+            for other in range(n_blocks):
+                # Tiles below the diagonal are the transposes of those above
+                pairs = np.load(tile_paths[(min(block, other), max(block, other))], mmap_mode="r")
+                first, second = ("row", "column") if block <= other else ("column", "row")
+                rows.append(np.asarray(pairs[first], dtype=np.int64))
+                columns.append(np.asarray(pairs[second], dtype=np.int64))
+                shared.append(np.asarray(pairs["shared"], dtype=np.int64))
+                del pairs
+            rows, columns, shared = np.concatenate(rows), np.concatenate(columns), np.concatenate(shared)
+
+            # Pairs in the order of the full comparison matrix
+            order = np.argsort(rows * n_windows + columns)
+            rows, columns, shared = rows[order], columns[order], shared[order]
+            fractions = shared / (sizes[rows] + sizes[columns] - shared)
+            edges.extend(outlierEdges(  rows, columns, fractions, windows, contigs, \
+                                        barcode_factor, min_barcode_fraction))
+        if n_blocks > 0:
+            misc.printstatus("[ BARCODE LINKING ]\t" + misc.reportProgress(n_blocks, n_blocks))
+    finally:
+        shutil.rmtree(tile_directory)
+
+    misc.printstatus("[ BARCODE LINKING ]\tFound {} edges.".format(len(edges)))
+    return edges
+
+def writeFractions(GEMcomparison, windows, outfilename):
+    '''Write the all-against-all fractions of shared barcodes, with the
+    window names, to a compressed .npz file. Only the non-zero fractions
+    are stored. Read back with loadFractions.
+    '''
+    np.savez_compressed(outfilename, \
+                        data = GEMcomparison.data, \
+                        indices = GEMcomparison.indices, \
+                        indptr = GEMcomparison.indptr, \
+                        shape = np.array(GEMcomparison.shape), \
+                        windows = np.array(list(windows), dtype=str))
 
-def makeEdges(GEMcomparison, barcode_factor, min_barcode_fraction):
-    '''Create edges from the GEMcomparison dataframe.
+def loadFractions(filename):
+    '''Read fractions of shared barcodes written by writeFractions.
+
+    Returns:
+        scipy.sparse.csr_matrix: fractions of shared barcodes.
+        list: window names of the rows and columns.
+    '''
+    with np.load(filename) as npz:
+        GEMcomparison = sparse.csr_matrix(  (npz["data"], npz["indices"], npz["indptr"]), \
+                                            shape=tuple(npz["shape"]))
+        windows = npz["windows"].tolist()
+    return GEMcomparison, windows
+
+def makeEdges(GEMcomparison, windows, barcode_factor, min_barcode_fraction, bounds = None):
+    '''Create edges from the GEMcomparison matrix.
+
+    Description:
+        All rows are handled at once on the non-zero entries of
+        GEMcomparison. Comparisons to the same contig are removed, the
+        outlier bound of every row is calculated from the remaining
+        fractions, and the fractions above both the bound and
+        min_barcode_fraction become edges.
 
     Args:
-        GEMcomparison (pd.DataFrame): All-against-all comparison of the
-            windows' barcodes.
+        GEMcomparison (scipy.sparse.csr_matrix): All-against-all comparison
+            of the windows' barcodes.
+        windows (list): Window names of the rows and columns in GEMcomparison.
         barcode_factor (int): Factor for calculating outliers.
         min_barcode_fraction (float): Minimum fraction of shared barcodes to create
             an edge in the linkgraph.
+        bounds (np.array): Outlier bound of every row. If not given, it is
+            calculated from the fractions in GEMcomparison.
     Returns:
         list: Edges inferred from the fractions of shared barcodes.
     '''
 
-    misc.printstatus("Number of windows: "+str(len(GEMcomparison.keys())))
-    edges = []
-
-    with open("fractions.txt", "w") as out:
-        for f in GEMcomparison.index:
-            out.write("{}\t".format(f))
-        out.write("\n")
-
-        # Iterate over rows in GEMcomparison
-        for idx, (region, fractions) in enumerate(GEMcomparison.iterrows()):
-            contig = region[:-1]
-            window = region[-1]
-
-            out.write(region+"\t")
-            for f in fractions:
-                out.write("{}\t".format(f))
-            out.write("\n")
-
-            # Report progress every 100 windows
-            if idx in range(0,10000000,100):
-                misc.printstatusFlush("[ BARCODE LINKING ]\t" + misc.reportProgress(idx, len(GEMcomparison)))
-
-            '''
-            # Calculate outliers from the comparisons of window k to all other windows
-            # outliers is a dict where each key is a connected window to region,
-            # and value is the fraction of shared barcodes between region and window
-            outliers = esd.getOutliers_QC(np.array(fractions),fractions.index,10)
-            # Get rid of edges to the same contig.
-            outliers = { k:v for k,v in outliers.items() if k[:-1] != region[:-1] \
-                        and v > np.mean(fractions)}
-            outliers = pd.Series(outliers)
-            # If there are any outliers, i.e. edges to create, add them to the edges
-            # list. Don't add edges for lower outliers (fractions < mean(fractions))
-            # or where the fraction is less than
-            # min_barcode_fraction (-f) and edges back to the same contig
-            if len(outliers.keys()) > 1:
-                sorted_outliers = outliers.sort_values(ascending = False)
-                if sorted_outliers[0] > sorted_outliers[1] * barcode_factor:
-                    outliers = outliers[outliers == sorted_outliers[0]]
-
-            new_edges = [(region, connected_window, fraction) \
-                        for connected_window, fraction in outliers.items()]
-
-            # Let's try only writing single edges
-            #if len(new_edges) == 1:
-            for idx, mo in outliers.iteritems():
-                edges.append( (region, idx, mo ) )
-
-            '''
-
-            # Ignore comparisons to the same contig and calculate outliers
-            # In low coverage datasets the amount of 0's might cloud any
-            # actual signal
-            fractions = fractions.drop(labels = [contig+"s", contig+"e"], errors = "ignore")
-            fractions = fractions[fractions > 0]
-            if len(fractions) > 0:
-                minor_outliers = calcOutliers(fractions, barcode_factor)
-                minor_outliers = minor_outliers[minor_outliers > min_barcode_fraction]
-
-                for ix, mo in minor_outliers.iteritems():
-                    edges.append( (region, ix, mo ) )
-
-        misc.printstatus("[ BARCODE LINKING ]\t" + misc.reportProgress(len(GEMcomparison), len(GEMcomparison)))
-
-        return edges
-
-def main(contig_lengths, GEMlist, barcode_factor, barcode_fraction):
+    misc.printstatus("Number of windows: "+str(len(windows)))
+    windows = list(windows)
+    rows = np.repeat(np.arange(len(windows)), np.diff(GEMcomparison.indptr))
+    edges = outlierEdges(   rows, GEMcomparison.indices, GEMcomparison.data, windows, \
+                            windowContigs(windows), barcode_factor, min_barcode_fraction, bounds)
+    misc.printstatus("[ BARCODE LINKING ]\tFound {} edges.".format(len(edges)))
+
+    return edges
+
+def outlierEdges(   rows, columns, fractions, windows, contigs, barcode_factor, \
+                    min_barcode_fraction, bounds = None):
+    '''Create edges from the fractions of shared barcodes of window pairs,
+    in the order of the pairs.
+
+    Args:
+        rows (np.array): First window of every pair.
+        columns (np.array): Second window of every pair.
+        fractions (np.array): Fraction of shared barcodes of every pair. All
+            fractions of a first window must be included.
+        windows (list): Window names.
+        contigs (np.array): Contig of every window, from windowContigs.
+        barcode_factor (int): Factor for calculating outliers.
+        min_barcode_fraction (float): Minimum fraction of shared barcodes to create
+            an edge in the linkgraph.
+        bounds (np.array): Outlier bound of every window. If not given, it is
+            calculated from the fractions.
+    Returns:
+        list: Edges from the first to the second window of every outlier.
+    '''
+    # Ignore comparisons to the same contig and calculate outliers
+    # In low coverage datasets the amount of 0's might cloud any
+    # actual signal. Only windows with shared barcodes are stored in
+    # GEMcomparison, but explicitly stored 0's are removed too.
+    keep = (contigs[rows] != contigs[columns]) & (fractions > 0)
+    rows, columns, fractions = rows[keep], columns[keep], fractions[keep]
+
+    if bounds is None:
+        bounds = rowOutlierBounds(rows, fractions, len(windows), barcode_factor)
+    is_outlier = (fractions > bounds[rows]) & (fractions > min_barcode_fraction)
+    return [(windows[row], windows[column], fraction) for row, column, fraction \
+            in zip(rows[is_outlier], columns[is_outlier], fractions[is_outlier])]
+
+def main(  contig_lengths, GEMlist, barcode_factor, barcode_fraction, fractions_out = None, top_k = 0, \
+            sketches = None, lsh_bands = 64, memory_budget = 0, n_proc = 1, directory = None):
     '''Controller for graph_building.
 
     Args:
         contig_lengths (dict): Contig names (keys) and their lengths (values)
             from the input bam file.
-        GEMlist (dict): Windows corresponding to start and end regions
-            (size determined by -s) (keys) and the barcodes collected from
-            these regions (values).
+        GEMlist (barcode_collection.GEMlist): Windows corresponding to start
+            and end regions (size determined by -s) and the barcodes collected
+            from these regions.
         barcode_factor (int): Minimum fold difference between barcode fractions
             to create link.
         barcode_fraction (float): Minimum fraction of shared barcodes to create
             an edge in the linkgraph.
+        fractions_out (str): If given, write the fractions of shared barcodes
+            to this .npz file.
+        top_k (int): If > 0, only keep this many fractions of shared
+            barcodes per window during the comparison.
+        sketches (np.array): If given, MinHash sketches of the windows in
+            GEMlist. Only windows that are likely to share barcodes are
+            then compared, found by LSH with lsh_bands bands.
+        lsh_bands (int): Number of LSH bands.
+        memory_budget (float): If > 0, compare the windows in tiles using
+            about this many bytes of memory, with n_proc processes. Tile
+            files are written to a temporary directory in directory.
     Returns:
         Linkgraph: graph inferred from the input region barcodes.
         dict: dictionary of new scaffold names and which input contigs
@@ -502,14 +1041,29 @@ def main(contig_lengths, GEMlist, barcode_factor, barcode_fraction):
     global GEMs
     GEMs = GEMlist
 
-    # Collect the fraction of shared barcodes in the all-against-all
-    # comparison of windows
-    GEMcomparison = pairwise_comparisons(GEMlist)
-
-    # Infer linkage based on statistically significant outliers determined
-    # by the ESD test to build the graph
     nodes = makeNodes(list(contig_lengths.keys()))
-    edges = makeEdges(GEMcomparison, barcode_factor, barcode_fraction)
+    if memory_budget > 0 and sketches is None and top_k == 0:
+        # The comparisons are streamed from disk straight into edges
+        if fractions_out:
+            misc.printstatus("Fractions of shared barcodes are not kept when comparing in tiles, " + \
+                            "not writing {}.".format(fractions_out))
+        edges = tiledEdges(GEMlist, barcode_factor, barcode_fraction, memory_budget, n_proc, directory)
+    else:
+        # Collect the fraction of shared barcodes in the all-against-all
+        # comparison of windows
+        if sketches is not None:
+            GEMcomparison, bounds = pairwise_lsh_comparisons(GEMlist, sketches, lsh_bands, barcode_factor)
+        elif top_k > 0:
+            GEMcomparison, bounds = pairwise_top_comparisons(GEMlist, top_k, barcode_factor)
+        else:
+            GEMcomparison, bounds = pairwise_comparisons(GEMlist), None
+        if fractions_out:
+            misc.printstatus("Writing fractions of shared barcodes to {}.".format(fractions_out))
+            writeFractions(GEMcomparison, GEMlist.keys(), fractions_out)
+
+        # Infer linkage based on statistically significant outliers determined
+        # by the ESD test to build the graph
+        edges = makeEdges(GEMcomparison, GEMlist.keys(), barcode_factor, barcode_fraction, bounds)
     graph = Linkgraph(nodes, edges)
 
     return graph
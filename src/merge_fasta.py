@@ -10,30 +10,64 @@ Copyright (c) 2020, Markus Hiltunen
 Licensed under the GPL3 license. See LICENSE file.
 """
 
+import functools
+import os
 import numpy as np
 import pysam
 from scipy.stats import t
 import mappy as mp
 import multiprocessing
-import os
+import queue
 import time
 
 import nuclseqTools as nt
+import formatting_tools
 import misc
 
+# Number of bases at each contig end to search for overlaps in. 0 uses the
+# whole contigs. Set by main.
+overlap_window = 0
+
+# First covered step of contig ends, {(contig, side): step}. Filled by
+# trimSequences.
+covered_steps = {}
+trim_mincov = 0
+
+# Number of bases of the merged sequence to realign a query to in mergeSeq,
+# in addition to the query length
+realign_margin = 10000
+
+# Maximum number of extensions per overlap graph traversal. Set by main.
+max_traversal = 100000
+
+# Number of reverse complemented trimmed contigs to keep in memory
+rc_cache_size = 32
+
+# Paths with an estimated cost above this quantile of all paths are
+# dispatched from the start of mp_build_scaffolds
+heavy_path_quantile = 0.95
+
 class Overlapgraph:
     """Simple overlap graph
     Nodes are contigs, edges are overlaps between contigs in the form
-    (node1, node1_ori, node2, node2_ori, mappy.Alignment).
+    (node1, node1_ori, node2, node2_ori, Alignment).
     """
     def __init__(   self, nodes = set(), \
-                    edges = set()):
+                    edges = set(), \
+                    max_steps = 100000):
         self.nodes = nodes # {node1, node2, ...}
-        self.edges = edges # {(node1, node1_ori, node2, node2_ori, mappy.Alignment), ... }
+        self.edges = edges # {(node1, node1_ori, node2, node2_ori, Alignment), ... }
         self.paths = [] # Paths through the graph. Called externally.
         self.partial_paths = [] # Also keep partial paths
         self.incomplete_paths = []  # Combinations of partial paths with None at
                                     # the gap position
+        self.max_steps = max_steps # Maximum number of extensions per traversal
+
+        # Outgoing edges of each node and direction, in the order of self.edges
+        # Format: {(node, direction): [edge1, edge2, ...]}
+        self.adjacency = {}
+        for edge in self.edges:
+            self.adjacency.setdefault((edge[0], edge[1]), []).append(edge)
 
     def __str__(self):
         return "Overlapgraph([\
@@ -54,7 +88,10 @@ class Overlapgraph:
     def addEdges(self, edges):
         '''Adds edges (list) to graph.
         '''
-        self.edges.add(edges)
+        for edge in edges:
+            if edge not in self.edges:
+                self.edges.add(edge)
+                self.adjacency.setdefault((edge[0], edge[1]), []).append(edge)
 
     def nodes():
         '''Returns all nodes in graph
@@ -69,7 +106,68 @@ class Overlapgraph:
     def outgoing(self, node, direction):
         '''Returns all outgoing edges from node
         '''
-        return [ edge for edge in self.edges if edge[0] == node and edge[1] == direction ]
+        return self.adjacency.get((node, direction), [])
+
+    def bestPath(self, start, start_direction, target, target_direction):
+        '''Find the path between start and target with the longest overlap
+        distance, and append it to self.paths.
+
+        Description:
+            Depth first branch and bound over the paths from start. A branch
+            is pruned when even the longest incoming overlaps of all nodes it
+            has not visited cannot make it longer than the best path so far.
+            Of equally long paths, the first one found is kept, as in
+            shortestPath. The search stops after self.max_steps extensions,
+            returning the best path found until then.
+
+        Args:
+            start (str): starting contig name.
+            start_direction (str): starting contig orientation.
+            target (str): target contig name.
+            target_direction (str): target contig orientation.
+        Returns:
+            list: the best path, or None if no complete path was found.
+        '''
+        # Longest overlap into each node, to bound what a branch can gain
+        max_incoming = {}
+        for edge in self.edges:
+            if edge[4].blen > max_incoming.get(edge[2], 0):
+                max_incoming[edge[2]] = edge[4].blen
+
+        best_path, best_ovl = None, 0
+        n_steps = 0
+        visited = {start}
+
+        def __visit(n, n_dir, path, ovl, remaining):
+            nonlocal best_path, best_ovl, n_steps
+
+            if n == target:
+                if n_dir == target_direction \
+                and (best_path is None or ovl > best_ovl):
+                    best_path, best_ovl = path, ovl
+                return
+
+            for edge in self.outgoing(n, n_dir):
+                if n_steps >= self.max_steps:
+                    return
+                if edge[2] in visited:
+                    continue
+                n_remaining = remaining - max_incoming[edge[2]]
+                n_ovl = ovl + edge[4].blen
+                if best_path is not None and n_ovl + n_remaining <= best_ovl:
+                    continue
+
+                n_steps += 1
+                visited.add(edge[2])
+                __visit(edge[2], edge[3], path+[edge], n_ovl, n_remaining)
+                visited.remove(edge[2])
+
+        __visit(start, start_direction, [], 0, \
+                sum(v for k, v in max_incoming.items() if k != start))
+
+        if best_path is not None:
+            self.paths.append(best_path)
+        return best_path
 
     def traverse(self, start, start_direction, target, target_direction):
         '''Appends all possible paths between the nodes start and target to self.paths
@@ -77,7 +175,8 @@ class Overlapgraph:
         Description:
             Look for paths connecting start and target nodes. Every combination
             of edges is considered, and partial paths, i.e. extensions from
-            start that don't reach target, are also kept.
+            start that don't reach target, are also kept. Stops after
+            self.max_steps extensions.
 
         Args:
             start (str): starting contig name.
@@ -85,7 +184,13 @@ class Overlapgraph:
             target (str): target contig name.
             target_direction (str): target contig orientation.
         '''
+        n_steps = 0
+
         def __visit(n, n_dir, path):
+            nonlocal n_steps
+            n_steps += 1
+            if n_steps > self.max_steps:
+                return
             visited = [v[0] for v in path]
 
             # Check if target is reached yet.
@@ -227,164 +332,318 @@ class Overlapgraph:
                                                     rev_path[0][1], None)] \
                                                     + rev_path )
 
-def findOverlap(seq1,seq2):
+class Alignment:
+    """Alignment of a query to a reference sequence
+    Holds the attributes of a mappy.Alignment that are used during merging.
+    Unlike mappy.Alignment, it can be created from translated coordinates,
+    e.g. for the reverse complement of the reference.
+    """
+    def __init__(   self, ctg_len, r_st, r_en, q_st, q_en, strand, \
+                    mlen, blen, cigar):
+        self.ctg_len = ctg_len # Reference length
+        self.r_st = r_st # Reference start, 0-based
+        self.r_en = r_en # Reference end, exclusive
+        self.q_st = q_st # Query start, 0-based, always on the query forward strand
+        self.q_en = q_en # Query end, exclusive
+        self.strand = strand # 1 or -1
+        self.mlen = mlen # Number of matching bases
+        self.blen = blen # Alignment block length
+        self.cigar = cigar # [[length, operation], ...] in reference direction
+        self.cigar_str = "".join([str(l)+"MIDNSHP=XB"[op] for l, op in cigar])
+
+    def __repr__(self):
+        return "Alignment([{0}-{1} of {2}, {3}-{4}, strand: {5}, {6}])".format( \
+                self.r_st, self.r_en, self.ctg_len, self.q_st, self.q_en, \
+                self.strand, self.cigar_str)
+
+def fromMappy(aln, ctg_len = None, ref_offset = 0, query_offset = 0):
+    '''Copies a mappy.Alignment to an Alignment.
+
+    Args:
+        aln (mappy.Alignment): Alignment to copy.
+        ctg_len (int): Length of the full reference, if aln is to a part of it.
+        ref_offset (int): Start of the aligned part in the full reference.
+        query_offset (int): Start of the aligned part in the full query.
+    Returns:
+        Alignment: in the coordinates of the full reference and query.
+    '''
+    return Alignment(   ctg_len if ctg_len else aln.ctg_len, \
+                        aln.r_st + ref_offset, aln.r_en + ref_offset, \
+                        aln.q_st + query_offset, aln.q_en + query_offset, \
+                        aln.strand, aln.mlen, aln.blen, [list(c) for c in aln.cigar])
+
+def reverseAlignment(aln):
+    '''Translates an alignment to the reverse complement of the reference.
+
+    Description:
+        Aligning a query to the reverse complement of a reference gives the
+        same alignment as to the reference itself, seen from the other end:
+        reference coordinates are mirrored, the strand is flipped and the
+        cigar operations come in reverse order. Query coordinates are always
+        given on the query forward strand and are unchanged.
+    '''
+    return Alignment(   aln.ctg_len, aln.ctg_len - aln.r_en, aln.ctg_len - aln.r_st, \
+                        aln.q_st, aln.q_en, -aln.strand, aln.mlen, aln.blen, \
+                        aln.cigar[::-1])
+
+def invertAlignment(aln, query_len):
+    '''Swaps the roles of reference and query in an alignment.
+
+    Description:
+        The alignment of a query to a reference also describes the alignment
+        of the reference to the query. Coordinates are swapped and insertions
+        become deletions. If the alignment is on the reverse strand, the
+        cigar operations also come in reverse order, because the cigar
+        follows the forward direction of the reference.
+
+    Args:
+        aln (Alignment): Alignment to invert.
+        query_len (int): Length of the query, which becomes the reference.
+    Returns:
+        Alignment: the inverted alignment.
+    '''
+    swap = {1:2, 2:1} # Insertion <-> deletion
+    cigar = [[l, swap.get(op, op)] for l, op in aln.cigar]
+    if aln.strand == -1:
+        cigar = cigar[::-1]
+    return Alignment(   query_len, aln.q_st, aln.q_en, aln.r_st, aln.r_en, \
+                        aln.strand, aln.mlen, aln.blen, cigar)
+
+def sequenceEnds(seq):
+    '''Returns the parts of seq to search for overlaps in, as a list of
+    (offset, subsequence) tuples. If overlap_window is set and seq is long
+    enough, only the first and last overlap_window bases are used. seq may
+    be a str or a sequence from overlapSequence, of which only the parts
+    are decoded to str.
+    '''
+    if overlap_window > 0 and len(seq) > 2 * overlap_window:
+        return [(0, str(seq[:overlap_window])), \
+                (len(seq) - overlap_window, str(seq[len(seq) - overlap_window:]))]
+    return [(0, str(seq))]
+
+def indexSequence(seq):
+    '''Builds in-memory minimap2 indexes of seq for overlap detection.
+
+    Returns:
+        tuple: length of seq and a list of (offset, mappy.Aligner) tuples,
+            one for every part of seq given by sequenceEnds.
+    '''
+    #return mp.Aligner(seq=seq, preset="asm10")#k=19, w=10, scoring=[1,4,6,26])
+    return len(seq), [ (offset, mp.Aligner(seq=part, preset="map-pb")) \
+                        for offset, part in sequenceEnds(seq) ]
+
+def mapSequence(idx, seq):
+    '''Aligns seq to an index from indexSequence.
+
+    Returns:
+        list: Alignments in the coordinates of the full sequences.
+    '''
+    ref_len, ref_parts = idx
+    alignments = []
+    for query_offset, query_part in sequenceEnds(seq):
+        for ref_offset, aligner in ref_parts:
+            for aln in aligner.map(query_part):
+                alignments.append(fromMappy(aln, ref_len, ref_offset, query_offset))
+    return alignments
+
+def filterOverlaps(alignments, query_len):
+    '''Find the alignments that are overlaps between the ends of reference
+    and query.
+
+    Args:
+        alignments (list): Alignments of the query to the reference.
+        query_len (int): Length of the query.
+
+    Returns:
+        list: suffix_overlaps, list of overlaps from the suffix of reference
+        list: prefix_overlaps, list of overlaps from the suffix of revcomped
+            reference
+    '''
+    def isSuffixOverlap(aln):
+        # Filter for alignments starting within the first 1kb or ending
+        # within the last 1 kb of seq1, and starting within the first or
+        # last 1 kb of seq2
+        # We also need to control that the alignment is in the right direction
+
+        # Overlap is at suffix of reference. Ideally it ends at the last
+        # coordinate of reference, but because contig ends usually have
+        # poor quality, the alignment might not reach that far. We can still
+        # use the overlap, as long as there is an overhang from the query
+        # sequence.
+        if aln.r_en > aln.ctg_len - 1000:
+
+            # Overlap is at prefix of query, in this case it must be in
+            # forward orientation
+            if aln.q_st < 1000 and aln.strand == 1:
+                return True
+
+            # Overlap is at suffix of query, in this case it must be in
+            # reverse orientation
+            if aln.q_en > query_len-1000 and aln.strand == -1:
+                return True
+
+        return False
+
+    suffix_overlaps, prefix_overlaps = [], []
+    for aln in alignments:
+        if isSuffixOverlap(aln):
+            suffix_overlaps.append(aln)
+
+        ### Then do the same for prefix overlaps, which are the suffix
+        # overlaps of revcomped reference
+        rev_aln = reverseAlignment(aln)
+        if isSuffixOverlap(rev_aln):
+            prefix_overlaps.append(rev_aln)
+
+    return suffix_overlaps, prefix_overlaps
+
+def findOverlap(seq1,seq2,idx=None):
     '''Find overlaps between two sequences.
 
     Description:
         Use mappy to find overlaps between all prefix-suffix pairs of the
-        two given nucleotide sequences.
+        two given nucleotide sequences. The index is built in memory from
+        seq1 only. Overlaps with the prefix of seq1 are found from the same
+        alignments, translated to the reverse complement of seq1. If
+        overlap_window is set, only the ends of the sequences are aligned.
 
     Args:
         seq1 (str): First nucleotide sequence, serving as reference.
         seq2 (str): Second nucleotide sequence, serving as query.
+        idx (tuple): Index of seq1 from indexSequence. Built if not given.
 
     Returns:
         list: suffix_overlaps, list of overlaps from the suffix of seq1
         list: prefix_overlaps, list of overlaps from the suffix of revcomped seq1
     '''
-    alignment_preset = "map-pb"
-
     #### First find reference suffix overlaps. We will treat seq1 as reference
-    # Write seq1 to temporary fasta file
-    pid = str(os.getpid())
-    with open(pid+".tmp.fasta", "w") as tmpfasta:
-        tmpfasta.write(">tmp\n")
-        tmpfasta.write(seq1)
-
     # Build index from seq1
-    #idx = mp.Aligner(fn_idx_in=pid+"tmp.fasta", preset="asm10")#k=19, w=10, scoring=[1,4,6,26])
-    idx = mp.Aligner(fn_idx_in=pid+".tmp.fasta", preset=alignment_preset)
+    if idx is None:
+        idx = indexSequence(seq1)
 
-    # Align
-    alignments = idx.map(seq2)
-
-    # Iterate over alignments and search for overlapping ends
-    suffix_overlaps, prefix_overlaps = [], []
-    if alignments:
-        for aln in alignments:
-            # Filter for alignments starting within the first 1kb or ending
-            # within the last 1 kb of seq1, and starting within the first or
-            # last 1 kb of seq2
-            # We also need to control that the alignment is in the right direction
-
-            # Overlap is at suffix of reference. Ideally it ends at the last
-            # coordinate of reference, but because contig ends usually have
-            # poor quality, the alignment might not reach that far. We can still
-            # use the overlap, as long as there is an overhang from the query
-            # sequence.
-            if aln.r_en > aln.ctg_len - 1000:
-
-                # Overlap is at prefix of query, in this case it must be in
-                # forward orientation
-                if aln.q_st < 1000 and aln.strand == 1:
-                    suffix_overlaps.append(aln)
-
-                # Overlap is at suffix of query, in this case it must be in
-                # reverse orientation
-                if aln.q_en > len(seq2)-1000 and aln.strand == -1:
-                    suffix_overlaps.append(aln)
-
-    ### Then do the same for prefix overlaps, by first reverse complementing
-    # seq1
-    seq1 = nt.reverse_complement(seq1)
-    with open(pid+".tmp.fasta", "w") as tmpfasta:
-        tmpfasta.write(">tmp\n")
-        tmpfasta.write(seq1)
-
-    #idx = mp.Aligner(fn_idx_in="tmp.fasta", preset="map-pb")#k=19, w=10, scoring=[1,4,6,26])
-    idx = mp.Aligner(fn_idx_in=pid+".tmp.fasta", preset=alignment_preset)
-    alignments = idx.map(seq2)
-    prefix_overlaps = []
-    if alignments:
-        for aln in alignments:
-
-            # Overlap is at suffix of (revcomped) reference
-            if aln.r_en > aln.ctg_len - 1000:
-
-                # Overlap is at prefix of query, in this case it must be in
-                # reverse orientation
-                if aln.q_st < 1000 and aln.strand == 1:
-                    prefix_overlaps.append(aln)
-
-                # Overlap is at suffix of query, in this case it must be in
-                # forward orientation
-                if aln.q_en > len(seq2)-1000 and aln.strand == -1:
-                    prefix_overlaps.append(aln)
-
-    # Finally go through the overlaps and if there are more than X, return only
-    # the X longest
-    '''
-    if len(suffix_overlaps) > 3:
-        suffix_overlaps.sort(key=lambda ovl: ovl.mlen, reverse = True)
-        suffix_overlaps = suffix_overlaps[:3]
-    if len(prefix_overlaps) > 3:
-        prefix_overlaps.sort(key=lambda ovl: ovl.mlen, reverse = True)
-        prefix_overlaps = prefix_overlaps[:3]
-    '''
-    return suffix_overlaps, prefix_overlaps
+    # Align and search for overlapping ends
+    alignments = mapSequence(idx, seq2)
+    return filterOverlaps(alignments, len(seq2))
 
 def findOverlaps(fasta):
     '''Compute all prefix/suffix overlaps of given sequences. Return only the
     longest overlap for each prefix-suffix combination.
 
+    Description:
+        Every pair of sequences is aligned once, using one in-memory index
+        per sequence. The alignments of seq2 to seq1 are inverted to also
+        give the overlaps of seq1 to seq2, so both directions of an overlap
+        always come from the same alignment.
+
     Args:
-        fasta: fasta in dict format where keys are headers and values sequences
+        fasta: fasta in dict format where keys are headers and values
+            sequences, as str or from overlapSequence
     Returns:
         list: list of tuples describing the overlaps.
     '''
     overlaps = {}
-    for tig1, seq1 in fasta.items():
-        for tig2, seq2 in fasta.items():
-
-            # Avoid self-alignments
-            if tig1 != tig2:
 
-                # Find overlaps between suffix of seq1 and prefix or suffix of seq2
-                suffix_ovls, prefix_overlaps = findOverlap(seq1, seq2)
-                for ovl in suffix_ovls:
-                    strand = "+" if ovl.strand > 0 else "-"
-
-                    # If current prefix-suffix pair not in overlaps, append it
-                    if (tig1, "+", tig2, strand) not in overlaps:
-                        overlaps[(tig1, "+", tig2, strand)] = ovl
-                    else:
-                        # Else check if the new overlap has more matching
-                        # bases, in that case use the new overlap
-                        old_mlen = overlaps[(tig1, "+", tig2, strand)].mlen
-                        if ovl.mlen > old_mlen:
-                            overlaps[(tig1, "+", tig2, strand)] = ovl
-
-                # prefix_overlaps are actually suffix overlaps from the revcomp
-                # of seq1
-                for ovl in prefix_overlaps:
-                    strand = "+" if ovl.strand > 0 else "-"
-
-                    # If current prefix-suffix pair not in overlaps, append it
-                    if (tig1, "-", tig2, strand) not in overlaps.keys():
-                        overlaps[(tig1, "-", tig2, strand)] = ovl
-                    else:
-                        # Else check if the new overlap has more matching
-                        # bases, in that case use the new overlap
-                        old_mlen = overlaps[(tig1, "-", tig2, strand)].mlen
-                        if ovl.mlen > old_mlen:
-                            overlaps[(tig1, "-", tig2, strand)] = ovl
+    def addOverlaps(tig1, tig2, suffix_ovls, prefix_ovls):
+        # prefix_overlaps are actually suffix overlaps from the revcomp
+        # of seq1
+        for tig1_ori, ovls in (("+", suffix_ovls), ("-", prefix_ovls)):
+            for ovl in ovls:
+                strand = "+" if ovl.strand > 0 else "-"
+                key = (tig1, tig1_ori, tig2, strand)
+
+                # If current prefix-suffix pair not in overlaps, append it.
+                # Else check if the new overlap has more matching
+                # bases, in that case use the new overlap
+                if key not in overlaps or ovl.mlen > overlaps[key].mlen:
+                    overlaps[key] = ovl
+
+    tigs = list(fasta.keys())
+    for idx, tig1 in enumerate(tigs):
+        seq1 = fasta[tig1]
+        index = None
+
+        # Avoid self-alignments and aligning the same pair twice
+        for tig2 in tigs[idx+1:]:
+            seq2 = fasta[tig2]
+            if index is None:
+                index = indexSequence(seq1)
+
+            # Find overlaps between suffix of seq1 and prefix or suffix of seq2
+            alignments = mapSequence(index, seq2)
+            addOverlaps(tig1, tig2, *filterOverlaps(alignments, len(seq2)))
+
+            # The same alignments seen from seq2
+            alignments = [invertAlignment(aln, len(seq2)) for aln in alignments]
+            addOverlaps(tig2, tig1, *filterOverlaps(alignments, len(seq1)))
 
     # Reformat to list of tuples
     return [tuple(list(k)+[ovl]) for k, ovl in overlaps.items()]
 
-def countReads(contig,coords_to_check, region_length):
+def initTrimWorker(input_bam, mincov):
+    '''Opens a separate handle to the bam file in each trimming process.
+    '''
+    global samfile
+    global trim_mincov
+    samfile = pysam.AlignmentFile(input_bam, "rb")
+    trim_mincov = mincov
+
+def firstCoveredStep(tig, side, mincov, end = None, step_len = 50):
+    '''Find the first step from a contig end with enough coverage.
+
+    Description:
+        Walks inward from the given end of tig in steps of step_len bases,
+        like trimFasta does. The coverage profile is fetched in chunks of
+        growing size with one count_coverage call each, and the average
+        coverage of all steps in a chunk is computed at once.
+
+    Args:
+        tig (str): Contig name.
+        side (str): "s" or "e".
+        mincov (int): Steps with average coverage above this are covered.
+        end (int): Current end coordinate of the contig. Defaults to the
+            contig length.
+        step_len (int): Step size.
+    Returns:
+        int: number of steps before the first covered step, or None if
+            there is no covered step.
     '''
-    To count the number of reads aligned to a region
+    end = samfile.get_reference_length(tig) if end is None else end
+    n_steps = end // step_len # Number of whole steps in the contig
+    first_step, chunk_steps = 0, 200
+
+    while first_step < n_steps:
+        last_step = min(first_step + chunk_steps, n_steps)
+        if side == "s":
+            start, stop = first_step * step_len, last_step * step_len
+        else:
+            start, stop = end - last_step * step_len, end - first_step * step_len
+
+        coverage = np.array(samfile.count_coverage(tig, start, stop)).sum(axis=0)
+        step_cov = coverage.reshape(-1, step_len).sum(axis=1) / step_len
+        if side == "e":
+            step_cov = step_cov[::-1] # Order steps from the end inward
+
+        covered = np.flatnonzero(step_cov > mincov)
+        if len(covered) > 0:
+            return first_step + int(covered[0])
+
+        first_step = last_step
+        chunk_steps *= 2
+
+    return None
+
+def coveredStepsWorker(contig_side):
+    '''Returns contig_side and its first covered step, for process pools.
     '''
-    cov_arr = samfile.count_coverage(contig, coords_to_check[0],coords_to_check[1])
-    cov = sum([sum(cov_arr[x]) for x in range(0,4,1)]) / region_length
-    return cov
+    return contig_side, firstCoveredStep(contig_side[0], contig_side[1], trim_mincov)
 
 def trimFasta(trimmed_fasta_coords, contig_side_to_trim, mincov):
     '''
     Given a fasta entry with side to trim, returns new start and end coordinates
     Input format: "tigs" or "tige"
 
+    Uses the first covered steps in covered_steps, if computed beforehand.
+
     Returns:
         int: number of coordinates to trim off either start or end side of
             input contig. Negative if end side.
@@ -396,44 +655,25 @@ def trimFasta(trimmed_fasta_coords, contig_side_to_trim, mincov):
 
     if tig in fastafile.references:
         ctg_len = trimmed_fasta_coords[tig][1]
-        cov = 0
         coords_to_trim = 0
 
-        if side == "s":
-            coords_to_check = [0,step_len]
-            cov = countReads(tig,coords_to_check, step_len)
-
-            while cov <= mincov:
-                coords_to_trim += step_len # Update with new end coordinate
-                coords_to_check = [x+step_len for x in coords_to_check] # And move to next coordinates
-
-                # If contig boundary was passed without coverage being enough,
-                # use all of it
-                if coords_to_trim >= ctg_len - step_len:
-                    coords_to_trim = 0
-                    break
-
-                cov = countReads(tig,coords_to_check, step_len)
-
-        elif side == "e":
-            coords_to_check = [ctg_len-step_len,ctg_len]
-            cov = countReads(tig,coords_to_check, step_len)
-
-            while cov <= mincov:
-                coords_to_trim -= step_len    # Update with new end coordinate
-                coords_to_check = [x-step_len for x in coords_to_check] # And move to next coordinates
-
-                # If contig boundary was passed without coverage being enough,
-                # use all of it
-                if abs(coords_to_trim) >= ctg_len - step_len:
-                    coords_to_trim = 0
-                    break
+        # Steps are counted from the contig start, or from the current end
+        # coordinate, which is only different from the contig length if the
+        # end has been trimmed before
+        if (tig, side) in covered_steps \
+        and (side == "s" or ctg_len == fastafile.get_reference_length(tig)):
+            step = covered_steps[(tig, side)]
+        else:
+            step = firstCoveredStep(tig, side, mincov, ctg_len)
 
-                cov = countReads(tig,coords_to_check, step_len)
+        # If contig boundary was passed without coverage being enough,
+        # use all of it
+        if step is not None and step * step_len < ctg_len - step_len:
+            coords_to_trim = step * step_len if side == "s" else -step * step_len
 
     return coords_to_trim
 
-def trimSequences(paths, mincov):
+def trimSequences(paths, mincov, n_proc = 1, input_bam = None):
     '''Trim away low quality regions of input sequences
 
     Description:
@@ -448,6 +688,8 @@ def trimSequences(paths, mincov):
             graph_building.Junction objects.
         mincov (int): Trim contig ends with lower average coverage than this
             value
+        n_proc (int): Number of processes to scan contig ends with.
+        input_bam (str): Path to the bam file, needed if n_proc > 1.
     Returns:
         dict: trimmed_fasta_coords. Keys: input contig headers, values:
             start and end coordinates to keep, in addition to True or False
@@ -460,6 +702,30 @@ def trimSequences(paths, mincov):
     for idx, ctg in enumerate(fastafile.references):
         trimmed_fasta_coords[ctg] = [0, fastafile.lengths[idx], False, False]
 
+    # Scan the coverage of all contig ends that may be trimmed up front
+    global covered_steps
+    global trim_mincov
+    trim_mincov = mincov
+    contig_sides = set()
+    for path in paths:
+        for junction in path:
+            for node in [junction.start, junction.target]:
+                if node != None:
+                    contig_sides.add( (node[:-1], node[-1]) )
+            for conn in junction.connections:
+                contig_sides.add( (conn, "s") )
+                contig_sides.add( (conn, "e") )
+    references = set(fastafile.references)
+    contig_sides = sorted(cs for cs in contig_sides if cs[0] in references)
+
+    if n_proc == 1:
+        covered_steps = dict(coveredStepsWorker(cs) for cs in contig_sides)
+    else:
+        with multiprocessing.Pool(n_proc, initializer=initTrimWorker, \
+                                initargs=(input_bam, mincov)) as pool:
+            covered_steps = dict(pool.imap_unordered(coveredStepsWorker, \
+                                contig_sides, chunksize=16))
+
     # Then find new coordinates for all sequences to merge
     for idx, path in enumerate(paths):
         if idx in range(0,100000000,5):
@@ -520,39 +786,12 @@ def trimSequences(paths, mincov):
 
     return trimmed_fasta_coords
 
-def chop_cigar(cigar):
-    '''
-    Given a cigar string, chops it up into a list.
-    '''
-    cig_list = []
-    pos = 0
-    for idx, c in enumerate(cigar):
-        if c.isalpha():
-            cig_list.append(cigar[pos:idx+1])
-            pos  = idx + 1
-    return cig_list
-
-def reverse_cigar(cigar_list):
-    '''
-    Reverses the input list of cigar operations.
-    '''
-    reversed = []
-    for cig in cigar_list[::-1]:
-        if cig[-1] == "M":
-            reversed.append(cig)
-
-        elif cig[-1] == "D":
-            reversed.append(cig[:-1]+"I")
-        elif cig[-1] == "I":
-            reversed.append(cig[:-1]+"D")
-    return reversed
-
 def shortestPath(paths):
     '''Find the path with the longest overlap distance.
 
     Description: Each member of paths is a list, containing starting contig,
         starting contig direction, aligned contig, aligned contig direction,
-        and alignment information in a mappy.Alignment object. The path with
+        and alignment information in an Alignment object. The path with
         the longest overlap distance is returned.
     Args:
         paths: graph_building.Overlapgraph.paths
@@ -572,15 +811,42 @@ def shortestPath(paths):
             best_ovl = ovl_dist
     return best_path
 
+@functools.lru_cache(maxsize=rc_cache_size)
+def reverseComplementContig(tig):
+    '''Reverse complement of a trimmed contig. The most recently used are
+    cached, since the same contig is often needed several times per junction.
+    '''
+    return trimmed_fasta.packed(tig).reverse_complement().decode()
+
+def orientedContig(tig, ori):
+    '''Returns the trimmed sequence of tig in orientation ori, "+" or "-".
+    '''
+    return trimmed_fasta.sequence(tig) if ori == "+" else reverseComplementContig(tig)
+
+def overlapSequence(tig, ori = "+"):
+    '''Returns the trimmed sequence of tig in orientation ori, "+" or "-",
+    to search for overlaps in with findOverlaps.
+
+    Description:
+        If overlap_window is set, only the contig ends are aligned. The
+        sequence is then a view of trimmed_fasta, and sequenceEnds decodes
+        only the ends. Otherwise the whole contig is decoded, as the whole
+        contig is aligned.
+    '''
+    if overlap_window == 0:
+        return orientedContig(tig, ori)
+    packed = trimmed_fasta.packed(tig)
+    return packed if ori == "+" else nt.ReverseComplementView(packed)
+
 def createConsensus(step,string1,string2, gapsize):
     '''Given two overlapping nucleotide strings and mappy alignment information,
     merges and returns the nucleotide strings.
 
     Args:
         step: step in the path. Looks like:
-        ("ctg1", "ctg1_orientation", "ctg2", "ctg2_orientation", <mappy.Alignment object>)
-        string1: first nucleotide string
-        string2: second nucleotide string
+        ("ctg1", "ctg1_orientation", "ctg2", "ctg2_orientation", <Alignment object>)
+        string1: first nucleotide string, in the orientation of the step
+        string2: second nucleotide string, in the orientation of the step
         gapsize (int): Gap size for scaffolding.
     Returns:
         Str: The nucleotide sequence starting at the alignment r_st, if any,
@@ -588,16 +854,12 @@ def createConsensus(step,string1,string2, gapsize):
         Int: query_pos, query position.
         Bool: gap, if there is a gap in the sequence or not.
     '''
-    ref_ori, target_ori = step[1], step[3]
+    target_ori = step[3]
     aln = step[4]
 
-    # Reverse complement sequences if in - direction
+    # Sequences in - direction are already reverse complemented.
     # If reference is in -, the overlap was already calculated
     # from the revcomp. I.e. no need to recalculate position and cigar string.
-    if ref_ori == "-":
-        string1 = nt.reverse_complement(string1)
-    if target_ori == "-":
-        string2 = nt.reverse_complement(string2)
 
     # If there is no alignment, merge by gap insertion
     if not aln:
@@ -606,43 +868,40 @@ def createConsensus(step,string1,string2, gapsize):
         ovl_len = 0
 
     else:
-        cig_list = chop_cigar(aln.cigar_str)
-        # Track position in both strings
-        ref_pos, query_pos = aln.r_st, aln.q_st
-
-        if target_ori == "-":
-            cigar_list = reverse_cigar(cig_list)
-            query_pos = len(string2) - aln.q_en
+        # Query positions are on the oriented query. For a - query this is
+        # the reverse complement, which is aligned in the same direction as
+        # the reference, so the cigar is used as it is.
+        query_st = aln.q_st if target_ori == "+" else len(string2) - aln.q_en
+
+        # Find where each operation ends in both strings
+        cigar = np.asarray(aln.cigar, dtype=np.int64).reshape(-1, 2)
+        lengths, ops = cigar[:,0], cigar[:,1]
+        ref_steps = np.where((ops == 0) | (ops == 2), lengths, 0)
+        query_steps = np.where((ops == 0) | (ops == 1), lengths, 0)
+        ref_ends = aln.r_st + np.cumsum(ref_steps)
+        query_ends = query_st + np.cumsum(query_steps)
+
+        # Walk through the aligned region, gradually building the sequence.
+        # Because of the tendency of PacBio to miss some bases, we will use
+        # the extra base at every indel position. Matches and deletions in
+        # the query both take bases from the reference, so the reference is
+        # copied in one slice between every pair of insertions.
+        insertions = np.flatnonzero(ops == 1)
+        ref_cuts = [aln.r_st] + ref_ends[insertions].tolist() + [aln.r_st + int(ref_steps.sum())]
+        ins_starts = (query_ends[insertions] - lengths[insertions]).tolist()
+        ins_ends = query_ends[insertions].tolist()
 
         output_string = []
-
-        # Then walk through the aligned region in the cigar string,
-        # gradually building the sequence. Because of the tendency of PacBio
-        # to miss some bases, we will use the extra base at every indel position
-        for cig in cig_list:
-
-            # If strings match, there is no problem
-            # Use whatever sequence, they are the same
-            # Then move both position trackers
-            if cig[-1] == "M":
-                output_string.append( string1[ref_pos:ref_pos+int(cig[:-1])] )
-                ref_pos += int(cig[:-1])
-                query_pos += int(cig[:-1])
-
-            # If insertion in query, add extra bases from query and increase position
-            elif cig[-1] == "I":
-                output_string.append( string2[query_pos:query_pos+int(cig[:-1])] )
-                query_pos += int(cig[:-1])
-
-            # If deletion in query, add extra bases from reference and increase position
-            elif cig[-1] == "D":
-                output_string.append( string1[ref_pos:ref_pos+int(cig[:-1])] )
-                ref_pos += int(cig[:-1])
+        for k in range(len(ins_starts)):
+            output_string.append( string1[ref_cuts[k]:ref_cuts[k+1]] )
+            output_string.append( string2[ins_starts[k]:ins_ends[k]] )
+        output_string.append( string1[ref_cuts[-2]:ref_cuts[-1]] )
+        query_end = query_st + int(query_steps.sum())
 
         # After iterating over the whole alignment, add remaining bases from
         # query sequence
-        ovl_len = len(''.join(output_string))
-        output_string.append( string2[query_pos:] )
+        ovl_len = sum(len(seq) for seq in output_string)
+        output_string.append( string2[query_end:] )
         gap = False
 
     return ''.join(output_string), gap, ovl_len
@@ -653,7 +912,7 @@ def mergeSeq(path, gapsize):
     Description:
         Create a combined sequence of all contigs included in path. A merge
         will be performed at overlaps, and if there is no overlap, i.e. the
-        <mappy.Alignment object> is None, a gap is introduced. The sequence is
+        <Alignment object> is None, a gap is introduced. The sequence is
         built by iteration over the path. During each iteration, if there is
         an overlap, the merged sequence is first trimmed for the number of bases
         corresponding to the reference overlap length, and then extended,
@@ -662,7 +921,7 @@ def mergeSeq(path, gapsize):
         extension begins at the gap.
     Args:
         path (list): List of steps in the path. Each step is a tuple looking like:
-            ('tig1_name', 'tig1_dir', 'tig2_name', 'tig2_dir', <mappy.Alignment object>),
+            ('tig1_name', 'tig1_dir', 'tig2_name', 'tig2_dir', <Alignment object>),
             where dirs are either "+" or "-".
         gapsize (int): Gap size for scaffolding.
     Returns:
@@ -676,8 +935,7 @@ def mergeSeq(path, gapsize):
     # Initiate the merged sequence by adding the first reference sequence
     # Control for reverse orientation
     first_step = path[0]
-    merged_sequence = trimmed_fasta[first_step[0]] if first_step[1] == "+" \
-    else nt.reverse_complement(trimmed_fasta[first_step[0]])
+    merged_sequence = nt.SequenceBuilder(orientedContig(first_step[0], first_step[1]))
     bed_coords = [( "0", str(len(merged_sequence)), first_step[0], \
                     "0", first_step[1], "0", str(len(merged_sequence)), \
                     "0,0,255")]
@@ -697,22 +955,26 @@ def mergeSeq(path, gapsize):
         r_name, q_name = ovl[0], ovl[2]
         r_ori, q_ori = ovl[1], ovl[3]
         aln = ovl[4]
-        seq1, seq2 = trimmed_fasta[r_name], trimmed_fasta[q_name]
+        seq1, seq2 = orientedContig(r_name, r_ori), orientedContig(q_name, q_ori)
 
         # If there is an alignment at this step in the path, remove bases from
         # the merged sequence from where the alignment starts and onwards
         if aln:
-            bases_to_trim = len(trimmed_fasta[r_name]) - aln.r_st
+            bases_to_trim = trimmed_fasta.length(r_name) - aln.r_st
             if bases_to_trim > 0:
-                merged_sequence = merged_sequence[:-bases_to_trim]
+                merged_sequence.truncate(bases_to_trim)
             else:
                 # If we got here it means that the whole reference sequence is
                 # in the alignment. In this case, we cannot simply remove the
                 # number of bases in the merged sequence that correspond to the
                 # query length, because the query may already have been aligned
                 # into the merged sequence. Instead, recalculate the alignment from
-                # the merged sequence.
-                suffix_overlaps, prefix_overlaps = findOverlap(merged_sequence, trimmed_fasta[q_name])
+                # the merged sequence. The query cannot overlap more of the
+                # merged sequence than its own length, so only a tail window
+                # of that length and a margin is indexed.
+                query = trimmed_fasta.sequence(q_name)
+                tail = merged_sequence.tail(len(query) + realign_margin)
+                suffix_overlaps, prefix_overlaps = findOverlap(tail, query)
                 # We are only interested in suffix_overlaps in the expected
                 # orientation of query
                 exp_ori = 1 if q_ori == "+" else -1
@@ -726,8 +988,13 @@ def mergeSeq(path, gapsize):
                         if ovl_dist > best_ovl.blen:
                             best_ovl = sovl
 
+                    # Continue from the new overlap. The tail window ends
+                    # where the merged sequence ends, so trimming from the
+                    # overlap start in the window trims the merged sequence
+                    # at the same position.
                     r_name, r_ori = "tmp", "+"
-                    seq1 = merged_sequence
+                    seq1, aln = tail, best_ovl
+                    merged_sequence.truncate(len(tail) - best_ovl.r_st)
 
                 else:
                     aln = None
@@ -748,7 +1015,7 @@ def mergeSeq(path, gapsize):
                                 str(len(merged_sequence)+ovl_len+1), "255,0,0"))
 
         # Extend merged_sequence by the new consensus
-        merged_sequence += consensus
+        merged_sequence.append(consensus)
         included_contigs.append(q_name)
         # Append seq2 to bed_coords
         bed_coords.append( (str(len(merged_sequence)-len(seq2)+1), \
@@ -757,228 +1024,435 @@ def mergeSeq(path, gapsize):
                             str(len(merged_sequence)-len(seq2)+1), \
                             str(len(merged_sequence)+1), "0,0,255" ) )
 
-    return merged_sequence, included_contigs, n_gaps, n_merges, bed_coords
+    return merged_sequence.getvalue(), included_contigs, n_gaps, n_merges, bed_coords
 
-def combine_paths(linkpath):
-    '''Find if each junction in linkpath can be merged by alignment or gap
-    introduction. Return a path where each step is a tuple describing the
-    potential overlap.
+def resolveJunction(junction):
+    '''Find if junction can be merged by alignment or gap introduction.
+
+    Description:
+        Only needs the sequences of the contigs in junction, so junctions
+        can be resolved independently and joined with joinJunctions.
 
     Args:
-        linkpath (list): list of graph_building.Junction objects to be combined
-            into a scaffold.
+        junction (graph_building.Junction): junction to resolve.
 
     Returns:
-        filled_path (list): List of steps in the path. Each step is a tuple looking like:
-            ('tig1_name', 'tig1_dir', 'tig2_name', 'tig2_dir', <mappy.Alignment object>),
-            where dirs are either "+" or "-". If <mappy.Alignment object> is None,
+        list: steps, list of steps in the path. Each step is a tuple looking like:
+            ('tig1_name', 'tig1_dir', 'tig2_name', 'tig2_dir', <Alignment object>),
+            where dirs are either "+" or "-". If <Alignment object> is None,
             scaffold by gap introduction.
-        all_edges (list): List of all edges that were formed.
+        bool: prepend, if the steps go before the steps of all previous
+            junctions in the path.
+        list: edges, all edges that were formed.
     '''
-    filled_path = []
-    all_edges = []
-    for junction in linkpath:
-        # Take a different route if there is a None in the junction
-        if junction.start and junction.target:
-            # Extract all sequences in this junction to a separate dict
-            to_overlap = {  junction.start[:-1]: trimmed_fasta[junction.start[:-1]], \
-                            junction.target[:-1]: trimmed_fasta[junction.target[:-1]]}
-            for conn in junction.connections:
-                to_overlap[conn] = trimmed_fasta[conn]
+    steps, prepend, edges = [], False, []
+
+    # Take a different route if there is a None in the junction
+    if junction.start and junction.target:
+        # Extract all sequences in this junction to a separate dict
+        to_overlap = {  junction.start[:-1]: overlapSequence(junction.start[:-1]), \
+                        junction.target[:-1]: overlapSequence(junction.target[:-1])}
+        for conn in junction.connections:
+            to_overlap[conn] = overlapSequence(conn)
+
+        ref_dir = "+" if junction.start[-1] == "e" else "-"
+        target_dir = "-" if junction.target[-1] == "e" else "+"
+
+        # Find which direction to traverse the graph in.
+        #if ref_dir == "-":
+        #    to_overlap[junction.start[:-1]] = nt.reverse_complement(to_overlap[junction.start[:-1]])
+
+        # Find all overlaps between sequences in question and if any are found,
+        # create an overlap graph to describe them.
+        edges = findOverlaps(to_overlap)
+        if edges:
+            graph = Overlapgraph(   set(to_overlap.keys()), \
+                                    set(edges), \
+                                    max_traversal)
+
+            # Find the path between start and target with the longest
+            # overlap distance
+            bestpath = graph.bestPath(  junction.start[:-1], ref_dir, \
+                                        junction.target[:-1], target_dir)
+
+            if bestpath is None:
+                # If no path, try to find incomplete paths
+                # Find partial paths starting from start
+                graph.traverse( junction.start[:-1], ref_dir, \
+                                junction.target[:-1], target_dir)
 
-            ref_dir = "+" if junction.start[-1] == "e" else "-"
-            target_dir = "-" if junction.target[-1] == "e" else "+"
+                # And also starting from target
+                def reverse_ori(ori):
+                    return "+" if ori == "-" else "-"
+
+                graph.traverse( junction.target[:-1], \
+                                reverse_ori(target_dir), \
+                                junction.start[:-1], \
+                                reverse_ori(ref_dir))
+                graph.resolve_incomplete_paths( junction.start[:-1], \
+                                                ref_dir, \
+                                                junction.target[:-1], \
+                                                target_dir)
+                bestpath = shortestPath(graph.incomplete_paths)
+
+            steps = bestpath
+        else:
+            # If no edges, put None at overlap and drop any connections
+            steps = [ (junction.start[:-1], ref_dir, \
+                        junction.target[:-1], target_dir, None) ]
 
+    # If there is a None in the junction
+    else:
+        if junction.start:
+            ref_dir = "+" if junction.start[-1] == "e" else "-"
             # Find which direction to traverse the graph in.
-            #if ref_dir == "-":
-            #    to_overlap[junction.start[:-1]] = nt.reverse_complement(to_overlap[junction.start[:-1]])
-
-            # Find all overlaps between sequences in question and if any are found,
-            # create an overlap graph to describe them.
+            to_overlap = {junction.start[:-1]: overlapSequence(junction.start[:-1], ref_dir)}
+            for conn in junction.connections:
+                to_overlap[conn] = overlapSequence(conn)
             edges = findOverlaps(to_overlap)
             if edges:
-                all_edges = all_edges + edges
                 graph = Overlapgraph(   set(to_overlap.keys()), \
-                                        set(edges))
+                                        set(edges), \
+                                        max_traversal)
 
-                # Try to find a path between start and target
-                # Partial paths are also saved in the graph
+                # Try to find partial paths extending from start
+                # We can use graph.traverse for this by defining a target
+                # that's not in the graph, i.e. complete paths will be
+                # impossible to find
                 graph.traverse( junction.start[:-1], ref_dir, \
-                                junction.target[:-1], target_dir)
+                                "not_a_target", "+")
 
-                if len(graph.paths) == 1:
-                    # If one path, use it right away
-                    bestpath = list(graph.paths)[0]
+                if graph.partial_paths:
+                    bestpath = shortestPath(graph.partial_paths)
+                    steps = bestpath
 
-                elif len(graph.paths) > 1:
-                    # If there is more than one path, find the shortest path
-                    bestpath = shortestPath(graph.paths)
+        elif junction.target:
+            # Same as above, except in the opposite direction
+            #target_dir = "-" if junction.target[-1] == "e" else "+"
+            target_dir = "+" if junction.target[-1] == "e" else "-"
+            to_overlap = {junction.target[:-1]: overlapSequence(junction.target[:-1], target_dir)}
+            for conn in junction.connections:
+                to_overlap[conn] = overlapSequence(conn)
+            edges = findOverlaps(to_overlap)
+            if edges:
+                graph = Overlapgraph(   set(to_overlap.keys()), \
+                                        set(edges), \
+                                        max_traversal)
+                graph.traverse( junction.target[:-1], target_dir, \
+                            "not_a_target", "+")
+                if graph.partial_paths:
+                    # If there is a partial_path, we need to reverse it
+                    # and add it to the beginning of filled_path
+                    reversed_paths = [graph.reverse_path(path) for path in graph.partial_paths]
+                    # Remove None's, in separate step to avoid calculating
+                    # non-existent paths twice
+                    reversed_paths = [p for p in reversed_paths if p]
+
+                    if reversed_paths:
+                        bestpath = shortestPath(reversed_paths)
+                        steps, prepend = bestpath, True
+
+    return steps, prepend, edges
+
+def joinJunctions(resolved):
+    '''Join the output of resolveJunction for all junctions of a path, in
+    path order, to a path where each step is a tuple describing the
+    potential overlap.
+    '''
+    filled_path = []
+    all_edges = []
+    for steps, prepend, edges in resolved:
+        filled_path = steps + filled_path if prepend else filled_path + steps
+        all_edges = all_edges + edges
+    return filled_path, all_edges
 
-                else:
-                    # If no path, try to find incomplete paths
-                    # Find partial paths also starting from target
-                    def reverse_ori(ori):
-                        return "+" if ori == "-" else "-"
-
-                    graph.traverse( junction.target[:-1], \
-                                    reverse_ori(target_dir), \
-                                    junction.start[:-1], \
-                                    reverse_ori(ref_dir))
-                    graph.resolve_incomplete_paths( junction.start[:-1], \
-                                                    ref_dir, \
-                                                    junction.target[:-1], \
-                                                    target_dir)
-                    bestpath = shortestPath(graph.incomplete_paths)
-
-                filled_path.extend(bestpath)
-            else:
-                # If no edges, put None at overlap and drop any connections
-                filled_path.append( (junction.start[:-1], ref_dir, \
-                                    junction.target[:-1], target_dir, None))
+def combine_paths(linkpath):
+    '''Find if each junction in linkpath can be merged by alignment or gap
+    introduction. Return a path where each step is a tuple describing the
+    potential overlap.
 
-        # If there is a None in the junction
-        else:
-            if junction.start:
-                to_overlap = {junction.start[:-1]: trimmed_fasta[junction.start[:-1]]}
-                for conn in junction.connections:
-                    to_overlap[conn] = trimmed_fasta[conn]
-                ref_dir = "+" if junction.start[-1] == "e" else "-"
-                # Find which direction to traverse the graph in.
-                if ref_dir == "-":
-                    to_overlap[junction.start[:-1]] = nt.reverse_complement(to_overlap[junction.start[:-1]])
-                edges = findOverlaps(to_overlap)
-                if edges:
-                    all_edges = all_edges + edges
-                    graph = Overlapgraph(   set(to_overlap.keys()), \
-                                            set(edges))
-
-                    # Try to find partial paths extending from start
-                    # We can use graph.traverse for this by defining a target
-                    # that's not in the graph, i.e. complete paths will be
-                    # impossible to find
-                    graph.traverse( junction.start[:-1], ref_dir, \
-                                    "not_a_target", "+")
-
-                    if graph.partial_paths:
-                        bestpath = shortestPath(graph.partial_paths)
-                        filled_path.extend(bestpath)
-
-            elif junction.target:
-                # Same as above, except in the opposite direction
-                to_overlap = {junction.target[:-1]: trimmed_fasta[junction.target[:-1]]}
-                for conn in junction.connections:
-                    to_overlap[conn] = trimmed_fasta[conn]
-                #target_dir = "-" if junction.target[-1] == "e" else "+"
-                target_dir = "+" if junction.target[-1] == "e" else "-"
-                if target_dir == "-":
-                    to_overlap[junction.target[:-1]] = nt.reverse_complement(to_overlap[junction.target[:-1]])
-                edges = findOverlaps(to_overlap)
-                if edges:
-                    all_edges = all_edges + edges
-                    graph = Overlapgraph(   set(to_overlap.keys()), \
-                                            set(edges))
-                    graph.traverse( junction.target[:-1], target_dir, \
-                                "not_a_target", "+")
-                    if graph.partial_paths:
-                        # If there is a partial_path, we need to reverse it
-                        # and add it to the beginning of filled_path
-                        reversed_paths = [graph.reverse_path(path) for path in graph.partial_paths]
-                        # Remove None's, in separate step to avoid calculating
-                        # non-existent paths twice
-                        reversed_paths = [p for p in reversed_paths if p]
-
-                        if reversed_paths:
-                            bestpath = shortestPath(reversed_paths)
-                            filled_path = bestpath + filled_path
+    Args:
+        linkpath (list): list of graph_building.Junction objects to be combined
+            into a scaffold.
 
-    return filled_path, all_edges
+    Returns:
+        filled_path (list): List of steps in the path. Each step is a tuple looking like:
+            ('tig1_name', 'tig1_dir', 'tig2_name', 'tig2_dir', <Alignment object>),
+            where dirs are either "+" or "-". If <Alignment object> is None,
+            scaffold by gap introduction.
+        all_edges (list): List of all edges that were formed.
+    '''
+    return joinJunctions([resolveJunction(junction) for junction in linkpath])
 
-def build_scaffolds(paths, gapsize):
-    scaffold_sequences, scaffold_correspondences = {}, {}
-    all_edges = []
+def build_scaffolds(paths, gapsize, writer):
+    '''Create a scaffold from each path and write it with writer.
+
+    Returns:
+        set: used_contigs, names of contigs put into scaffolds.
+        int: n_gaps, number of gaps.
+        int: n_merges, number of aligned merges.
+    '''
+    used_contigs = set()
     n_gaps, n_merges = 0,0
     misc.printstatus("Number of paths: "+str(len(paths)))
-    bed = {} # To collect bed coordinates
 
     for idx, path in enumerate(paths):
         misc.printstatusFlush("[ SCAFFOLDING ]\t" + misc.reportProgress(idx+1, len(paths)))
 
-        # Collect all relevant sequences from fasta
-        linked_contigs = [ [junction.start[:-1], junction.target[:-1]] + \
-                            junction.connections for junction in path \
-                            if junction.start and junction.target]
-        linked_contigs = [ step for partial_path in linked_contigs for step in partial_path]
-
         # Start overlapping
         filled_path, edges = combine_paths(path)
         # It is possible that there is no filled_path, in the case that the
         # path had a single junction which had a None at junction.start or
         # junction.target and no overlaps were found. In this case, continue.
         if filled_path:
-            all_edges.extend(edges)
-
             # Create scaffold
             scaffold_sequence, included, ng, nm, bed_coords = mergeSeq(filled_path, gapsize)
-            scaffold_sequences["scaffold_"+str(idx)] = scaffold_sequence
-            scaffold_correspondences["scaffold_"+str(idx)] = included
-            bed["scaffold_"+str(idx)] = bed_coords
+            writer.write("scaffold_"+str(idx), scaffold_sequence, included, bed_coords)
+            used_contigs.update(included)
             n_gaps += ng
             n_merges += nm
 
     misc.printstatus("[ SCAFFOLDING ]\t" + misc.reportProgress(idx+1, len(paths)))
 
-    return scaffold_sequences, scaffold_correspondences, all_edges, n_gaps, n_merges, bed
+    return used_contigs, n_gaps, n_merges
 
 def process_scaffold(path):
+    return mergeResolved([resolveJunction(junction) for junction in path])
+
+def mergeResolved(resolved):
+    '''Create a scaffold from the resolved junctions of a path.
+
+    Args:
+        resolved (list): resolveJunction output of each junction, in path order.
+    Returns:
+        tuple: mergeSeq output, or None if there is nothing to merge.
+    '''
     gapsize = 100
-    # Collect all relevant sequences from fasta
-    linked_contigs = [ [junction.start[:-1], junction.target[:-1]] + \
-                        junction.connections for junction in path \
-                        if junction.start and junction.target]
-    linked_contigs = [ step for partial_path in linked_contigs for step in partial_path]
-
-    # Start overlapping
-    filled_path, edges = combine_paths(path)
+
+    filled_path, edges = joinJunctions(resolved)
     # It is possible that there is no filled_path, in the case that the
     # path had a single junction which had a None at junction.start or
     # junction.target and no overlaps were found. In this case, continue.
     if filled_path:
-        #all_edges.extend(edges)
-
         # Create scaffold
         scaffold_sequence, included, ng, nm, bed_coords = mergeSeq(filled_path, gapsize)
         return (scaffold_sequence, included, ng, nm, bed_coords)
 
-def mp_build_scaffolds(paths, gapsize, n_proc):
-    scaffold_sequences, scaffold_correspondences = {}, {}
-    all_edges = []
-    n_gaps, n_merges = 0,0
-    misc.printstatus("Number of paths: "+str(len(paths)))
-    bed = {} # To collect bed coordinates
+def estimateCost(path):
+    '''Estimate the cost of creating a scaffold from path, in bases.
 
-    pool = multiprocessing.Pool(n_proc)
-    result = pool.map_async(process_scaffold, paths)
+    Description:
+        Scaffolding time is dominated by findOverlaps, which aligns every
+        pair of contigs in a junction once. The cost of a pair is taken as
+        the summed length of both contigs, or of their ends if
+        overlap_window is set. Merging adds the length of every contig.
 
-    while not result.ready():
-        misc.printstatusFlush("[ SCAFFOLDING ]\t" + misc.reportProgress(len(paths)-result._number_left, len(paths)))
-        time.sleep(4)
+    Args:
+        path (list): graph_building.Junction objects.
+    Returns:
+        int: estimated cost.
+    '''
+    def searchedLength(tig):
+        ctg_len = trimmed_fasta.length(tig)
+        return min(ctg_len, 2 * overlap_window) if overlap_window else ctg_len
+
+    cost = 0
+    for junction in path:
+        tigs = [node[:-1] for node in [junction.start, junction.target] if node] \
+                + junction.connections
+        # Each contig is in one pair with every other contig
+        cost += (len(tigs) - 1) * sum(searchedLength(tig) for tig in tigs)
+        cost += sum(trimmed_fasta.length(tig) for tig in tigs)
+    return cost
+
+def processTasks(tasks):
+    '''Run a batch of scaffolding tasks and time each of them.
 
-    # Get the result and remove Nones.
-    mp_output = [i for i in result.get() if i]
-    misc.printstatus("[ SCAFFOLDING ]\t" + misc.reportProgress(len(paths), len(paths)))
+    Args:
+        tasks (list): (key, argument) tuples. Keys look like
+            ("path", path index): create a scaffold from the path argument,
+            ("junction", path index, junction index): resolve the junction
+            argument, or ("merge", path index): create a scaffold from the
+            resolved junctions argument.
+    Returns:
+        list: (key, output, seconds) tuples.
+    '''
+    results = []
+    for key, argument in tasks:
+        start = time.perf_counter()
+        if key[0] == "path":
+            output = process_scaffold(argument)
+        elif key[0] == "junction":
+            output = resolveJunction(argument)
+        else:
+            output = mergeResolved(argument)
+        results.append( (key, output, time.perf_counter() - start) )
+    return results
+
+def mp_build_scaffolds(paths, gapsize, n_proc, writer, buffer_size = None, \
+                        batch_size = 8, cost_log = None):
+    '''Create scaffolds from paths in n_proc processes and write them with
+    writer in path order.
+
+    Description:
+        Paths with more than one junction are split into one task per
+        junction, since junctions are resolved independently, and a merge
+        task that runs mergeSeq once all junctions of the path are resolved.
+        Other paths are one task each. Only the paths within buffer_size of
+        the next path to write are dispatched, so the parent only keeps the
+        scaffolds of that window that finished out of order.
+
+        Merge tasks are dispatched first. Otherwise the most expensive tasks
+        are dispatched first, as estimated by estimateCost, while cheap
+        single junction paths are dispatched in batches. When half of the
+        window is waiting to be written, the tasks of the next path to write
+        are dispatched first. Scaffolds are named by a counter over the paths
+        that gave a scaffold.
+
+        Paths with a cost above the heavy_path_quantile of all paths are
+        also entered at the start, wherever they are in the path order, so
+        that a heavy path late in the order does not run alone after all
+        other paths are written. At most buffer_size paths are entered
+        early, the most expensive first.
 
-    # Unpack multiprocessing data results
-    for idx, dat in enumerate(mp_output):
-        scaffold_sequence, included, ng, nm, bed_coords = dat[0], dat[1], dat[2], dat[3], dat[4]
-        scaffold_sequences["scaffold_"+str(idx)] = scaffold_sequence
-        scaffold_correspondences["scaffold_"+str(idx)] = included
-        bed["scaffold_"+str(idx)] = bed_coords
-        n_gaps += ng
-        n_merges += nm
+    Args:
+        buffer_size (int): Maximum number of paths in the pool or waiting to
+            be written, besides the heavy paths entered at the start.
+            Defaults to 4 * n_proc.
+        batch_size (int): Maximum number of cheap paths per task.
+        cost_log (str): If given, the predicted cost and the summed time of
+            the tasks of every path are written to this file.
+    Returns:
+        set: used_contigs, names of contigs put into scaffolds.
+        int: n_gaps, number of gaps.
+        int: n_merges, number of aligned merges.
+    '''
+    used_contigs = set()
+    n_gaps, n_merges = 0,0
+    n_scaffolds = 0
+    misc.printstatus("Number of paths: "+str(len(paths)))
+    buffer_size = 4 * n_proc if buffer_size is None else buffer_size
+    max_tasks = 2 * n_proc # Tasks in the pool at a time
+
+    # Paths with a single junction and at most the median cost are cheap
+    costs = [estimateCost(path) for path in paths]
+    median_cost = sorted(costs)[len(costs) // 2] if costs else 0
+    cheap = [len(path) == 1 and cost <= median_cost for path, cost in zip(paths, costs)]
+    heavy_cost = sorted(costs)[int(len(costs) * heavy_path_quantile)] if costs else 0
+    heavy = sorted([idx for idx, cost in enumerate(costs) if cost > heavy_cost], \
+                    key=lambda idx: (-costs[idx], idx))[:buffer_size]
+
+    log = open(cost_log, "w") if cost_log else None
+    if log:
+        log.write("path\tjunctions\tpredicted_cost\tseconds\n")
+
+    finished = queue.Queue() # Results of tasks, put by the pool
+    ready = {} # Tasks that can be dispatched {key: cost}
+    resolved = {} # Resolved junctions of split paths {idx: [resolved, ...]}
+    n_unresolved = {} # Junctions left to resolve in split paths {idx: int}
+    seconds = {} # Summed time of the finished tasks of each path {idx: float}
+    done = {} # Finished paths that are not written yet {idx: scaffold}
+    entered = set() # Paths whose tasks have been created
+    n_entered = 0 # Paths that have entered the window
+    n_tasks = 0
+    next_write = 0
+
+    def enterPath(idx):
+        '''Create the tasks of a path.
+        '''
+        if len(paths[idx]) > 1:
+            resolved[idx] = [None] * len(paths[idx])
+            n_unresolved[idx] = len(paths[idx])
+            for j, junction in enumerate(paths[idx]):
+                ready[("junction", idx, j)] = estimateCost([junction])
+        else:
+            ready[("path", idx)] = costs[idx]
+        entered.add(idx)
+
+    for idx in heavy:
+        enterPath(idx)
+
+    with multiprocessing.Pool(n_proc) as pool:
+        while next_write < len(paths):
+            # Create the tasks of paths entering the window
+            while n_entered < min(next_write + buffer_size, len(paths)):
+                if n_entered not in entered:
+                    enterPath(n_entered)
+                n_entered += 1
+
+            # Fill the pool
+            while n_tasks < max_tasks and ready:
+                merges = [key for key in ready if key[0] == "merge"]
+                head = [key for key in ready if key[1] == next_write]
+                if merges:
+                    batch = [min(merges)]
+                elif head and len(done) >= buffer_size // 2:
+                    batch = [max(head, key=ready.get)]
+                else:
+                    batch = [max(ready, key=ready.get)]
+                    if batch[0][0] == "path" and cheap[batch[0][1]]:
+                        batch += sorted([   key for key in ready if key[0] == "path" \
+                                            and cheap[key[1]] and key != batch[0]])[:batch_size-1]
+
+                tasks = []
+                for key in batch:
+                    del ready[key]
+                    if key[0] == "path":
+                        tasks.append( (key, paths[key[1]]) )
+                    elif key[0] == "junction":
+                        tasks.append( (key, paths[key[1]][key[2]]) )
+                    else:
+                        tasks.append( (key, resolved.pop(key[1])) )
+                pool.apply_async(   processTasks, (tasks,), \
+                                    callback=finished.put, \
+                                    error_callback=finished.put)
+                n_tasks += 1
+
+            # Wait for a task to finish
+            results = finished.get()
+            n_tasks -= 1
+            if isinstance(results, BaseException):
+                raise results
+            for key, output, sec in results:
+                idx = key[1]
+                seconds[idx] = seconds.get(idx, 0) + sec
+                if key[0] == "junction":
+                    resolved[idx][key[2]] = output
+                    n_unresolved[idx] -= 1
+                    if n_unresolved[idx] == 0:
+                        # All junctions resolved, the path can be merged
+                        del n_unresolved[idx]
+                        ready[("merge", idx)] = costs[idx]
+                else:
+                    done[idx] = output
+                    if log:
+                        log.write("{0}\t{1}\t{2}\t{3:.3f}\n".format(idx, len(paths[idx]), \
+                                    costs[idx], seconds[idx]))
+                    del seconds[idx]
+
+            # Write every scaffold that is next in order
+            while next_write in done:
+                dat = done.pop(next_write)
+                next_write += 1
+                misc.printstatusFlush("[ SCAFFOLDING ]\t" + misc.reportProgress(next_write, len(paths)))
+
+                # Paths without a scaffold give None
+                if dat:
+                    scaffold_sequence, included, ng, nm, bed_coords = dat
+                    writer.write("scaffold_"+str(n_scaffolds), scaffold_sequence, included, bed_coords)
+                    n_scaffolds += 1
+                    used_contigs.update(included)
+                    n_gaps += ng
+                    n_merges += nm
+
+    if log:
+        log.close()
+    misc.printstatus("[ SCAFFOLDING ]\t" + misc.reportProgress(len(paths), len(paths)))
 
-    return scaffold_sequences, scaffold_correspondences, all_edges, n_gaps, n_merges, bed
+    return used_contigs, n_gaps, n_merges
 
-def main(input_fasta, input_bam, paths, mincov, gapsize, n_proc):
+def main(input_fasta, input_bam, paths, mincov, gapsize, n_proc, outfilename, \
+        window = 0, traversal_cap = 100000):
     '''Controller for merge_fasta.
 
     Args:
@@ -989,56 +1463,63 @@ def main(input_fasta, input_bam, paths, mincov, gapsize, n_proc):
         mincov (int): Minimum average coverage for trimming.
         gapsize (int): Gap size when scaffolding by gap introduction.
         n_proc (int): Number of processes to run during scaffolding.
-    Returns:
-        dict: scaffolded fasta to output. Keys: fasta headers. Values: the
-            resulting sequence.
-        dict: correspondence, which contigs went into which scaffold.
+        outfilename (str): Prefix of the fasta, correspondence and bed
+            outputs, which are written while scaffolding.
+        window (int): Number of bases at each contig end to search for
+            overlaps in. 0 uses the whole contigs.
+        traversal_cap (int): Maximum number of extensions per overlap graph
+            traversal.
     '''
 
     global samfile
     global fastafile
+    global overlap_window
+    global max_traversal
+    overlap_window = window
+    max_traversal = traversal_cap
     fastafile = pysam.FastaFile(input_fasta)
     samfile = pysam.AlignmentFile(input_bam, "rb")
 
     # Get trim coordinates based on read mappings in samfile
     misc.printstatus("Trimming contig ends...")
-    trimmed_fasta_coords = trimSequences(paths, mincov)
+    trimmed_fasta_coords = trimSequences(paths, mincov, n_proc, input_bam)
 
-    # Trim fasta
+    # Trim fasta into a contig store shared by all scaffolding processes
     global trimmed_fasta
-    trimmed_fasta = {}
+    trimmed_fasta = nt.ContigStore( {tig: trimmed_fasta_coords[tig][1] - trimmed_fasta_coords[tig][0] \
+                                    for tig in samfile.references}, \
+                                    os.path.dirname(os.path.abspath(outfilename)))
     for tig in samfile.references:
-        trimmed_fasta[tig] = fastafile.fetch(reference=tig, \
-                                             start=trimmed_fasta_coords[tig][0], \
-                                             end=trimmed_fasta_coords[tig][1])
+        trimmed_fasta.write(tig, fastafile.fetch(reference=tig, \
+                                                start=trimmed_fasta_coords[tig][0], \
+                                                end=trimmed_fasta_coords[tig][1]))
+    reverseComplementContig.cache_clear()
     samfile.close()
     fastafile.close()
 
     # Start finding overlaps
     misc.printstatus("Creating scaffolds...")
 
-    if n_proc == 1:
-        scaffold_sequences, scaffold_correspondences, all_edges, \
-        n_gaps, n_merges, bed = build_scaffolds(paths, gapsize)
-    else:
-        scaffold_sequences, scaffold_correspondences, all_edges, \
-        n_gaps, n_merges, bed = mp_build_scaffolds(paths, gapsize, n_proc)
+    try:
+        misc.printstatus("Writing merged fasta to {0}.fasta".format(outfilename))
+        with formatting_tools.ScaffoldWriter(outfilename) as writer:
+            if n_proc == 1:
+                used_contigs, n_gaps, n_merges = build_scaffolds(paths, gapsize, writer)
+            else:
+                used_contigs, n_gaps, n_merges = mp_build_scaffolds(paths, gapsize, n_proc, writer, \
+                                                    cost_log=outfilename+".scaffolding_costs.tsv")
 
-    all_edges = [edge for ls in all_edges for edge in ls]
+            misc.printstatus("Scaffolding completed.")
+            misc.printstatus("Number of aligned merges: {}".format(str(n_merges)))
+            misc.printstatus("Number of gaps introduced: {}".format(str(n_gaps)))
 
-    misc.printstatus("Scaffolding completed.")
-    misc.printstatus("Number of aligned merges: {}".format(str(n_merges)))
-    misc.printstatus("Number of gaps introduced: {}".format(str(n_gaps)))
-    #complete_overlap_graph = Overlapgraph(list(trimmed_fasta.keys()), all_edges)
-    #writeGfa(complete_overlap_graph)
+            # Write contigs that were not put into a scaffold
+            misc.printstatus("Collecting leftover sequences.")
+            leftover_contigs = [ ctg for ctg in trimmed_fasta.keys() if ctg not in used_contigs ]
 
-    # Collect contigs that were not put into a scaffold
-    misc.printstatus("Collecting leftover sequences.")
-    used_contigs = [ tig for value in scaffold_correspondences.values() for tig in value]
-    leftover_contigs = [ ctg for ctg in trimmed_fasta.keys() if ctg not in used_contigs ]
+            for idx,tig in enumerate(leftover_contigs):
+                writer.write("unplaced_contig_"+str(idx), trimmed_fasta.sequence(tig), [tig])
+    finally:
+        trimmed_fasta.close()
 
-    for idx,tig in enumerate(leftover_contigs):
-        scaffold_sequences["unplaced_contig_"+str(idx)] = trimmed_fasta[tig]
-        scaffold_correspondences["unplaced_contig_"+str(idx)] = [tig]
 
-    return scaffold_sequences, scaffold_correspondences, bed
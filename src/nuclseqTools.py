@@ -6,22 +6,366 @@ Copyright (c) 2020, Markus Hiltunen
 Licensed under the GPL3 license. See LICENSE file.
 """
 
+import mmap
+import os
+import tempfile
+
+import numpy as np
+
+# Complements of the IUPAC nucleotide codes, in both cases
+COMPLEMENT = str.maketrans( "ACGTUMRWSYKVHDBNacgtumrwsykvhdbn", \
+                            "TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn")
+
 def reverse_complement(nuclstring):
     '''Reverse complement argument nucleotide string.
+
+    Description:
+        All IUPAC codes are complemented and case is preserved. Other
+        characters, such as gaps, are kept as they are.
+    '''
+    return nuclstring.translate(COMPLEMENT)[::-1]
+
+class SequenceBuilder:
+    '''Builds a long nucleotide string from chunks.
+
+    Description:
+        Appending and removing bases at the end only touches the last
+        chunks, instead of copying the whole sequence built so far. The
+        chunks are joined once when the sequence is needed.
+    '''
+    def __init__(self, nuclstring = ""):
+        self.chunks = [] # Nucleotide strings, in order
+        self.length = 0
+        self.append(nuclstring)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.getvalue()
+
+    def append(self, nuclstring):
+        '''Add nuclstring to the end of the sequence.
+        '''
+        if nuclstring:
+            self.chunks.append(nuclstring)
+            self.length += len(nuclstring)
+
+    def truncate(self, n_bases):
+        '''Remove n_bases from the end of the sequence.
+        '''
+        while n_bases > 0 and self.chunks:
+            last = self.chunks[-1]
+            if len(last) <= n_bases:
+                self.chunks.pop()
+                self.length -= len(last)
+                n_bases -= len(last)
+            else:
+                self.chunks[-1] = last[:-n_bases]
+                self.length -= n_bases
+                n_bases = 0
+
+    def tail(self, n_bases):
+        '''Returns the last n_bases of the sequence as a string.
+        '''
+        tail_chunks, tail_len = [], 0
+        for chunk in reversed(self.chunks):
+            if tail_len >= n_bases:
+                break
+            tail_chunks.append(chunk)
+            tail_len += len(chunk)
+        tail = "".join(reversed(tail_chunks))
+        return tail[max(0, len(tail) - n_bases):]
+
+    def getvalue(self):
+        '''Returns the whole sequence as a string.
+        '''
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
+# 2-bit codes of the bases, and the bases of the codes
+BASE_CODES = np.zeros(256, dtype=np.uint8)
+for code, base in enumerate("ACGT"):
+    BASE_CODES[ord(base)] = BASE_CODES[ord(base.lower())] = code
+IS_BASE = np.zeros(256, dtype=bool)
+IS_BASE[[ord(base) for base in "ACGTacgt"]] = True
+IS_LOWER = np.zeros(256, dtype=bool)
+IS_LOWER[ord("a"):ord("z")+1] = True
+CODE_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+COMPLEMENT_BYTES = np.frombuffer(bytes(range(256)).decode("latin-1").translate(COMPLEMENT).encode("latin-1"), \
+                                dtype=np.uint8)
+SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8) # Bit positions of the bases in a byte
+BYTE_CODES = (np.arange(256, dtype=np.uint8)[:,None] >> SHIFTS) & 3 # Codes of each packed byte
+BYTE_BASES = CODE_BASES[BYTE_CODES] # Uppercase bases of each packed byte
+# Packed byte holding the reverse complement of the bases of each packed byte
+BYTE_REVCOMP = np.bitwise_or.reduce((3 - BYTE_CODES[:,::-1]) << SHIFTS, axis=1).astype(np.uint8)
+
+def findRuns(mask, values = None):
+    '''Find runs of True in mask, also split where values change.
+
+    Returns:
+        np.array: starts of the runs
+        np.array: ends of the runs, exclusive
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    change = np.diff(mask.astype(np.int8), prepend=0, append=0) != 0
+    if values is not None and len(values) > 1:
+        # Also start a new run where the value changes within a run
+        value_change = np.zeros(len(mask)+1, dtype=bool)
+        value_change[1:-1] = (values[1:] != values[:-1]) & mask[1:] & mask[:-1]
+        change |= value_change
+    bounds = np.flatnonzero(change)
+    # Runs of False between runs of True are dropped
+    starts = bounds[:-1][mask[bounds[:-1]]] if len(bounds) > 0 else bounds
+    ends = bounds[1:][mask[bounds[:-1]]] if len(bounds) > 0 else bounds
+    return starts.astype(np.int64), ends.astype(np.int64)
+
+def coveredPositions(starts, ends):
+    '''Returns all positions within the runs from starts to ends.
+    '''
+    lengths = ends - starts
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
+
+class PackedSequence:
+    '''Nucleotide sequence stored at 2 bits per base.
+
+    Description:
+        ACGT are packed four bases per byte. Other characters, e.g. N and
+        IUPAC codes, are kept in a side table of runs of the same character,
+        and lowercase bases in a table of lowercase runs. Slices share the
+        packed bytes of the sequence they are taken from. Decode to str or
+        bytes only where a string is needed.
+    '''
+    def __init__(   self, data, length, offset = 0, \
+                    other_starts = None, other_ends = None, other_chars = None, \
+                    lower_starts = None, lower_ends = None):
+        empty = np.zeros(0, dtype=np.int64)
+        self.data = data # Packed bytes, np.uint8
+        self.length = length
+        self.offset = offset # Position of the first base in data
+        self.other_starts = empty if other_starts is None else other_starts
+        self.other_ends = empty if other_ends is None else other_ends
+        self.other_chars = np.zeros(0, dtype=np.uint8) if other_chars is None else other_chars
+        self.lower_starts = empty if lower_starts is None else lower_starts
+        self.lower_ends = empty if lower_ends is None else lower_ends
+
+    @classmethod
+    def fromString(cls, nuclstring):
+        '''Pack nuclstring, a str or bytes.
+        '''
+        if isinstance(nuclstring, str):
+            nuclstring = nuclstring.encode("ascii")
+        seq = np.frombuffer(nuclstring, dtype=np.uint8)
+        other = ~IS_BASE[seq]
+        other_starts, other_ends = findRuns(other, seq)
+        lower_starts, lower_ends = findRuns(IS_LOWER[seq])
+        return cls( packCodes(BASE_CODES[seq]), len(seq), 0, \
+                    other_starts, other_ends, seq[other_starts], \
+                    lower_starts, lower_ends)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.decode()
+
+    def __getitem__(self, key):
+        '''Slice the sequence. Only slices with step 1 are supported.
+        '''
+        start, stop, step = key.indices(self.length)
+        if step != 1:
+            raise ValueError("PackedSequence slices must have step 1.")
+        stop = max(start, stop)
+
+        # Keep the packed bytes that hold the slice
+        first = self.offset + start
+        data = self.data[first // 4:(self.offset + stop + 3) // 4]
+
+        def sliceRuns(starts, ends):
+            keep = slice(np.searchsorted(ends, start, side="right"), \
+                        np.searchsorted(starts, stop, side="left"))
+            return  np.clip(starts[keep], start, stop) - start, \
+                    np.clip(ends[keep], start, stop) - start, keep
+
+        other_starts, other_ends, keep = sliceRuns(self.other_starts, self.other_ends)
+        lower_starts, lower_ends, _ = sliceRuns(self.lower_starts, self.lower_ends)
+        return PackedSequence(  data, stop - start, first % 4, \
+                                other_starts, other_ends, self.other_chars[keep], \
+                                lower_starts, lower_ends)
+
+    def codes(self):
+        '''Returns the 2-bit code of every base.
+        '''
+        return BYTE_CODES[self.data].reshape(-1)[self.offset:self.offset + self.length]
+
+    def reverse_complement(self):
+        '''Returns the reverse complement, with case preserved.
+        '''
+        # Reversing the bytes moves the unused bases after the end to the start
+        offset = (-(self.offset + self.length)) % 4
+        return PackedSequence(  BYTE_REVCOMP[self.data[::-1]], self.length, offset, \
+                                (self.length - self.other_ends)[::-1], \
+                                (self.length - self.other_starts)[::-1], \
+                                COMPLEMENT_BYTES[self.other_chars][::-1], \
+                                (self.length - self.lower_ends)[::-1], \
+                                (self.length - self.lower_starts)[::-1])
+
+    def tobytes(self):
+        '''Decode to bytes.
+        '''
+        seq = BYTE_BASES[self.data].reshape(-1)[self.offset:self.offset + self.length]
+        seq[coveredPositions(self.lower_starts, self.lower_ends)] += 32 # To lowercase
+        seq[coveredPositions(self.other_starts, self.other_ends)] = \
+                np.repeat(self.other_chars, self.other_ends - self.other_starts)
+        return seq.tobytes()
+
+    def decode(self):
+        '''Decode to str.
+        '''
+        return self.tobytes().decode("ascii")
+
+class ReverseComplementView:
+    '''Reverse complement of a PackedSequence, computed only for the
+    slices taken from it.
+    '''
+    def __init__(self, packed):
+        self.packed = packed # Forward sequence
+
+    def __len__(self):
+        return self.packed.length
+
+    def __str__(self):
+        return self.decode()
+
+    def __getitem__(self, key):
+        '''Slice the reverse complement. Returns a PackedSequence.
+        '''
+        start, stop, step = key.indices(self.packed.length)
+        if step != 1:
+            raise ValueError("ReverseComplementView slices must have step 1.")
+        stop = max(start, stop)
+        return self.packed[self.packed.length - stop:self.packed.length - start].reverse_complement()
+
+    def decode(self):
+        '''Decode the whole reverse complement to str.
+        '''
+        return self.packed.reverse_complement().decode()
+
+def packCodes(codes):
+    '''Pack an array of 2-bit codes four per byte.
+    '''
+    padded = np.zeros((len(codes) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    return np.bitwise_or.reduce(padded.reshape(-1, 4) << SHIFTS, axis=1).astype(np.uint8)
+
+class ContigStore:
+    '''Contig sequences in one memory mapped buffer.
+
+    Description:
+        Sequences are packed to 2 bits per base as in PackedSequence and
+        stored back to back in a temporary file that is memory mapped, and
+        an offset table gives where each sequence starts. The side tables of
+        other characters and lowercase runs are kept with the store.
+        Processes forked after the store is created share the mapping, and a
+        pickled store attaches to the same file, so the sequences are only
+        in memory once regardless of the number of processes. Slices are
+        returned as PackedSequence views of the buffer, or decoded to str
+        where a string is needed.
     '''
-    rev_comped = ""
-    for l in reversed(nuclstring):
-        if l == "A" or l == "a":
-            rev_comped += "T"
-        elif l == "T" or l == "t":
-            rev_comped += "A"
-        elif l == "C" or l == "c":
-            rev_comped += "G"
-        elif l == "G" or l == "g":
-            rev_comped += "C"
-        elif l == "N" or l == "n":
-            rev_comped += "N"
-    return rev_comped
+    def __init__(self, lengths, directory = None):
+        '''
+        Args:
+            lengths (dict): Keys: contig names, values: sequence lengths.
+            directory (str): Where to create the buffer file. Defaults to
+                the system temporary directory.
+        '''
+        self.names = list(lengths.keys())
+        self.index = {name:idx for idx, name in enumerate(self.names)}
+        self.lengths = np.array(list(lengths.values()), dtype=np.int64)
+        # Byte offsets of the packed sequences
+        self.offsets = np.zeros(len(self.names)+1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum((self.lengths + 3) // 4)
+        self.side_tables = {} # {name: PackedSequence without packed bytes}
+
+        fd, self.path = tempfile.mkstemp(prefix="contigs.", suffix=".mmap", dir=directory)
+        size = max(1, int(self.offsets[-1])) # Empty maps are not allowed
+        os.ftruncate(fd, size)
+        self.buffer = mmap.mmap(fd, size)
+        os.close(fd)
+        self.owner = True # Only the creating process removes the file
+
+    def __getstate__(self):
+        return {"names": self.names, "lengths": self.lengths, "offsets": self.offsets, \
+                "side_tables": self.side_tables, "path": self.path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.index = {name:idx for idx, name in enumerate(self.names)}
+        with open(self.path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.owner = False
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def keys(self):
+        return self.names
+
+    def length(self, name):
+        '''Returns the length of the sequence of name.
+        '''
+        return int(self.lengths[self.index[name]])
+
+    def write(self, name, nuclstring):
+        '''Store nuclstring as the sequence of name.
+        '''
+        idx = self.index[name]
+        if len(nuclstring) != self.length(name):
+            raise ValueError("Sequence of {0} is {1} bases, expected {2}.".format( \
+                            name, len(nuclstring), self.length(name)))
+        packed = PackedSequence.fromString(nuclstring)
+        self.buffer[self.offsets[idx]:self.offsets[idx+1]] = packed.data.tobytes()
+        packed.data = None
+        self.side_tables[name] = packed
+
+    def packed(self, name, start = 0, end = None):
+        '''Returns the sequence of name, from start to end, as a
+        PackedSequence that shares the buffer.
+        '''
+        idx = self.index[name]
+        tables = self.side_tables[name]
+        data = np.frombuffer(   self.buffer, dtype=np.uint8, \
+                                count=int(self.offsets[idx+1] - self.offsets[idx]), \
+                                offset=int(self.offsets[idx]))
+        packed = PackedSequence(data, tables.length, 0, \
+                                tables.other_starts, tables.other_ends, tables.other_chars, \
+                                tables.lower_starts, tables.lower_ends)
+        if start == 0 and end is None:
+            return packed
+        return packed[start:end]
+
+    def sequence(self, name, start = 0, end = None):
+        '''Returns the sequence of name, from start to end, as str.
+        '''
+        return self.packed(name, start, end).decode()
+
+    def close(self):
+        '''Unmap the buffer, and remove its file if this process created it.
+        '''
+        try:
+            self.buffer.close()
+        except BufferError:
+            pass # Packed sequences still use the buffer, unmapped when freed
+        if self.owner and os.path.exists(self.path):
+            os.remove(self.path)
 
 # Deprecated
 def createConsensus(delta,string1,string2):
@@ -0,0 +1,198 @@
+"""Tests for merge_fasta.createConsensus and mp_build_scaffolds.
+
+Sequences are given in the orientation of the step, as mergeSeq passes them.
+Alignment reference coordinates are on the oriented reference, query
+coordinates on the forward query strand, as from mappy.
+"""
+
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import mappy as mp
+import pytest
+
+import merge_fasta
+import nuclseqTools as nt
+
+ORIENTATIONS = [("+", "+"), ("+", "-"), ("-", "+"), ("-", "-")]
+
+# (reference, query, r_st, query start, query end, cigar, consensus, ovl_len)
+# with both sequences oriented. Mismatches in matches show that matched
+# bases are taken from the reference.
+CASES = {
+    "match": ("TTGCAACGTACGT", "ACGAACGTGGCCA", 5, 0, 8, [[8, 0]], \
+                "ACGTACGTGGCCA", 8),
+    "insertions": ("TTGCAACGTACGT", "ACCTTTACAGTGGCCA", 5, 0, 11, \
+                [[3, 0], [2, 1], [3, 0], [1, 1], [2, 0]], \
+                "ACGTTTACAGTGGCCA", 11),
+    "deletions": ("TTGCAACGTACGTAC", "ACACGACGGCCA", 5, 0, 7, \
+                [[2, 0], [2, 2], [3, 0], [1, 2], [2, 0]], \
+                "ACGTACGTACGGCCA", 10),
+    "mixed": ("TTGCAACGTACGTAC", "GAACGCCCTATACGG", 5, 2, 13, \
+                [[3, 0], [3, 1], [2, 0], [2, 2], [3, 0]], \
+                "ACGCCCTACGTACGG", 13),
+}
+
+def makeStep(r_ori, q_ori, reference, query, r_st, q_st, q_en, cigar):
+    '''Returns the step and oriented sequences of an overlap given on the
+    oriented sequences.
+    '''
+    if q_ori == "-":
+        q_st, q_en = len(query) - q_en, len(query) - q_st
+    r_en = r_st + sum([length for length, op in cigar if op in (0, 2)])
+    aln = merge_fasta.Alignment(len(reference), r_st, r_en, q_st, q_en, \
+                                1 if q_ori == "+" else -1, 0, r_en - r_st, cigar)
+    return ("ref", r_ori, "query", q_ori, aln), reference, query
+
+def walkCigar(string1, string2, r_st, q_st, cigar):
+    '''Builds the consensus one cigar operation at a time. Matches and
+    deletions take reference bases, insertions query bases.
+    '''
+    output, ref_pos, query_pos = [], r_st, q_st
+    for length, op in cigar:
+        if op == 0:
+            output.append(string1[ref_pos:ref_pos+length])
+            ref_pos += length
+            query_pos += length
+        elif op == 1:
+            output.append(string2[query_pos:query_pos+length])
+            query_pos += length
+        elif op == 2:
+            output.append(string1[ref_pos:ref_pos+length])
+            ref_pos += length
+    ovl_len = len("".join(output))
+    return "".join(output) + string2[query_pos:], ovl_len
+
+@pytest.mark.parametrize("r_ori,q_ori", ORIENTATIONS)
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_consensus(case, r_ori, q_ori):
+    reference, query, r_st, q_st, q_en, cigar, consensus, ovl_len = CASES[case]
+    step, string1, string2 = makeStep(r_ori, q_ori, reference, query, r_st, q_st, q_en, cigar)
+
+    assert merge_fasta.createConsensus(step, string1, string2, 100) == (consensus, False, ovl_len)
+
+@pytest.mark.parametrize("r_ori,q_ori", ORIENTATIONS)
+def test_no_overlap(r_ori, q_ori):
+    step = ("ref", r_ori, "query", q_ori, None)
+
+    assert merge_fasta.createConsensus(step, "ACGT", "GGCC", 5) == ("NNNNNGGCC", True, 0)
+    assert merge_fasta.createConsensus(step, "ACGT", "", 5) == ("NNNNN", True, 0)
+
+@pytest.mark.parametrize("r_ori,q_ori", ORIENTATIONS)
+def test_zero_length_overlap(r_ori, q_ori):
+    step, string1, string2 = makeStep(r_ori, q_ori, "ACGT", "GGCC", 4, 0, 0, [])
+
+    assert merge_fasta.createConsensus(step, string1, string2, 100) == ("GGCC", False, 0)
+
+def mutate(seq, rate, rnd):
+    '''Adds insertions and deletions of 1-3 bases at the given rate.
+    '''
+    output = []
+    for base in seq:
+        draw = rnd.random()
+        if draw < rate:
+            continue
+        output.append(base)
+        if draw > 1 - rate:
+            output.append("".join(rnd.choice("ACGT") for _ in range(rnd.randint(1, 3))))
+    return "".join(output)
+
+@pytest.mark.parametrize("r_ori,q_ori", ORIENTATIONS)
+def test_indel_rich_alignments(r_ori, q_ori):
+    rnd = random.Random(5)
+    for _ in range(5):
+        overlap = "".join(rnd.choice("ACGT") for _ in range(rnd.randint(3000, 8000)))
+        string1 = "".join(rnd.choice("ACGT") for _ in range(2000)) + overlap
+        string2 = mutate(overlap, 0.05, rnd) + "".join(rnd.choice("ACGT") for _ in range(2000))
+        forward_query = string2 if q_ori == "+" else nt.reverse_complement(string2)
+
+        hits = [hit for hit in mp.Aligner(seq=string1, preset="map-pb").map(forward_query) \
+                if hit.strand == (1 if q_ori == "+" else -1)]
+        assert hits
+        aln = merge_fasta.fromMappy(max(hits, key=lambda hit: hit.blen))
+        assert any(op == 1 for _, op in aln.cigar) and any(op == 2 for _, op in aln.cigar)
+
+        q_st = aln.q_st if q_ori == "+" else len(string2) - aln.q_en
+        consensus, ovl_len = walkCigar(string1, string2, aln.r_st, q_st, aln.cigar)
+        assert merge_fasta.createConsensus(("ref", r_ori, "query", q_ori, aln), \
+                                            string1, string2, 100) \
+                == (consensus, False, ovl_len)
+        assert consensus.endswith(string2[aln.q_en if q_ori == "+" else len(string2) - aln.q_st:])
+
+# Number of scaffolding tasks started, shared with the pool processes
+started = None
+
+def sleepingScaffold(path):
+    '''Stands in for process_scaffold: records when the path started and
+    sleeps for its cost in hundredths of a second.
+    '''
+    with started.get_lock():
+        started.value += 1
+        order = started.value
+    kind, idx, cost = path[0]
+    time.sleep(cost / 100)
+    return ("ACGT", ["{0}{1}".format(kind, idx), order], 0, 0, [])
+
+class ListWriter:
+    '''Collects what mp_build_scaffolds writes.
+    '''
+    def __init__(self):
+        self.written = []
+
+    def write(self, name, sequence, included, bed_coords = None):
+        self.written.append(included)
+
+def test_late_heavy_path_starts_first(monkeypatch):
+    global started
+    context = multiprocessing.get_context("fork")
+    started = context.Value("i", 0)
+    monkeypatch.setattr(merge_fasta.multiprocessing, "Pool", context.Pool)
+    monkeypatch.setattr(merge_fasta, "estimateCost", lambda path: path[0][2])
+    monkeypatch.setattr(merge_fasta, "process_scaffold", sleepingScaffold)
+
+    # A heavy path near the end, far outside the window of 4 * n_proc paths
+    paths = [[("cheap", idx, 1)] for idx in range(40)]
+    paths[37] = [("heavy", 37, 50)]
+    writer = ListWriter()
+    merge_fasta.mp_build_scaffolds(paths, 100, 2, writer)
+
+    assert [included[0] for included in writer.written] \
+            == ["{0}{1}".format(path[0][0], path[0][1]) for path in paths]
+    # Without entering it early, the heavy path would start after about 30
+    # cheap paths and then run alone
+    assert writer.written[37][1] <= 2
+
+def describeOverlaps(overlaps):
+    '''Returns the overlaps from findOverlaps with alignments as dicts.
+    '''
+    return [ovl[:4] + (vars(ovl[4]),) for ovl in overlaps]
+
+@pytest.mark.parametrize("window", [0, 1500])
+def test_overlaps_of_contig_ends(monkeypatch, tmp_path, window):
+    rnd = random.Random(7)
+    shared = ["".join(rnd.choice("ACGT") for _ in range(800)) for _ in range(2)]
+    contigs = {"a": "".join(rnd.choice("ACGTacgtN") for _ in range(5000)) + shared[0],
+               "b": shared[0] + "".join(rnd.choice("ACGT") for _ in range(4000)) + shared[1],
+               "c": nt.reverse_complement(shared[1] + "".join(rnd.choice("ACGT") for _ in range(6000)))}
+    store = nt.ContigStore({tig: len(seq) for tig, seq in contigs.items()}, str(tmp_path))
+    for tig, seq in contigs.items():
+        store.write(tig, seq)
+    monkeypatch.setattr(merge_fasta, "trimmed_fasta", store, raising=False)
+    monkeypatch.setattr(merge_fasta, "overlap_window", window)
+    merge_fasta.reverseComplementContig.cache_clear()
+
+    for ori in ("+", "-"):
+        views = {tig: merge_fasta.overlapSequence(tig, ori) for tig in contigs}
+        strings = {tig: merge_fasta.orientedContig(tig, ori) for tig in contigs}
+        assert [str(views[tig]) for tig in contigs] == [strings[tig] for tig in contigs]
+        assert describeOverlaps(merge_fasta.findOverlaps(views)) \
+                == describeOverlaps(merge_fasta.findOverlaps(strings))
+    overlaps = merge_fasta.findOverlaps({tig: merge_fasta.overlapSequence(tig) for tig in contigs})
+    assert {key[:4] for key in overlaps} >= {("a", "+", "b", "+"), ("b", "+", "c", "-")}
+    merge_fasta.reverseComplementContig.cache_clear()
+    store.close()
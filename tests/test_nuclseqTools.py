@@ -0,0 +1,171 @@
+"""Tests for nuclseqTools.PackedSequence, ReverseComplementView and
+ContigStore.
+
+Decoded sequences are compared with the str operations they replace, on
+mixed-case input with N runs and other IUPAC codes.
+"""
+
+import os
+import pickle
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import pytest
+
+import nuclseqTools as nt
+
+IUPAC = "ACGTUMRWSYKVHDBNacgtumrwsykvhdbn"
+
+def randomSequence(length, rnd):
+    '''Mostly ACGT in both cases, with runs of N and single IUPAC codes.
+    '''
+    output = []
+    while len(output) < length:
+        draw = rnd.random()
+        if draw < 0.05:
+            output.extend(rnd.choice("Nn") * rnd.randint(1, 12))
+        elif draw < 0.1:
+            output.append(rnd.choice(IUPAC))
+        elif draw < 0.3:
+            output.extend(rnd.choice("acgt") for _ in range(rnd.randint(1, 8)))
+        else:
+            output.append(rnd.choice("ACGT"))
+    return "".join(output[:length])
+
+@pytest.mark.parametrize("length", [0, 1, 2, 3, 4, 5, 7, 8, 9, 100, 1001])
+def test_round_trip(length):
+    seq = randomSequence(length, random.Random(length))
+    packed = nt.PackedSequence.fromString(seq)
+
+    assert len(packed) == length
+    assert packed.decode() == seq
+    assert str(packed) == seq
+    assert packed.tobytes() == seq.encode("ascii")
+    assert nt.PackedSequence.fromString(seq.encode("ascii")).decode() == seq
+
+def test_iupac_codes():
+    packed = nt.PackedSequence.fromString(IUPAC)
+
+    assert packed.decode() == IUPAC
+    assert packed.reverse_complement().decode() == nt.reverse_complement(IUPAC)
+    assert nt.reverse_complement("ACGTUMRWSYKVHDBN") == "NVHDBMRSWYKAACGT"
+
+def test_slices():
+    rnd = random.Random(1)
+    seq = randomSequence(203, rnd)
+    packed = nt.PackedSequence.fromString(seq)
+
+    for start in range(0, 12):
+        for stop in list(range(start, start + 12)) + [150, 203, 250]:
+            assert packed[start:stop].decode() == seq[start:stop]
+    for _ in range(200):
+        start, stop = sorted(rnd.randint(0, 203) for _ in range(2))
+        assert packed[start:stop].decode() == seq[start:stop]
+        # Slices of slices, at other offsets in the packed bytes
+        inner_start, inner_stop = sorted(rnd.randint(0, stop - start) for _ in range(2))
+        assert packed[start:stop][inner_start:inner_stop].decode() \
+                == seq[start:stop][inner_start:inner_stop]
+    assert packed[-20:].decode() == seq[-20:]
+    assert packed[50:10].decode() == ""
+    with pytest.raises(ValueError):
+        packed[::2]
+
+def test_reverse_complement():
+    rnd = random.Random(2)
+    for length in (0, 1, 3, 4, 5, 64, 257):
+        seq = randomSequence(length, rnd)
+        packed = nt.PackedSequence.fromString(seq)
+
+        assert packed.reverse_complement().decode() == nt.reverse_complement(seq)
+        assert packed.reverse_complement().reverse_complement().decode() == seq
+        for _ in range(50):
+            start, stop = sorted(rnd.randint(0, length) for _ in range(2))
+            assert packed[start:stop].reverse_complement().decode() \
+                    == nt.reverse_complement(seq[start:stop])
+            assert packed.reverse_complement()[start:stop].decode() \
+                    == nt.reverse_complement(seq)[start:stop]
+
+def test_reverse_complement_view():
+    rnd = random.Random(3)
+    seq = randomSequence(301, rnd)
+    view = nt.ReverseComplementView(nt.PackedSequence.fromString(seq))
+    rc = nt.reverse_complement(seq)
+
+    assert len(view) == len(seq)
+    assert view.decode() == rc
+    assert str(view) == rc
+    for _ in range(100):
+        start, stop = sorted(rnd.randint(0, len(seq)) for _ in range(2))
+        assert view[start:stop].decode() == rc[start:stop]
+    assert str(view[:40]) == rc[:40]
+    assert str(view[-40:]) == rc[-40:]
+    with pytest.raises(ValueError):
+        view[::-1]
+
+@pytest.fixture
+def contigs():
+    rnd = random.Random(4)
+    return {"empty": "",
+            "short": "acGT",
+            "ns": "N" * 9,
+            "long": randomSequence(5003, rnd),
+            "last_empty": ""}
+
+def fillStore(contigs, directory):
+    store = nt.ContigStore({name: len(seq) for name, seq in contigs.items()}, directory)
+    for name, seq in contigs.items():
+        store.write(name, seq)
+    return store
+
+def test_contig_store(contigs, tmp_path):
+    store = fillStore(contigs, str(tmp_path))
+
+    assert len(store) == len(contigs)
+    assert list(store) == list(contigs) == store.keys()
+    assert "long" in store and "missing" not in store
+    for name, seq in contigs.items():
+        assert store.length(name) == len(seq)
+        assert store.sequence(name) == seq
+        assert store.packed(name).decode() == seq
+        assert store.packed(name).reverse_complement().decode() == nt.reverse_complement(seq)
+    assert store.sequence("long", 1000, 1010) == contigs["long"][1000:1010]
+    assert store.sequence("long", 4990) == contigs["long"][4990:]
+    assert store.packed("long", 7, 3001).decode() == contigs["long"][7:3001]
+    assert store.sequence("empty", 0, 0) == ""
+
+    path = store.path
+    assert os.path.exists(path)
+    store.close()
+    assert not os.path.exists(path)
+
+def test_contig_store_write_length(contigs, tmp_path):
+    store = fillStore(contigs, str(tmp_path))
+    with pytest.raises(ValueError):
+        store.write("short", "ACGTA")
+    # Rewriting with the right length replaces the sequence
+    store.write("short", "NNNN")
+    assert store.sequence("short") == "NNNN"
+    assert store.sequence("long") == contigs["long"]
+    store.close()
+
+def test_only_empty_contigs(tmp_path):
+    store = fillStore({"a": "", "b": ""}, str(tmp_path))
+
+    assert store.sequence("a") == store.sequence("b") == ""
+    assert len(store.packed("b")) == 0
+    store.close()
+
+def test_pickled_store(contigs, tmp_path):
+    store = fillStore(contigs, str(tmp_path))
+    attached = pickle.loads(pickle.dumps(store))
+
+    for name, seq in contigs.items():
+        assert attached.sequence(name) == seq
+    # Only the creating store removes the file
+    attached.close()
+    assert os.path.exists(store.path)
+    assert store.sequence("long", 0, 100) == contigs["long"][:100]
+    store.close()
+    assert not os.path.exists(store.path)
@@ -0,0 +1,773 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""benchmark.py
+
+Description: Benchmarks for performance critical steps of the ARBitR
+pipeline. Every benchmark compares a new implementation against the one
+it replaces and reports both the run times and if the results agree.
+
+Copyright (c) 2020, Markus Hiltunen
+Licensed under the GPL3 license. See LICENSE file.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import numpy as np
+import pysam
+from scipy import sparse
+
+import barcode_collection
+import graph_building
+import merge_fasta
+import nuclseqTools as nt
+
+parser = argparse.ArgumentParser(description="Benchmarks for performance \
+                                critical steps of the ARBitR pipeline.")
+subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+collection_parser = subparsers.add_parser("collection", \
+                    help="Single pass barcode collection against fetching \
+                    every window separately.")
+collection_parser.add_argument("input_bam", \
+                    help="Input bam file. Required.", \
+                    type = str)
+collection_parser.add_argument("-s","--region_size", \
+                    help="Size of region of contig start and end to collect \
+                    barcodes from. [20000]", \
+                    default = 20000, \
+                    type = int)
+collection_parser.add_argument("-m","--molecule_size", \
+                    help="Estimated mean molecule size. [45000]", \
+                    default = 45000, \
+                    type = int)
+collection_parser.add_argument("-q","--mapq", \
+                    help="Mapping quality cutoff value for linkgraph. [60]", \
+                    default = 60, \
+                    type = int)
+collection_parser.add_argument("-Q","--short_mapq", \
+                    help="Mapping quality cutoff value for pulling in short contigs. [20]", \
+                    default = 20, \
+                    type = int)
+collection_parser.add_argument("-b","--bc_quantity", \
+                    help="Minimum number of reads per barcode. [3]", \
+                    default = 3, \
+                    type = int)
+collection_parser.add_argument("-B","--short_bc_quant", \
+                    help="Minimum number of reads per barcode in short contigs. [2]", \
+                    default = 2, \
+                    type = int)
+collection_parser.add_argument("-n","--n_proc", \
+                    help="Number of processes to collect the single pass in. [1]", \
+                    default = 1, \
+                    type = int)
+
+linkgraph_parser = subparsers.add_parser("linkgraph", \
+                    help="Path extraction from an adjacency indexed linkgraph \
+                    against scanning the edge list.")
+linkgraph_parser.add_argument("-N","--nodes", \
+                    help="Numbers of nodes in the synthetic graphs. \
+                    [1000 10000 100000]", \
+                    default = [1000, 10000, 100000], \
+                    nargs = "+", \
+                    type = int)
+linkgraph_parser.add_argument("--max_old", \
+                    help="Largest graph to run the edge list scan on. [5000]", \
+                    default = 5000, \
+                    type = int)
+
+overlaps_parser = subparsers.add_parser("overlaps", \
+                    help="Overlap detection at contig ends only against \
+                    whole contigs.")
+overlaps_parser.add_argument("input_fasta", \
+                    help="Input fasta file. All contigs are overlapped \
+                    against each other. Required.", \
+                    type = str)
+overlaps_parser.add_argument("-w","--overlap_window", \
+                    help="Number of bases at each contig end to search for \
+                    overlaps in. [45000]", \
+                    default = 45000, \
+                    type = int)
+
+revcomp_parser = subparsers.add_parser("revcomp", \
+                    help="Reverse complement by translation against building \
+                    the string one base at a time.")
+revcomp_parser.add_argument("-l","--length", \
+                    help="Length of the random sequence. [5000000]", \
+                    default = 5000000, \
+                    type = int)
+
+consensus_parser = subparsers.add_parser("consensus", \
+                    help="Consensus construction from the integer cigar against \
+                    parsing the cigar string.")
+consensus_parser.add_argument("-l","--overlap_length", \
+                    help="Length of the simulated overlaps. [50000]", \
+                    default = 50000, \
+                    type = int)
+consensus_parser.add_argument("-e","--indel_rate", \
+                    help="Fraction of bases with an indel in the simulated \
+                    reads. [0.1]", \
+                    default = 0.1, \
+                    type = float)
+consensus_parser.add_argument("-r","--repeats", \
+                    help="Number of times to build each consensus. [20]", \
+                    default = 20, \
+                    type = int)
+
+traversal_parser = subparsers.add_parser("traversal", \
+                    help="Best path search through junction overlap graphs \
+                    against enumerating every path.")
+traversal_parser.add_argument("-N","--nodes", \
+                    help="Numbers of contigs in the synthetic junctions. \
+                    [6 8 10 12 14]", \
+                    default = [6, 8, 10, 12, 14], \
+                    nargs = "+", \
+                    type = int)
+traversal_parser.add_argument("--max_old", \
+                    help="Largest junction to enumerate every path in. [10]", \
+                    default = 10, \
+                    type = int)
+
+packed_parser = subparsers.add_parser("packed", \
+                    help="2-bit packed sequences against str for storage, \
+                    slicing and reverse complement.")
+packed_parser.add_argument("-l","--length", \
+                    help="Length of the random sequence. [5000000]", \
+                    default = 5000000, \
+                    type = int)
+packed_parser.add_argument("-s","--slice_length", \
+                    help="Length of the slices to take. [45000]", \
+                    default = 45000, \
+                    type = int)
+
+edges_parser = subparsers.add_parser("edges", \
+                    help="Outlier edge calling on all rows of the comparison \
+                    matrix at once against one row at a time.")
+edges_parser.add_argument("-N","--windows", \
+                    help="Numbers of windows in the synthetic comparisons. \
+                    [1000 10000 30000]", \
+                    default = [1000, 10000, 30000], \
+                    nargs = "+", \
+                    type = int)
+edges_parser.add_argument("-k","--partners", \
+                    help="Mean number of windows each window shares barcodes \
+                    with. [50]", \
+                    default = 50, \
+                    type = int)
+
+topk_parser = subparsers.add_parser("topk", \
+                    help="Linkgraph edges from the top k fractions of every \
+                    window against from all fractions.")
+topk_parser.add_argument("-N","--windows", \
+                    help="Numbers of windows in the synthetic GEMlists. \
+                    [2000 10000]", \
+                    default = [2000, 10000], \
+                    nargs = "+", \
+                    type = int)
+topk_parser.add_argument("-k","--top_k", \
+                    help="Number of fractions to keep per window. [20]", \
+                    default = 20, \
+                    type = int)
+
+lsh_parser = subparsers.add_parser("lsh", \
+                    help="Recall of linkgraph edges from MinHash/LSH candidate \
+                    pairs against comparing all windows.")
+lsh_parser.add_argument("-i","--input_bam", \
+                    help="Collect the windows from this bam file, e.g. the \
+                    test data. If not given, synthetic windows are used.", \
+                    type = str)
+lsh_parser.add_argument("-s","--region_size", \
+                    help="Size of region of contig start and end to collect \
+                    barcodes from. [20000]", \
+                    default = 20000, \
+                    type = int)
+lsh_parser.add_argument("-m","--molecule_size", \
+                    help="Minimum length of contigs to collect windows from. \
+                    [45000]", \
+                    default = 45000, \
+                    type = int)
+lsh_parser.add_argument("-N","--windows", \
+                    help="Number of synthetic windows. [10000]", \
+                    default = 10000, \
+                    type = int)
+lsh_parser.add_argument("--minhash_size", \
+                    help="Number of MinHash values per window. [128]", \
+                    default = 128, \
+                    type = int)
+lsh_parser.add_argument("--bands", \
+                    help="Numbers of LSH bands to report the recall of. \
+                    [16 32 64 128]", \
+                    default = [16, 32, 64, 128], \
+                    nargs = "+", \
+                    type = int)
+lsh_parser.add_argument("--bound_samples", \
+                    help="Numbers of barcode occurrences per window to \
+                    sample for the outlier bounds. The first is used for \
+                    the LSH bands. [500 200 1000]", \
+                    default = [500, 200, 1000], \
+                    nargs = "+", \
+                    type = int)
+lsh_parser.add_argument("--barcode_pool", \
+                    help="Number of random barcodes the synthetic windows \
+                    draw from. A fixed pool makes every window share \
+                    barcodes with more windows as the number of windows \
+                    grows, as in a real library. 0 uses 50 per window. [0]", \
+                    default = 0, \
+                    type = int)
+lsh_parser.add_argument("--min_link", \
+                    help="Fewest barcodes shared by linked synthetic \
+                    windows, drawn uniformly up to 60. Weaker links fall \
+                    near the outlier bounds. [60]", \
+                    default = 60, \
+                    type = int)
+
+tiled_parser = subparsers.add_parser("tiled", \
+                    help="Linkgraph edges from tiles spilled to disk against \
+                    from the comparison of all windows in memory.")
+tiled_parser.add_argument("-N","--windows", \
+                    help="Numbers of windows in the synthetic GEMlists. \
+                    [2000 10000]", \
+                    default = [2000, 10000], \
+                    nargs = "+", \
+                    type = int)
+tiled_parser.add_argument("-M","--memory_budget", \
+                    help="Memory budget of the tiled comparison in MB. [100]", \
+                    default = 100, \
+                    type = float)
+tiled_parser.add_argument("-n","--n_proc", \
+                    help="Number of processes to compare tiles with. Peak \
+                    memory is only measured in the main process. [1]", \
+                    default = 1, \
+                    type = int)
+
+class EdgeScanLinkgraph(graph_building.Linkgraph):
+    '''Linkgraph that looks up edges by scanning the edge list, as before
+    the adjacency index was introduced.
+    '''
+    def getEdges(self,node):
+        return [e for e in self.edges if e[0] == node]
+
+    def getNodes(self,node):
+        return [e[1] for e in self.edges if e[0] == node]
+
+    def unambiguousPaths(self):
+        visited_nodes = []
+        for n in self.nodes:
+            if n not in visited_nodes:
+                path = self.findPath(n)
+                if path != []:
+                    self.paths.append(path)
+                    for junc in path:
+                        visited_nodes.append(junc.start)
+                        visited_nodes.append(junc.target)
+                        for conn in junc.connections:
+                            visited_nodes.append(conn+"s")
+                            visited_nodes.append(conn+"e")
+                    if path[0].start != None:
+                        visited_nodes.append(self.opposite(path[0].start))
+                    if path[-1].target != None:
+                        visited_nodes.append(self.opposite(path[-1].target))
+
+def loopReverseComplement(nuclstring):
+    '''Reverse complement one base at a time, as before translation was
+    introduced.
+    '''
+    rev_comped = ""
+    for l in reversed(nuclstring):
+        if l == "A" or l == "a":
+            rev_comped += "T"
+        elif l == "T" or l == "t":
+            rev_comped += "A"
+        elif l == "C" or l == "c":
+            rev_comped += "G"
+        elif l == "G" or l == "g":
+            rev_comped += "C"
+        elif l == "N" or l == "n":
+            rev_comped += "N"
+    return rev_comped
+
+def stringCigarConsensus(step, string1, string2, gapsize):
+    '''Build the consensus of an overlap by parsing the cigar string, as
+    before the integer cigar was used.
+    '''
+    aln = step[4]
+    cig_list = []
+    pos = 0
+    for idx, c in enumerate(aln.cigar_str):
+        if c.isalpha():
+            cig_list.append(aln.cigar_str[pos:idx+1])
+            pos = idx + 1
+
+    ref_pos, query_pos = aln.r_st, aln.q_st
+    if step[3] == "-":
+        query_pos = len(string2) - aln.q_en
+
+    output_string = []
+    for cig in cig_list:
+        if cig[-1] == "M":
+            output_string.append( string1[ref_pos:ref_pos+int(cig[:-1])] )
+            ref_pos += int(cig[:-1])
+            query_pos += int(cig[:-1])
+        elif cig[-1] == "I":
+            output_string.append( string2[query_pos:query_pos+int(cig[:-1])] )
+            query_pos += int(cig[:-1])
+        elif cig[-1] == "D":
+            output_string.append( string1[ref_pos:ref_pos+int(cig[:-1])] )
+            ref_pos += int(cig[:-1])
+
+    ovl_len = len(''.join(output_string))
+    output_string.append( string2[query_pos:] )
+    return ''.join(output_string), False, ovl_len
+
+def simulateRead(seq, indel_rate, rnd):
+    '''Add PacBio-like errors to seq, mostly indels.
+    '''
+    read = list(seq)
+    for i in range(len(read)):
+        r = rnd.random()
+        if r < indel_rate / 2:
+            read[i] = ""
+        elif r < indel_rate:
+            read[i] += rnd.choice("ACGT")
+        elif r < indel_rate * 1.1:
+            read[i] = rnd.choice("ACGT")
+    return "".join(read)
+
+def syntheticLinkgraph(n_nodes, seed = 1):
+    '''Create the nodes and edges of a linkgraph made up of chains of
+    randomly oriented contigs, with occasional forks between chains.
+    '''
+    rnd = random.Random(seed)
+    contigs = ["ctg{}".format(i) for i in range(n_nodes // 2)]
+    nodes = graph_building.makeNodes(contigs)
+    edges = []
+    idx = 0
+    while idx < len(contigs):
+        chain = contigs[idx:idx + rnd.randint(2, 50)]
+        idx += len(chain)
+        forward = [rnd.random() < 0.5 for _ in chain]
+        for i in range(len(chain) - 1):
+            out_node = chain[i] + ("e" if forward[i] else "s")
+            in_node = chain[i+1] + ("s" if forward[i+1] else "e")
+            edges.append( (out_node, in_node, rnd.random()) )
+        if rnd.random() < 0.05:
+            edges.append( (rnd.choice(nodes), rnd.choice(nodes), rnd.random()) )
+    return nodes, edges
+
+def syntheticComparison(n_windows, partners, seed = 1):
+    '''Create a comparison matrix of fractions of shared barcodes, where
+    each window shares a few barcodes with many windows and many barcodes
+    with the window that continues its chain.
+    '''
+    rng = np.random.default_rng(seed)
+    windows = ["ctg{0}{1}".format(i // 2, "se"[i % 2]) for i in range(n_windows)]
+    n_pairs = n_windows * partners // 2
+    rows = np.concatenate([rng.integers(n_windows, size=n_pairs), np.arange(1, n_windows - 1, 2)])
+    columns = np.concatenate([rng.integers(n_windows, size=n_pairs), np.arange(2, n_windows, 2)])
+    fractions = np.concatenate([rng.exponential(0.005, size=n_pairs), \
+                                rng.uniform(0.02, 0.5, size=len(rows) - n_pairs)])
+    comparison = sparse.coo_matrix((fractions, (rows, columns)), shape=(n_windows, n_windows)).tocsr()
+    comparison = comparison.maximum(comparison.T).tocsr()
+    comparison.sort_indices()
+    return comparison, windows
+
+def syntheticGEMlist(n_windows, seed = 1, n_barcodes = 0, min_link = 60):
+    '''Create a GEMlist where every window has a few hundred random
+    barcodes out of n_barcodes, 50 per window if 0, and shares a block of
+    min_link to 60 barcodes with the window that continues its chain.
+    '''
+    rng = np.random.default_rng(seed)
+    n_barcodes = n_barcodes if n_barcodes > 0 else 50 * n_windows
+    windows = ["ctg{0}{1}".format(i // 2, "se"[i % 2]) for i in range(n_windows)]
+    barcode_arrays = []
+    for i in range(n_windows):
+        barcodes = rng.integers(0, n_barcodes, size=rng.integers(100, 300))
+        link = (i + 1) // 2 # Windows 2j-1 and 2j share the barcodes of link j
+        link_size = 60 if min_link >= 60 else np.random.default_rng((seed, link)).integers(min_link, 61)
+        barcodes = np.concatenate([barcodes, n_barcodes + 60 * link + np.arange(link_size)])
+        barcode_arrays.append(np.unique(barcodes).astype(np.uint32))
+    return barcode_collection.GEMlist(windows, barcode_arrays)
+
+def loopEdges(GEMcomparison, windows, barcode_factor, min_barcode_fraction):
+    '''Call outlier edges one row of GEMcomparison at a time, as makeEdges
+    did before calling all rows at once.
+    '''
+    edges = []
+    contigs = np.array([region[:-1] for region in windows])
+    for idx, region in enumerate(windows):
+        columns = GEMcomparison.indices[GEMcomparison.indptr[idx]:GEMcomparison.indptr[idx+1]]
+        fractions = GEMcomparison.data[GEMcomparison.indptr[idx]:GEMcomparison.indptr[idx+1]]
+        other_contig = contigs[columns] != region[:-1]
+        columns, fractions = columns[other_contig], fractions[other_contig]
+        if len(fractions) > 0:
+            is_outlier = (fractions > graph_building.outlierBound(fractions, barcode_factor)) \
+                        & (fractions > min_barcode_fraction)
+            for ix, mo in zip(columns[is_outlier], fractions[is_outlier]):
+                edges.append( (region, windows[ix], mo ) )
+    return edges
+
+def syntheticOverlapgraph(n_nodes, seed = 1):
+    '''Create an overlap graph where half of all possible overlaps between
+    n_nodes contigs are present, as in junctions with many short contigs.
+    '''
+    rnd = random.Random(seed)
+    nodes = ["ctg{}".format(i) for i in range(n_nodes)]
+    edges = set()
+    for n1 in nodes:
+        for n2 in nodes:
+            for ori1 in "+-":
+                for ori2 in "+-":
+                    if n1 != n2 and rnd.random() < 0.5:
+                        blen = rnd.randint(100, 5000)
+                        aln = merge_fasta.Alignment(10000, 10000 - blen, 10000, \
+                                                    0, blen, 1, blen, blen, [[blen, 0]])
+                        edges.add( (n1, ori1, n2, ori2, aln) )
+    return merge_fasta.Overlapgraph(set(nodes), edges), nodes[0], nodes[-1]
+
+def timed(func, *args, **kwargs):
+    '''Run func and return its result and the elapsed wall clock time.
+    '''
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def report(name, old_time, new_time, identical):
+    '''Print a summary line for a benchmark.
+    '''
+    print("{0}\told: {1:.3f} s\tnew: {2:.3f} s\tspeedup: {3:.2f}x\tidentical: {4}".format( \
+            name, old_time, new_time, old_time / new_time if new_time > 0 else float("inf"), identical))
+
+def benchmark_collection(args):
+    '''Compare two fetch based barcode collections against one single pass.
+    '''
+    samfile = pysam.AlignmentFile(args.input_bam, "rb")
+    contig_lengths = dict(zip(samfile.references, samfile.lengths))
+    samfile.close()
+    backbone = {k:v for k,v in contig_lengths.items() if v > args.molecule_size}
+    small = {k:v for k,v in contig_lengths.items() if k not in backbone}
+
+    def fetch_per_window():
+        return barcode_collection.main(args.input_bam, backbone, args.region_size, \
+                                        args.mapq, args.bc_quantity), \
+                barcode_collection.main(args.input_bam, small, args.molecule_size, \
+                                        args.short_mapq, args.short_bc_quant)
+
+    old, old_time = timed(fetch_per_window)
+    new, new_time = timed(barcode_collection.collectAll, args.input_bam, backbone, small, \
+                            args.region_size, args.molecule_size, args.mapq, \
+                            args.bc_quantity, args.short_mapq, args.short_bc_quant, \
+                            args.n_proc)
+    report("collection", old_time, new_time, old == new)
+
+def benchmark_linkgraph(args):
+    '''Time path extraction on synthetic graphs of increasing size.
+    '''
+    barcodes = np.arange(200, dtype=np.uint32)
+    for n_nodes in args.nodes:
+        nodes, edges = syntheticLinkgraph(n_nodes)
+        graph_building.GEMs = {node:barcodes for node in nodes}
+
+        graph = graph_building.Linkgraph(nodes, edges)
+        _, new_time = timed(graph.unambiguousPaths)
+        print("linkgraph\tnodes: {0}\tedges: {1}\tpaths: {2}\tnew: {3:.3f} s\tper node: {4:.2f} us".format( \
+                n_nodes, len(graph.edges), len(graph.paths), new_time, new_time / n_nodes * 1e6))
+
+        if n_nodes <= args.max_old:
+            old_graph = EdgeScanLinkgraph(nodes, edges)
+            _, old_time = timed(old_graph.unambiguousPaths)
+            identical = [[str(junc) for junc in path] for path in graph.paths] \
+                        == [[str(junc) for junc in path] for path in old_graph.paths]
+            report("linkgraph {}".format(n_nodes), old_time, new_time, identical)
+
+def benchmark_edges(args):
+    '''Time outlier edge calling on synthetic comparison matrices.
+    '''
+    for n_windows in args.windows:
+        comparison, windows = syntheticComparison(n_windows, args.partners)
+        old, old_time = timed(loopEdges, comparison, windows, 3, 0.01)
+        new, new_time = timed(graph_building.makeEdges, comparison, windows, 3, 0.01)
+        report("edges {0}\tpairs: {1}\tedges: {2}".format(n_windows, comparison.nnz, len(new)), \
+                old_time, new_time, old == new)
+
+def benchmark_topk(args):
+    '''Compare the time, peak memory and edges of the top k comparison with
+    the comparison of all windows.
+    '''
+    for n_windows in args.windows:
+        GEMlist = syntheticGEMlist(n_windows)
+        windows = GEMlist.keys()
+
+        def full():
+            return graph_building.makeEdges(graph_building.pairwise_comparisons(GEMlist), \
+                                            windows, 3, 0.01)
+        def top():
+            comparison, bounds = graph_building.pairwise_top_comparisons(GEMlist, args.top_k, 3)
+            return graph_building.makeEdges(comparison, windows, 3, 0.01, bounds)
+
+        tracemalloc.start()
+        old, old_time = timed(full)
+        old_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        new, new_time = timed(top)
+        new_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report("topk {0}\tpeak old: {1:.1f} MB\tpeak new: {2:.1f} MB".format( \
+                n_windows, old_peak / 1e6, new_peak / 1e6), old_time, new_time, old == new)
+
+def exactBounds(incidence, sizes, contigs, barcode_factor):
+    '''Outlier bound of every window from all its fractions, as
+    pairwise_lsh_comparisons calculated them before sampling.
+    '''
+    bounds = np.full(incidence.shape[0], np.nan)
+    for start, end, _, rows, _, fractions in graph_building.blockFractions(incidence, sizes, contigs):
+        bounds[start:end] = graph_building.rowOutlierBounds(rows - start, fractions, end - start, \
+                                                            barcode_factor)
+    return bounds
+
+def benchmark_lsh(args):
+    '''Report the recall and precision of the edges called from LSH
+    candidate pairs, with the edges from the comparison of all windows as
+    the truth.
+
+    Description:
+        The bounds lines call edges from all pairs, with outlier bounds
+        estimated from samples instead of exact, so they show what the
+        estimated bounds alone lose. The LSH lines use the first number of
+        samples, and time the sketching with the comparison.
+    '''
+    if args.input_bam:
+        samfile = pysam.AlignmentFile(args.input_bam, "rb")
+        contig_lengths = dict(zip(samfile.references, samfile.lengths))
+        samfile.close()
+        backbone = {k:v for k,v in contig_lengths.items() if v > args.molecule_size}
+        GEMlist = barcode_collection.main(args.input_bam, backbone, args.region_size, 60, 3)
+    else:
+        GEMlist = syntheticGEMlist(args.windows, n_barcodes=args.barcode_pool, min_link=args.min_link)
+    windows = GEMlist.keys()
+
+    # The first comparison pays for growing the process memory, which would
+    # otherwise be counted against the exact comparison only
+    graph_building.makeEdges(graph_building.pairwise_comparisons(GEMlist), windows, 39, 0.01)
+    comparison, comparison_time = timed(graph_building.pairwise_comparisons, GEMlist)
+    exact, edge_time = timed(graph_building.makeEdges, comparison, windows, 39, 0.01)
+    exact_time = comparison_time + edge_time
+    sketches, sketch_time = timed(GEMlist.minhash, args.minhash_size)
+    print("lsh\twindows: {0}\texact edges: {1}\tsketching: {2:.3f} s".format( \
+            len(windows), len(exact), sketch_time))
+
+    def accuracy(edges):
+        found = {edge[:2] for edge in edges}
+        recall = len(found & exact) / len(exact) if exact else 1.0
+        precision = len(found & exact) / len(found) if found else 1.0
+        return found, recall, precision
+
+    exact = {edge[:2] for edge in exact}
+    incidence = graph_building.incidenceMatrix(GEMlist)
+    contigs = graph_building.windowContigs(windows)
+    exact_bounds, bound_time = timed(exactBounds, incidence, GEMlist.sizes(), contigs, 39)
+    for n_samples in args.bound_samples:
+        bounds, sampled_time = timed(graph_building.sampledOutlierBounds, \
+                                    incidence, GEMlist.sizes(), contigs, 39, n_samples)
+        error = np.abs(bounds - exact_bounds) / exact_bounds
+        found, recall, precision = accuracy(graph_building.makeEdges(comparison, windows, 39, 0.01, bounds))
+        report("bounds {0} samples\tmedian error: {1:.3f}\t99th percentile: {2:.3f}\t".format( \
+                n_samples, np.nanmedian(error) if len(error) else 0.0, \
+                np.nanpercentile(error, 99) if len(error) else 0.0) + \
+                "edges: {0}\trecall: {1:.3f}\tprecision: {2:.3f}".format(len(found), recall, precision), \
+                bound_time, sampled_time, found == exact)
+
+    graph_building.lsh_bound_samples = args.bound_samples[0]
+    for n_bands in args.bands:
+        def approximate():
+            comparison, bounds = graph_building.pairwise_lsh_comparisons(GEMlist, sketches, n_bands, 39)
+            return comparison.nnz, graph_building.makeEdges(comparison, windows, 39, 0.01, bounds)
+        (n_pairs, edges), lsh_time = timed(approximate)
+        found, recall, precision = accuracy(edges)
+        report("lsh {0} bands\tpairs: {1}\tedges: {2}\trecall: {3:.3f}\tprecision: {4:.3f}".format( \
+                n_bands, n_pairs, len(found), recall, precision), \
+                exact_time, lsh_time + sketch_time, found == exact)
+
+def benchmark_tiled(args):
+    '''Compare the time, peak memory and edges of the tiled comparison with
+    the comparison of all windows in memory.
+    '''
+    for n_windows in args.windows:
+        GEMlist = syntheticGEMlist(n_windows)
+
+        def full():
+            return graph_building.makeEdges(graph_building.pairwise_comparisons(GEMlist), \
+                                            GEMlist.keys(), 3, 0.01)
+
+        tracemalloc.start()
+        old, old_time = timed(full)
+        old_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        new, new_time = timed(graph_building.tiledEdges, GEMlist, 3, 0.01, \
+                                args.memory_budget * 1e6, args.n_proc)
+        new_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report("tiled {0}\tpeak old: {1:.1f} MB\tpeak new: {2:.1f} MB".format( \
+                n_windows, old_peak / 1e6, new_peak / 1e6), old_time, new_time, old == new)
+
+def benchmark_overlaps(args):
+    '''Compare overlaps and merges found at contig ends to those found
+    from whole contigs.
+    '''
+    fastafile = pysam.FastaFile(args.input_fasta)
+    fasta = {tig:fastafile.fetch(tig) for tig in fastafile.references}
+    fastafile.close()
+
+    merge_fasta.overlap_window = 0
+    full, old_time = timed(merge_fasta.findOverlaps, fasta)
+    merge_fasta.overlap_window = args.overlap_window
+    ends, new_time = timed(merge_fasta.findOverlaps, fasta)
+    merge_fasta.overlap_window = 0
+
+    full = {edge[:4]:edge for edge in full}
+    ends = {edge[:4]:edge for edge in ends}
+    shared = full.keys() & ends.keys()
+
+    # Compare the merged sequences of overlaps found in both modes
+    same_merge = 0
+    for key in shared:
+        seq1 = fasta[key[0]] if key[1] == "+" else nt.reverse_complement(fasta[key[0]])
+        seq2 = fasta[key[2]] if key[3] == "+" else nt.reverse_complement(fasta[key[2]])
+        if merge_fasta.createConsensus(full[key], seq1, seq2, 100) \
+        == merge_fasta.createConsensus(ends[key], seq1, seq2, 100):
+            same_merge += 1
+
+    report("overlaps", old_time, new_time, full.keys() == ends.keys())
+    print("overlaps\twhole contigs: {0}\tcontig ends: {1}\tin both: {2}\tidentical merges: {3}".format( \
+            len(full), len(ends), len(shared), same_merge))
+
+def benchmark_revcomp(args):
+    '''Time reverse complementing a random sequence, and repeated lookups
+    of a cached reverse complemented contig.
+    '''
+    rnd = random.Random(1)
+    seq = "".join(rnd.choices("ACGTN", weights=[30, 20, 20, 30, 1], k=args.length))
+
+    old, old_time = timed(loopReverseComplement, seq)
+    new, new_time = timed(nt.reverse_complement, seq)
+    report("revcomp {}".format(args.length), old_time, new_time, old == new)
+
+    merge_fasta.trimmed_fasta = nt.ContigStore({"ctg": len(seq)})
+    merge_fasta.trimmed_fasta.write("ctg", seq)
+    merge_fasta.reverseComplementContig.cache_clear()
+    _, uncached_time = timed(lambda: [nt.reverse_complement(seq) for _ in range(10)])
+    _, cached_time = timed(lambda: [merge_fasta.orientedContig("ctg", "-") for _ in range(10)])
+    report("revcomp cached x10", uncached_time, cached_time, \
+            merge_fasta.orientedContig("ctg", "-") == new)
+    merge_fasta.trimmed_fasta.close()
+
+def benchmark_consensus(args):
+    '''Time consensus construction of simulated overlaps between noisy
+    contig ends, with the query in both orientations.
+    '''
+    rnd = random.Random(1)
+    genome = "".join(rnd.choices("ACGT", k=3 * args.overlap_length))
+    ref = simulateRead(genome[:2 * args.overlap_length], args.indel_rate, rnd)
+    query = simulateRead(genome[args.overlap_length:], args.indel_rate, rnd)
+
+    # The query contig is stored in either orientation. In the step it is
+    # always oriented to follow the reference, i.e. it is query.
+    for ori in ["+", "-"]:
+        query_contig = query if ori == "+" else nt.reverse_complement(query)
+        suffix_overlaps, _ = merge_fasta.findOverlap(ref, query_contig)
+        suffix_overlaps = [aln for aln in suffix_overlaps if aln.strand == (1 if ori == "+" else -1)]
+        if not suffix_overlaps:
+            print("consensus {}\tno overlap found".format(ori))
+            continue
+        aln = max(suffix_overlaps, key=lambda aln: aln.blen)
+        step = ("ref", "+", "query", ori, aln)
+        n_indels = sum(l for l, op in aln.cigar if op in (1, 2))
+
+        old, old_time = timed(lambda: [stringCigarConsensus(step, ref, query, 100) \
+                                        for _ in range(args.repeats)])
+        new, new_time = timed(lambda: [merge_fasta.createConsensus(step, ref, query, 100) \
+                                        for _ in range(args.repeats)])
+        report("consensus {0} overlap: {1} indels: {2}".format(ori, aln.blen, n_indels), \
+                old_time, new_time, old == new)
+
+def benchmark_traversal(args):
+    '''Time finding the best path through synthetic junctions.
+    '''
+    for n_nodes in args.nodes:
+        graph, start, target = syntheticOverlapgraph(n_nodes)
+        new, new_time = timed(graph.bestPath, start, "+", target, "+")
+        print("traversal\tcontigs: {0}\tedges: {1}\tnew: {2:.3f} s".format( \
+                n_nodes, len(graph.edges), new_time))
+
+        if n_nodes <= args.max_old:
+            graph, start, target = syntheticOverlapgraph(n_nodes)
+            graph.max_steps = float("inf")
+            def enumerate_paths():
+                graph.traverse(start, "+", target, "+")
+                return merge_fasta.shortestPath(graph.paths)
+            old, old_time = timed(enumerate_paths)
+            report("traversal {}".format(n_nodes), old_time, new_time, \
+                    [step[:4] for step in old] == [step[:4] for step in new])
+
+def benchmark_packed(args):
+    '''Compare the size of a 2-bit packed sequence with the str, and time
+    slicing and reverse complementing both.
+    '''
+    rnd = random.Random(1)
+    # Soft masked repeats and gaps come in runs, every tenth block of 1 kb
+    blocks = []
+    for i in range(0, args.length, 1000):
+        block = "".join(rnd.choices("ACGT", weights=[30, 20, 20, 30], k=min(1000, args.length - i)))
+        blocks.append(block.lower() if i % 10000 == 0 else block.replace("A", "N", 1) if i % 10000 == 5000 else block)
+    seq = "".join(blocks)
+    packed, encode_time = timed(nt.PackedSequence.fromString, seq)
+    packed_size = packed.data.nbytes + sum(table.nbytes for table in [ \
+                    packed.other_starts, packed.other_ends, packed.other_chars, \
+                    packed.lower_starts, packed.lower_ends])
+    print("packed {0}\tstr: {1} bytes\tpacked: {2} bytes\tencode: {3:.3f} s".format( \
+            args.length, len(seq), packed_size, encode_time))
+
+    starts = [rnd.randrange(args.length - args.slice_length) for _ in range(100)]
+    old, old_time = timed(lambda: [seq[s:s + args.slice_length] for s in starts])
+    new, new_time = timed(lambda: [packed[s:s + args.slice_length] for s in starts])
+    report("slice x100", old_time, new_time, [p.decode() for p in new] == old)
+
+    old, old_time = timed(nt.reverse_complement, seq)
+    new, new_time = timed(packed.reverse_complement)
+    report("revcomp {}".format(args.length), old_time, new_time, new.decode() == old)
+    _, decode_time = timed(new.decode)
+    print("decode {0}\t{1:.3f} s".format(args.length, decode_time))
+
+def main():
+    args = parser.parse_args()
+    if args.benchmark == "collection":
+        benchmark_collection(args)
+    elif args.benchmark == "linkgraph":
+        benchmark_linkgraph(args)
+    elif args.benchmark == "edges":
+        benchmark_edges(args)
+    elif args.benchmark == "topk":
+        benchmark_topk(args)
+    elif args.benchmark == "lsh":
+        benchmark_lsh(args)
+    elif args.benchmark == "tiled":
+        benchmark_tiled(args)
+    elif args.benchmark == "overlaps":
+        benchmark_overlaps(args)
+    elif args.benchmark == "revcomp":
+        benchmark_revcomp(args)
+    elif args.benchmark == "consensus":
+        benchmark_consensus(args)
+    elif args.benchmark == "traversal":
+        benchmark_traversal(args)
+    elif args.benchmark == "packed":
+        benchmark_packed(args)
+
+if __name__ == "__main__":
+    main()